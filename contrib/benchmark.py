@@ -3,6 +3,7 @@ import os
 import sys
 import json
 import time
+import argparse
 
 from subprocess import Popen, PIPE
 from tempfile import NamedTemporaryFile
@@ -32,6 +33,11 @@ def benchmark(name, config, args):
       "value": run_time
     }
 
+parser = argparse.ArgumentParser(description='Times opustrainer on a number of scenarios, and prints the results as JSON.')
+parser.add_argument('--backends', action='store_true', help='Also time Tags with SPM with each backend for the modifier workers. Not run by CI, as it takes a while')
+parser.add_argument('--pipeline', action='store_true', help='Also time UpperCase and Tags with SPM seeded per line, in the same processes and in a pipeline. Not run by CI, as it takes a while')
+args = parser.parse_args()
+
 with NamedTemporaryFile('w') as testdata:
 	with open(os.path.join(root, 'test-data/clean.enzh.10')) as fh:
 		for _ in range(10_000):
@@ -93,6 +99,42 @@ with NamedTemporaryFile('w') as testdata:
 		},
 	]
 
+	# The same with the modifiers in threads or subinterpreters, where this
+	# Python has them. Threads only run side by side without a GIL.
+	backends = []
+	if args.backends:
+		backends.append('processes')
+		if not getattr(sys, '_is_gil_enabled', lambda: True)():
+			backends.append('threads')
+		if sys.version_info >= (3, 14):
+			backends.append('interpreters')
+
+	scenarios += [
+		{
+			"name": f"Tags with SPM ({backend})",
+			"args": ["--backend", backend],
+			"config": scenarios[-1]["config"]
+		}
+		for backend in backends
+	]
+
+	# Each line seeded on its own, with the modifiers in the same processes or
+	# in a pipeline, which passes the random state of every line from one stage
+	# to the next.
+	pipelines = [("processes", []), ("pipeline", ["--modifier-pipeline", "Tags=3"])] if args.pipeline else []
+
+	scenarios += [
+		{
+			"name": f"UpperCase and Tags with SPM, seeded per line ({name})",
+			"args": ["--rng", "philox", *options],
+			"config": {
+				**scenarios[2]["config"],
+				"modifiers": [{"UpperCase": 0.1}, *scenarios[2]["config"]["modifiers"]]
+			}
+		}
+		for name, options in pipelines
+	]
+
 	json.dump([
 		benchmark(**scenario)
 		for scenario in scenarios
@@ -0,0 +1,193 @@
+"""Decides which CPUs the trainer program, the modifier workers and the shufflers
+run on, within the CPUs this process may use.
+
+The CPUs available are those in the affinity mask of this process, which
+schedulers and containers restrict, and the number of them that can be kept
+busy may be limited further by a cgroup CPU quota. `os.cpu_count()` knows about
+neither.
+
+CPUs are given as lists like `0-3,8,10-11`, as NUMA nodes like `node1`, or a
+mix of both. All of this degrades to "any CPU" on platforms without
+`os.sched_getaffinity`.
+"""
+import math
+import os
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from opustrainer import logger
+
+
+# cgroup v2, and v1 quota and period, in microseconds
+CGROUP_CPU_MAX = '/sys/fs/cgroup/cpu.max'
+CGROUP_V1_QUOTA = '/sys/fs/cgroup/cpu/cpu.cfs_quota_us'
+CGROUP_V1_PERIOD = '/sys/fs/cgroup/cpu/cpu.cfs_period_us'
+
+NUMA_NODES = '/sys/devices/system/node'
+
+
+def parse_cpu_list(text:str) -> List[int]:
+    """Parses a list like `0-3,8` into the CPUs it contains."""
+    cpus = set()
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        match = re.fullmatch(r'(\d+)(?:-(\d+))?', part)
+        if match is None:
+            raise ValueError(f'cannot parse CPU list: {text}')
+        first = int(match.group(1))
+        last = int(match.group(2)) if match.group(2) is not None else first
+        cpus.update(range(first, last + 1))
+    return sorted(cpus)
+
+
+def format_cpu_list(cpus:List[int]) -> str:
+    """Inverse of `parse_cpu_list()`."""
+    ranges: List[List[int]] = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(first) if first == last else f'{first}-{last}' for first, last in ranges)
+
+
+def available_cpus() -> List[int]:
+    """CPUs this process may run on."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def cgroup_cpu_limit() -> Optional[float]:
+    """Number of CPUs worth of time the cgroup quota allows, if there is one."""
+    try:
+        with open(CGROUP_CPU_MAX, 'r') as fh:
+            quota, period = fh.read().split()
+        if quota == 'max':
+            return None
+        return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+
+    try:
+        with open(CGROUP_V1_QUOTA, 'r') as fh:
+            quota = fh.read().strip()
+        with open(CGROUP_V1_PERIOD, 'r') as fh:
+            period = fh.read().strip()
+        if int(quota) <= 0:
+            return None
+        return int(quota) / int(period)
+    except (OSError, ValueError):
+        return None
+
+
+def numa_nodes() -> Dict[int,List[int]]:
+    """CPUs of each NUMA node, if the platform tells us."""
+    nodes = {}
+    try:
+        entries = os.listdir(NUMA_NODES)
+    except OSError:
+        return {}
+    for entry in entries:
+        match = re.fullmatch(r'node(\d+)', entry)
+        if match is None:
+            continue
+        try:
+            with open(os.path.join(NUMA_NODES, entry, 'cpulist'), 'r') as fh:
+                nodes[int(match.group(1))] = parse_cpu_list(fh.read())
+        except (OSError, ValueError):
+            continue
+    return nodes
+
+
+def resolve_cpus(spec:str, available:List[int]) -> List[int]:
+    """CPUs of `spec`, a list of CPUs and NUMA nodes, that are in `available`."""
+    cpus = set()
+    nodes: Optional[Dict[int,List[int]]] = None
+    for part in spec.split(','):
+        part = part.strip()
+        match = re.fullmatch(r'node(\d+)', part)
+        if match is not None:
+            if nodes is None:
+                nodes = numa_nodes()
+            if int(match.group(1)) not in nodes:
+                raise ValueError(f'there is no NUMA node {match.group(1)}')
+            cpus.update(nodes[int(match.group(1))])
+        else:
+            cpus.update(parse_cpu_list(part))
+    selected = sorted(cpus & set(available))
+    if not selected:
+        raise ValueError(f'none of the CPUs in {spec} are available, choose from {format_cpu_list(available)}')
+    return selected
+
+
+def set_affinity(cpus:Optional[List[int]]) -> None:
+    """Restricts the calling process to `cpus`, if given and supported."""
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+
+
+def worker_cpus(index:int, workers:int, cpus:List[int]) -> List[int]:
+    """CPUs for worker `index` of `workers`. Each worker gets its own CPU if
+    there are enough of them, otherwise all workers share them."""
+    if workers <= len(cpus):
+        return [cpus[index]]
+    return list(cpus)
+
+
+@dataclass(frozen=True)
+class CpuLayout:
+    """CPUs reserved for the trainer program, and those opustrainer itself, the
+    modifier workers and shufflers run on. Empty lists mean no restriction."""
+    trainer: List[int]
+    main: List[int]
+    workers: List[int]
+    shuffle: List[int]
+
+    # Number of modifier workers that fit in the CPU budget
+    budget: int
+
+    def log(self, loglevel:str="INFO") -> None:
+        describe = lambda cpus: format_cpu_list(cpus) if cpus else 'any'
+        logger.log(f"CPU layout: trainer {describe(self.trainer)}, opustrainer {describe(self.main)}, modifier workers {describe(self.workers)}, "
+                   f"shufflers {describe(self.shuffle)}; room for {self.budget} modifier workers", loglevel=loglevel)
+
+
+def plan_layout(*, trainer:Optional[str]=None, workers:Optional[str]=None, shuffle:Optional[str]=None) -> CpuLayout:
+    """Splits the available CPUs. `trainer` is a number of CPUs to reserve for
+    the trainer program, taken from the end, or a list of them. The modifier
+    workers and shufflers get the rest, unless `workers` and `shuffle` say
+    otherwise. The budget is the number of worker CPUs, limited by the cgroup
+    quota minus what is reserved for the trainer."""
+    available = available_cpus()
+
+    reserved: List[int] = []
+    if trainer is not None:
+        if trainer.strip().isdigit():
+            count = int(trainer)
+            if count >= len(available):
+                raise ValueError(f'cannot reserve {count} of {len(available)} available CPUs for the trainer')
+            reserved = available[len(available) - count:] if count > 0 else []
+        else:
+            reserved = resolve_cpus(trainer, available)
+
+    rest = [cpu for cpu in available if cpu not in reserved] or available
+
+    worker_set = resolve_cpus(workers, rest) if workers is not None else rest
+    shuffle_set = resolve_cpus(shuffle, rest) if shuffle is not None else rest
+
+    budget = len(worker_set)
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        budget = min(budget, math.floor(limit) - len(reserved))
+
+    # Only pin what was asked for
+    return CpuLayout(
+        trainer=reserved,
+        main=rest if reserved else [],
+        workers=worker_set if workers is not None or reserved else [],
+        shuffle=shuffle_set if shuffle is not None or reserved else [],
+        budget=max(budget, 1))
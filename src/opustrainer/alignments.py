@@ -11,14 +11,19 @@ def parse_alignments(input_pairs:str, src_tokens:Optional[TokenList]=None, trg_t
     ]
 
     if src_tokens is not None and trg_tokens is not None:
-        for pair in pairs:
-            if pair.src < 0 or pair.src >= len(src_tokens) \
-            or pair.trg < 0 or pair.trg >= len(trg_tokens):
-                raise ValueError('Out-of-bound alignment pairs')
+        check_alignments(pairs, src_tokens, trg_tokens)
 
     return pairs
 
 
+def check_alignments(pairs:List[Pair], src_tokens:TokenList, trg_tokens:TokenList) -> None:
+    """Raises a ValueError if any of the indices of `pairs` is out of bounds."""
+    for pair in pairs:
+        if pair.src < 0 or pair.src >= len(src_tokens) \
+        or pair.trg < 0 or pair.trg >= len(trg_tokens):
+            raise ValueError('Out-of-bound alignment pairs')
+
+
 def format_alignments(pairs:List[Pair]) -> str:
     """Opposite of `parse_alignments`, turns a list of alignments back into the `a-b c-d ...` string
     format that most alignment tools expect."""
@@ -0,0 +1,119 @@
+"""Statistics about the datasets in a curriculum. These are gathered while the
+dataset is read for shuffling anyway, and cached on disk so that subsequent runs
+know how big each dataset is without counting lines at startup.
+"""
+import os
+import json
+import hashlib
+
+from dataclasses import dataclass
+from typing import Dict, List, Iterable, Iterator, Optional
+
+
+@dataclass(frozen=True)
+class DatasetStats:
+    """Line count, byte size and the distribution of field counts and line
+    lengths of a dataset."""
+    lines: int
+    bytes: int
+
+    # Number of tab separated fields => number of lines with that many fields
+    fields: Dict[int,int]
+
+    # Line length in bytes rounded up to a power of two => number of lines
+    lengths: Dict[int,int]
+
+    @property
+    def mean_line_length(self) -> float:
+        return self.bytes / self.lines if self.lines > 0 else 0.0
+
+
+class StatsCollector(Iterable[bytes]):
+    """Wraps an iterable of lines and gathers DatasetStats while they pass
+    through it."""
+    lines: int
+    bytes: int
+    fields: Dict[int,int]
+    lengths: Dict[int,int]
+
+    def __init__(self, lines:Iterable[bytes]):
+        self._it = lines
+        self.lines = 0
+        self.bytes = 0
+        self.fields = {}
+        self.lengths = {}
+
+    def __iter__(self) -> Iterator[bytes]:
+        for line in self._it:
+            self.lines += 1
+            self.bytes += len(line)
+            num_fields = line.count(b'\t') + 1
+            self.fields[num_fields] = self.fields.get(num_fields, 0) + 1
+            bucket = 1 << len(line).bit_length()
+            self.lengths[bucket] = self.lengths.get(bucket, 0) + 1
+            yield line
+
+    def stats(self) -> DatasetStats:
+        return DatasetStats(self.lines, self.bytes, dict(self.fields), dict(self.lengths))
+
+
+def fingerprint(files:List[str]) -> str:
+    """Identifies a list of files by their path, size and modification time. If
+    any of these changes, the cached statistics are no longer valid."""
+    digest = hashlib.sha1()
+    for filename in files:
+        info = os.stat(filename)
+        digest.update(f'{os.path.abspath(filename)}\0{info.st_size}\0{info.st_mtime_ns}\0'.encode())
+    return digest.hexdigest()
+
+
+def dump_stats(stats:DatasetStats) -> dict:
+    return {
+        'lines': stats.lines,
+        'bytes': stats.bytes,
+        'fields': stats.fields,
+        'lengths': stats.lengths,
+    }
+
+
+def load_stats(data:dict) -> DatasetStats:
+    # JSON turns the integer keys of the histograms into strings
+    return DatasetStats(
+        lines=int(data['lines']),
+        bytes=int(data['bytes']),
+        fields={int(key): int(value) for key, value in data['fields'].items()},
+        lengths={int(key): int(value) for key, value in data['lengths'].items()})
+
+
+class DatasetCatalog:
+    """Cache of DatasetStats, keyed by the fingerprint of a dataset's files.
+    If `path` is given, the catalog is read from and written to that file."""
+    path: Optional[str]
+    entries: Dict[str,DatasetStats]
+
+    def __init__(self, path:Optional[str]=None):
+        self.path = path
+        self.entries = {}
+        if path is not None and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as fh:
+                self.entries = {
+                    key: load_stats(value)
+                    for key, value in json.load(fh).items()
+                }
+
+    def get(self, files:List[str]) -> Optional[DatasetStats]:
+        try:
+            return self.entries.get(fingerprint(files))
+        except FileNotFoundError:
+            return None
+
+    def update(self, files:List[str], stats:DatasetStats) -> None:
+        self.entries[fingerprint(files)] = stats
+        if self.path is not None:
+            self._dump(self.path)
+
+    def _dump(self, path:str) -> None:
+        new_path = f'{path}.new'
+        with open(new_path, 'w', encoding='utf-8') as fh:
+            json.dump({key: dump_stats(value) for key, value in self.entries.items()}, fh)
+        os.rename(new_path, path)
@@ -0,0 +1,188 @@
+"""Python API to the batches of a curriculum, for trainers that run in the same
+process. Instead of starting opustrainer and reading lines from a pipe, iterate
+over a CurriculumDataset:
+
+    dataset = CurriculumDataset('train_config.yml', records=True)
+    for batch in dataset:
+        for src, trg, alignments in batch:
+            ...
+
+The dataset can be used as a PyTorch IterableDataset. When it is iterated by
+the workers of a DataLoader, each worker gets its own part of the batches, the
+same way `--rank` and `--world-size` split them between processes. Saving and
+restoring is left to the host's checkpoints, through `state_dict()` and
+`load_state_dict()`.
+
+Note that, like opustrainer-train, this uses the global state of Python's
+`random` module.
+"""
+import os
+from dataclasses import asdict
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import yaml
+
+from opustrainer.trainer import Curriculum, CurriculumLoader, Trainer, TrainerState, EpochTrackerState, DatasetState
+from opustrainer.catalog import DatasetCatalog
+from opustrainer.alignments import parse_alignments
+from opustrainer.types import Record
+
+
+def parse_record(line:str) -> Record:
+    """Splits a `src<tab>trg<tab>alignments` line into a Record. Fields after
+    the alignments are ignored."""
+    fields = line.split('\t')
+    return Record(
+        src=fields[0],
+        trg=fields[1] if len(fields) > 1 else '',
+        alignments=parse_alignments(fields[2]) if len(fields) > 2 else None)
+
+
+def get_worker_info() -> Tuple[int,int]:
+    """Index of this worker and the number of workers if this is running in a
+    PyTorch DataLoader worker, or (0, 1) otherwise."""
+    try:
+        from torch.utils.data import get_worker_info as get_torch_worker_info
+    except ImportError:
+        return 0, 1
+    info = get_torch_worker_info()
+    if info is None:
+        return 0, 1
+    return info.id, info.num_workers
+
+
+def dump_state(state:TrainerState) -> dict:
+    return asdict(state)
+
+
+def load_state(data:dict) -> TrainerState:
+    # random.setstate() needs tuples, which don't survive e.g. JSON
+    random_state = tuple(tuple(value) if isinstance(value, list) else value for value in data['random_state'])
+    return TrainerState(
+        stage=data['stage'],
+        random_state=random_state,
+        epoch_tracker_state=EpochTrackerState(**data['epoch_tracker_state']),
+        datasets={
+            name: DatasetState(**state)
+            for name, state in data['datasets'].items()
+        },
+        batch=data.get('batch', 0))
+
+
+class CurriculumDataset:
+    """Iterates over the batches of a curriculum. Each batch is a list of lines
+    without their newline, or if `records` is set, a list of Records.
+
+    If `return_state` is set, each batch comes with a state dict as
+    `(batch, state)`. That is useful if the dataset is iterated in DataLoader
+    workers, as those don't update the state of the dataset in the main
+    process. Merge the `states` of the last state dict received from each
+    worker to get a state dict that `load_state_dict()` accepts.
+    """
+    curriculum: Curriculum
+
+    def __init__(self, config:Union[str,dict], *, basepath:Optional[str]=None,
+                 batch_size:int=100, chunk_size:int=16, processes:int=0, prefetch:int=0,
+                 records:bool=False, return_state:bool=False, rank:int=0, world_size:int=1,
+                 shuffle:bool=True, tmpdir:Optional[str]=None, catalog:Optional[str]=None, rng:str='legacy'):
+        """
+        Parameters
+        ----------
+        config : str or dict
+            Path to the curriculum's yaml file, or its parsed contents
+        basepath : str, optional
+            Directory dataset paths are relative to. Defaults to the directory of `config`.
+        batch_size, chunk_size, processes, prefetch : int
+            Passed to `Trainer.run()`. With the default of 0 processes the modifiers
+            run in the process iterating, which is what you want in DataLoader workers.
+        records : bool
+            Yield lists of Records instead of lists of lines.
+        return_state : bool
+            Yield each batch together with the state dict after that batch.
+        rank, world_size : int
+            Part of the batches to yield when training data-parallel, like the
+            `--rank` and `--world-size` options of opustrainer-train.
+        shuffle : bool
+            Whether to shuffle the datasets and batches. Enabled by default.
+        tmpdir : str, optional
+            Directory for the temporary shuffled datasets.
+        catalog : str, optional
+            Path to the dataset statistics cache.
+        rng : str
+            Random number generator for the modifiers, see `opustrainer.rng`.
+            With `philox`, the batches don't depend on `chunk_size` and
+            `processes`, nor on the number of DataLoader workers.
+        """
+        if isinstance(config, str):
+            if basepath is None:
+                basepath = os.path.dirname(config)
+            with open(config, 'r', encoding='utf-8') as fh:
+                config = yaml.safe_load(fh)
+
+        self.curriculum = CurriculumLoader().load(config, basepath=basepath or './')
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.processes = processes
+        self.prefetch = prefetch
+        self.records = records
+        self.return_state = return_state
+        self.rank = rank
+        self.world_size = world_size
+        self.shuffle = shuffle
+        self.tmpdir = tmpdir
+        self.catalog = catalog
+        self.rng = rng
+
+        # Number of parts the batches were split into the last time this
+        # dataset was iterated or restored, and the state of each of them.
+        self._shards: Optional[int] = None
+        self._states: Dict[int,TrainerState] = {}
+
+    def __iter__(self) -> Iterator[Union[List[str],List[Record],Tuple[Union[List[str],List[Record]],dict]]]:
+        worker, num_workers = get_worker_info()
+        shards = self.world_size * num_workers
+        shard = self.rank * num_workers + worker
+
+        if self._states and self._shards != shards:
+            raise ValueError(f'state was saved with the batches split in {self._shards} parts, but now they are split in {shards}')
+        self._shards = shards
+
+        trainer = Trainer(self.curriculum,
+            rank=shard,
+            world_size=shards,
+            tmpdir=self.tmpdir,
+            shuffle=self.shuffle,
+            catalog=DatasetCatalog(self.catalog) if self.catalog else None,
+            rng=self.rng)
+
+        try:
+            if shard in self._states:
+                trainer.restore(self._states[shard])
+
+            for batch in trainer.run(batch_size=self.batch_size, chunk_size=self.chunk_size, processes=self.processes, prefetch=self.prefetch):
+                state = trainer.state()
+                self._states[shard] = state
+
+                lines = [line[:-1] for line in batch]
+                output = [parse_record(line) for line in lines] if self.records else lines
+
+                if self.return_state:
+                    yield output, {'shards': shards, 'states': {shard: dump_state(state)}}
+                else:
+                    yield output
+        finally:
+            trainer.close()
+
+    def state_dict(self) -> dict:
+        """State after the last batch yielded in this process."""
+        return {
+            'shards': self._shards,
+            'states': {shard: dump_state(state) for shard, state in self._states.items()}
+        }
+
+    def load_state_dict(self, state_dict:dict) -> None:
+        """Continue after the batches of `state_dict` the next time the dataset
+        is iterated. The batches need to be split into the same number of
+        parts as when the state was saved."""
+        self._shards = state_dict['shards']
+        self._states = {int(shard): load_state(state) for shard, state in state_dict['states'].items()}
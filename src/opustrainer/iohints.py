@@ -0,0 +1,112 @@
+"""Hints to the kernel about how we access files, so that temporary files that
+are read only once don't push the trainer's own data or the datasets of other
+processes out of the page cache. All of these degrade to no-ops on platforms
+that do not support them.
+"""
+import os
+import mmap
+from typing import Optional
+
+
+# Size of the regions we tell the kernel to read ahead, or to drop once we're
+# done with them.
+READAHEAD = 2**24
+
+
+def fadvise(fileno:int, offset:int, length:int, advice:str) -> None:
+    """Calls `posix_fadvise` with `POSIX_FADV_{advice}` if the platform supports
+    it. A length of 0 means until the end of the file."""
+    flag: Optional[int] = getattr(os, f'POSIX_FADV_{advice}', None)
+    if flag is None or not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        os.posix_fadvise(fileno, offset, length, flag)
+    except OSError:
+        # E.g. ESPIPE when the file is a pipe. Hints are hints, never fatal.
+        pass
+
+
+def enable_direct_io(fileno:int) -> bool:
+    """Tries to set O_DIRECT on an open file descriptor. Returns whether it
+    succeeded."""
+    flag = getattr(os, 'O_DIRECT', 0)
+    if not flag:
+        return False
+    try:
+        import fcntl
+        fcntl.fcntl(fileno, fcntl.F_SETFL, fcntl.fcntl(fileno, fcntl.F_GETFL) | flag)
+        return True
+    except (ImportError, OSError):
+        return False
+
+
+def disable_direct_io(fileno:int) -> None:
+    import fcntl
+    fcntl.fcntl(fileno, fcntl.F_SETFL, fcntl.fcntl(fileno, fcntl.F_GETFL) & ~getattr(os, 'O_DIRECT', 0))
+
+
+class DirectWriter:
+    """Writes to a file descriptor with O_DIRECT, bypassing the page cache.
+    O_DIRECT requires aligned buffers, offsets and lengths, so data is collected
+    in a page-aligned buffer and written in whole blocks. The last block is
+    padded, and the file is truncated to its real length on close. If the file
+    system does not support O_DIRECT, this falls back to normal writes.
+    Takes ownership of `fileno`."""
+    BLOCK = 2**20
+    ALIGN = 4096
+
+    def __init__(self, fileno:int):
+        self.fileno = fileno
+        self.direct = enable_direct_io(fileno)
+        self.buffer = mmap.mmap(-1, self.BLOCK) # anonymous mmaps are page-aligned
+        self.used = 0
+        self.size = 0
+
+    def write(self, data:bytes) -> None:
+        offset = 0
+        while offset < len(data):
+            length = min(len(data) - offset, self.BLOCK - self.used)
+            self.buffer[self.used:self.used + length] = data[offset:offset + length]
+            self.used += length
+            offset += length
+            if self.used == self.BLOCK:
+                self._flush(self.BLOCK)
+
+    def _flush(self, length:int) -> None:
+        with memoryview(self.buffer) as view:
+            block = view[:length]
+            while len(block) > 0:
+                try:
+                    written = os.write(self.fileno, block)
+                except OSError:
+                    # Some file systems accept O_DIRECT but then refuse the writes.
+                    if not self.direct:
+                        raise
+                    disable_direct_io(self.fileno)
+                    self.direct = False
+                    continue
+                block = block[written:]
+                # A partial write leaves us unaligned, continue without O_DIRECT
+                if len(block) > 0 and self.direct:
+                    disable_direct_io(self.fileno)
+                    self.direct = False
+        self.size += min(length, self.used)
+        self.used = 0
+
+    def close(self) -> None:
+        try:
+            if self.used > 0:
+                used = self.used
+                length = -(-used // self.ALIGN) * self.ALIGN if self.direct else used
+                self.buffer[used:length] = bytes(length - used)
+                self._flush(length)
+                os.ftruncate(self.fileno, self.size)
+        finally:
+            self.buffer.close()
+            os.close(self.fileno)
+
+    def __enter__(self) -> 'DirectWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -1,7 +1,9 @@
 from io import TextIOWrapper
 import logging
 from sys import stderr, version_info
-from typing import List, Dict, TextIO, Union, Optional
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, List, Dict, TextIO, Tuple, Union, Optional
 from functools import lru_cache
 
 def _getLevelNamesMapping() -> Dict[str,int]:
@@ -33,10 +35,37 @@ def log(msg: str, loglevel: str = "INFO", **kwargs) -> None:
     logging.log(level, msg, **kwargs)
 
 
-@lru_cache(None)
-def log_once(msg: str, loglevel: str = "INFO", **kwargs) -> None:
-    """A wrapper to log, to make sure that we only print things once"""
-    log(msg, loglevel, **kwargs)
+class LogOnce:
+    """A wrapper to log, to make sure that we only print things once. Remembers
+    at most `maxsize` messages (or all of them if None). Messages that were
+    forgotten are printed again the next time they come up."""
+    maxsize: Optional[int]
+
+    def __init__(self, maxsize: Optional[int] = None):
+        self.maxsize = maxsize
+        self._seen: "OrderedDict[Tuple[str,str,Tuple[Tuple[str,Any],...]],None]" = OrderedDict()
+        self._lock = Lock()
+
+    def __call__(self, msg: str, loglevel: str = "INFO", **kwargs) -> None:
+        key = (msg, loglevel, tuple(sorted(kwargs.items())))
+        with self._lock:
+            if key in self._seen:
+                self._seen.move_to_end(key)
+                return
+            self._seen[key] = None
+            while self.maxsize is not None and len(self._seen) > self.maxsize:
+                self._seen.popitem(last=False)
+        log(msg, loglevel, **kwargs)
+
+    def cache_clear(self) -> None:
+        with self._lock:
+            self._seen.clear()
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+
+log_once = LogOnce()
 
 
 def setup_logger(outputfilename: Optional[str] = None, loglevel: str = "INFO", disable_stderr: bool=False) -> None:
@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+"""Runs a curriculum without a trainer attached, and writes the batches it
+produces to a set of gzip compressed shards instead. Meant for trainers that
+can't read their training data from stdin.
+
+Batches are spread round-robin over the shards, each of which is compressed in
+its own thread. Every so often all shards finish their gzip member, and the
+size of each shard is written to a manifest together with the state of the
+trainer. An interrupted run continues from the
+last of these checkpoints, after truncating the shards back to the sizes in
+the manifest. Each stage starts at a checkpoint, so the manifest also tells
+you where in each shard a stage begins.
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import argparse
+
+from dataclasses import dataclass, replace
+from queue import Queue
+from threading import Thread
+from typing import List, Dict, Optional, Iterable, Union, cast
+
+import yaml
+
+from opustrainer.trainer import Curriculum, CurriculumLoader, DatasetState, TrainerState, StateLoader, Trainer, DatasetReader, AsyncDatasetReader, add_modifier_arguments, check_modifier_arguments, modifier_run_arguments
+from opustrainer.catalog import DatasetCatalog
+from opustrainer.affinity import plan_layout
+from opustrainer import logger
+
+
+MANIFEST_VERSION = 1
+
+# Marker put in the queue of a shard to finish the current gzip member
+_CHECKPOINT = object()
+
+
+@dataclass(frozen=True)
+class ShardOffset:
+    # Size of the compressed shard in bytes. Always at the boundary of a gzip
+    # member, so you can start decompressing from this offset.
+    bytes: int
+
+    # Number of lines in the shard up to that point
+    lines: int
+
+
+@dataclass(frozen=True)
+class StageOffsets:
+    stage: str
+
+    # Index of the first batch of this stage, counted over all shards
+    batch: int
+
+    # Where this stage starts in each of the shards
+    shards: List[ShardOffset]
+
+    # Position of each dataset reader when this stage started
+    datasets: Dict[str,DatasetState]
+
+
+@dataclass(frozen=True)
+class Manifest:
+    # Compressed shards, relative to the directory of the manifest
+    files: List[str]
+
+    # Size of each shard at the last checkpoint
+    shards: List[ShardOffset]
+
+    # Number of batches written at the last checkpoint
+    batches: int
+
+    # Stages that have been (or are being) materialized
+    stages: List[StageOffsets]
+
+    # Position of each dataset reader at the last checkpoint
+    datasets: Dict[str,DatasetState]
+
+    # File with the trainer state at the last checkpoint, relative to the
+    # directory of the manifest
+    state: Optional[str]
+
+    # Whether all stages of the curriculum have been materialized
+    complete: bool
+
+    @property
+    def lines(self) -> int:
+        return sum(shard.lines for shard in self.shards)
+
+
+class ManifestLoader:
+    """Reads and writes the manifest as JSON, so it can be read by whatever
+    reads the shards."""
+    def load(self, fh) -> Manifest:
+        data = json.load(fh)
+        if data.get('version') != MANIFEST_VERSION:
+            raise ValueError(f"Unsupported manifest version: {data.get('version')}")
+        return Manifest(
+            files=list(data['files']),
+            shards=[self._load_offset(shard) for shard in data['shards']],
+            batches=int(data['batches']),
+            stages=[
+                StageOffsets(
+                    stage=stage['stage'],
+                    batch=int(stage['batch']),
+                    shards=[self._load_offset(shard) for shard in stage['shards']],
+                    datasets=self._load_datasets(stage['datasets']))
+                for stage in data['stages']
+            ],
+            datasets=self._load_datasets(data['datasets']),
+            state=data['state'],
+            complete=bool(data['complete']))
+
+    def dump(self, manifest:Manifest, fh) -> None:
+        json.dump({
+            'version': MANIFEST_VERSION,
+            'files': manifest.files,
+            'shards': [self._dump_offset(shard) for shard in manifest.shards],
+            'batches': manifest.batches,
+            'lines': manifest.lines,
+            'stages': [
+                {
+                    'stage': stage.stage,
+                    'batch': stage.batch,
+                    'shards': [self._dump_offset(shard) for shard in stage.shards],
+                    'datasets': self._dump_datasets(stage.datasets),
+                }
+                for stage in manifest.stages
+            ],
+            'datasets': self._dump_datasets(manifest.datasets),
+            'state': manifest.state,
+            'complete': manifest.complete,
+        }, fh, indent=2)
+
+    def _load_offset(self, data:dict) -> ShardOffset:
+        return ShardOffset(bytes=int(data['bytes']), lines=int(data['lines']))
+
+    def _dump_offset(self, offset:ShardOffset) -> dict:
+        return {'bytes': offset.bytes, 'lines': offset.lines}
+
+    def _load_datasets(self, data:dict) -> Dict[str,DatasetState]:
+        return {
+            name: DatasetState(seed=int(state['seed']), line=int(state['line']), epoch=int(state['epoch']))
+            for name, state in data.items()
+        }
+
+    def _dump_datasets(self, datasets:Dict[str,DatasetState]) -> dict:
+        return {
+            name: {'seed': state.seed, 'line': state.line, 'epoch': state.epoch}
+            for name, state in datasets.items()
+        }
+
+
+class Shard:
+    """Output file that is compressed in its own thread, so all shards are
+    compressed in parallel (zlib releases the GIL while it is compressing). Each
+    time the shard is checkpointed, the current gzip member is finished and a
+    new one is started. Concatenated gzip members are a valid gzip file."""
+    path: str
+    level: int
+    lines: int
+
+    def __init__(self, path:str, *, offset:ShardOffset=ShardOffset(0, 0), level:int=6, queue_size:int=16):
+        self.path = path
+        self.level = level
+
+        # Throw away anything written after the checkpoint we're resuming from
+        if os.path.exists(path):
+            if os.path.getsize(path) < offset.bytes:
+                raise ValueError(f"Shard {path} is smaller than recorded in the manifest")
+            os.truncate(path, offset.bytes)
+        elif offset.bytes > 0:
+            raise ValueError(f"Shard {path} is missing")
+
+        self.lines = offset.lines
+        self._fh = open(path, 'ab')
+        self._error: Optional[BaseException] = None
+        self._queue: "Queue[Union[bytes,object,None]]" = Queue(maxsize=queue_size)
+        self._thread = Thread(target=self._run, name=f'shard {os.path.basename(path)}', daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        compressor = None
+        while True:
+            block = self._queue.get()
+            try:
+                if block is None:
+                    break
+                elif block is _CHECKPOINT:
+                    if compressor is not None:
+                        self._fh.write(compressor.flush())
+                        compressor = None
+                    self._fh.flush()
+                    os.fsync(self._fh.fileno())
+                elif self._error is None:
+                    if compressor is None:
+                        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                    self._fh.write(compressor.compress(cast(bytes, block)))
+            except BaseException as exc:
+                self._error = exc
+            finally:
+                self._queue.task_done()
+
+    def _check(self) -> None:
+        if self._error is not None:
+            raise self._error
+
+    def write(self, block:bytes) -> None:
+        self._check()
+        self._queue.put(block)
+        self.lines += block.count(b'\n')
+
+    def checkpoint(self) -> ShardOffset:
+        """Finishes the current gzip member, and returns the size of the shard."""
+        self._queue.put(_CHECKPOINT)
+        self._queue.join()
+        self._check()
+        return ShardOffset(bytes=os.fstat(self._fh.fileno()).st_size, lines=self.lines)
+
+    def close(self) -> None:
+        """Stops the compressor thread. Anything written since the last
+        checkpoint may or may not end up in the file."""
+        self._queue.put(None)
+        self._thread.join()
+        self._fh.close()
+
+
+class Materializer:
+    """Writes the output of a trainer to shards in `directory`."""
+    directory: str
+    num_shards: int
+
+    # zlib compression level, 1 (fastest) to 9 (smallest)
+    level: int
+
+    # Minimum number of seconds between checkpoints
+    interval: float
+
+    def __init__(self, directory:str, *, shards:int=1, level:int=6, interval:float=60):
+        assert shards > 0, 'need at least one shard'
+        self.directory = directory
+        self.num_shards = shards
+        self.level = level
+        self.interval = interval
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.directory, 'manifest.json')
+
+    def load_manifest(self) -> Optional[Manifest]:
+        if not os.path.exists(self.manifest_path):
+            return None
+        with open(self.manifest_path, 'r', encoding='utf-8') as fh:
+            return ManifestLoader().load(fh)
+
+    def _restore(self, trainer:Trainer, manifest:Manifest) -> None:
+        if len(manifest.files) != self.num_shards:
+            raise ValueError(f"Cannot resume with {self.num_shards} shards, the manifest has {len(manifest.files)}")
+        if manifest.state is not None:
+            with open(os.path.join(self.directory, manifest.state), 'r', encoding='utf-8') as fh:
+                trainer.restore(StateLoader().load(fh))
+
+    def _checkpoint(self, manifest:Manifest, shards:List[Shard], state:TrainerState, batches:int, *, complete:bool=False) -> Manifest:
+        offsets = [shard.checkpoint() for shard in shards]
+
+        # Trainer state goes in its own file, which is only referred to once
+        # the manifest is replaced. The manifest is what commits a checkpoint.
+        state_file = f'state.{batches:012d}.yml'
+        with open(os.path.join(self.directory, state_file), 'w', encoding='utf-8') as fh:
+            StateLoader().dump(state, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+
+        updated = replace(manifest,
+            shards=offsets,
+            batches=batches,
+            datasets=state.datasets,
+            state=state_file,
+            complete=complete)
+
+        new_path = f'{self.manifest_path}.new'
+        with open(new_path, 'w', encoding='utf-8') as fh:
+            ManifestLoader().dump(updated, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(new_path, self.manifest_path)
+
+        if manifest.state is not None and manifest.state != state_file:
+            os.unlink(os.path.join(self.directory, manifest.state))
+
+        logger.log(f"Checkpoint after {updated.batches} batches, {updated.lines} lines", loglevel="DEBUG")
+        return updated
+
+    def run(self, trainer:Trainer, *, restore:bool=True, max_lines:Optional[int]=None, **kwargs) -> Manifest:
+        """Runs `trainer` until it has gone through all stages, or until at least
+        `max_lines` lines have been written. Other keyword arguments are passed
+        to `trainer.run()`. Returns the manifest of the last checkpoint."""
+        os.makedirs(self.directory, exist_ok=True)
+
+        manifest = self.load_manifest() if restore else None
+        if manifest is not None:
+            self._restore(trainer, manifest)
+        else:
+            manifest = Manifest(
+                files=[f'shard.{n:05d}.tsv.gz' for n in range(self.num_shards)],
+                shards=[ShardOffset(0, 0) for _ in range(self.num_shards)],
+                batches=0,
+                stages=[],
+                datasets=trainer.state().datasets,
+                state=None,
+                complete=False)
+
+        if manifest.complete:
+            logger.log("Curriculum is already fully materialized")
+            return manifest
+
+        if max_lines is not None and manifest.lines >= max_lines:
+            return manifest
+
+        shards = [
+            Shard(os.path.join(self.directory, file), offset=offset, level=self.level)
+            for file, offset in zip(manifest.files, manifest.shards)
+        ]
+
+        try:
+            # State after the last batch that was written
+            state = trainer.state()
+            batches = manifest.batches
+            lines = manifest.lines
+            last_checkpoint = time.monotonic()
+
+            for batch in cast(Iterable[bytes], trainer.run(binary=True, **kwargs)):
+                # Start each stage at a checkpoint, so we know where in each
+                # shard it starts.
+                if not manifest.stages or trainer.state().stage != manifest.stages[-1].stage:
+                    manifest = self._checkpoint(manifest, shards, state, batches)
+                    manifest = replace(manifest, stages=manifest.stages + [StageOffsets(
+                        stage=trainer.state().stage,
+                        batch=batches,
+                        shards=manifest.shards,
+                        datasets=manifest.datasets)])
+                    last_checkpoint = time.monotonic()
+
+                shards[batches % len(shards)].write(batch)
+                state = trainer.state()
+                batches += 1
+                lines += batch.count(b'\n')
+
+                if max_lines is not None and lines >= max_lines:
+                    return self._checkpoint(manifest, shards, state, batches)
+
+                if time.monotonic() - last_checkpoint > self.interval:
+                    manifest = self._checkpoint(manifest, shards, state, batches)
+                    last_checkpoint = time.monotonic()
+
+            return self._checkpoint(manifest, shards, state, batches, complete=True)
+        finally:
+            for shard in shards:
+                shard.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Writes the output of a curriculum to sharded, compressed files.")
+    parser.add_argument("--config", '-c', required=True, type=str, help='YML configuration input.')
+    parser.add_argument("--output", '-o', required=True, type=str, help='Output directory for the shards and manifest.')
+    parser.add_argument("--shards", '-N', type=int, default=os.cpu_count() or 1, help='Number of shards to write in parallel')
+    parser.add_argument("--compression-level", type=int, default=6, help='gzip compression level, 1 (fastest) to 9 (smallest)')
+    parser.add_argument("--max-lines", type=int, default=None, help='Stop after writing this many lines. Required if the last stage never ends.')
+    parser.add_argument("--checkpoint-interval", type=float, default=60, help='Minimum number of seconds between checkpoints')
+    parser.add_argument("--catalog", type=str, help='Dataset statistics cache, defaults to ${CONFIG}.catalog.')
+    parser.add_argument("--sync", action="store_true", help="Do not shuffle async")
+    parser.add_argument("--temporary-directory", '-T', default=None, type=str, help='Temporary dir, used for shuffling')
+    parser.add_argument("--do-not-resume", '-d', action="store_true", help='Start over, even if the output directory contains a manifest')
+    parser.add_argument("--no-shuffle", '-n', action="store_false", help='Do not shuffle, for debugging', dest="shuffle")
+    parser.add_argument("--direct-io", action="store_true", help='Write temporary shuffle chunks with O_DIRECT to keep them out of the page cache')
+    add_modifier_arguments(parser)
+    parser.add_argument("--log-level", type=str, default="INFO", help="Set log level. Available levels: DEBUG, INFO, WARNING, ERROR, CRITICAL. Default is INFO")
+    parser.add_argument("--log-file", '-l', type=str, default=None, help="Target location for logging. Always logs to stderr and optionally to a file.")
+
+    args = parser.parse_args()
+    logger.setup_logger(args.log_file, args.log_level)
+
+    try:
+        layout = plan_layout(workers=args.worker_cpus, shuffle=args.shuffle_cpus)
+    except ValueError as e:
+        parser.error(str(e))
+    layout.log(loglevel="INFO" if args.worker_cpus is not None or args.shuffle_cpus is not None else "DEBUG")
+    if args.workers is None:
+        args.workers = layout.budget
+
+    stage_workers = check_modifier_arguments(parser, args)
+
+    with open(args.config, 'r', encoding='utf-8') as fh:
+        config = yaml.safe_load(fh)
+
+    curriculum: Curriculum = CurriculumLoader().load(config, basepath=os.path.dirname(args.config))
+
+    for dataset in curriculum.datasets.values():
+        missing_files = {file for file in dataset.files if not os.path.exists(file)}
+        if missing_files:
+            raise ValueError(f"Dataset '{dataset.name}' is missing files: {missing_files}")
+
+    last_stage = curriculum.stages[curriculum.stages_order[-1]]
+    if last_stage.until_epoch is None and args.max_lines is None:
+        parser.error(f"stage '{last_stage.name}' never ends, use --max-lines to limit the output")
+
+    trainer = Trainer(curriculum,
+        reader=DatasetReader if args.sync else AsyncDatasetReader,
+        tmpdir=args.temporary_directory,
+        shuffle=args.shuffle,
+        catalog=DatasetCatalog(args.catalog or f'{args.config}.catalog'),
+        direct_io=args.direct_io,
+        rng=args.rng,
+        read_by_offset=args.read_by_offset,
+        shuffle_cpus=layout.shuffle,
+        sparse=args.sparse_modifiers,
+        fuse=args.fuse_modifiers)
+
+    materializer = Materializer(args.output,
+        shards=args.shards,
+        level=args.compression_level,
+        interval=args.checkpoint_interval)
+
+    try:
+        manifest = materializer.run(trainer,
+            restore=not args.do_not_resume,
+            max_lines=args.max_lines,
+            **modifier_run_arguments(args, layout.workers, stage_workers))
+    except KeyboardInterrupt:
+        logger.log("Ctrl-c pressed, run again to continue from the last checkpoint")
+        sys.exit(130)
+    finally:
+        trainer.close()
+
+    logger.log(f"Wrote {manifest.lines} lines in {manifest.batches} batches to {len(manifest.files)} shards")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Splits a single memory limit over the parts of opustrainer that hold data in
+memory: the shufflers, the batches that are read and modified ahead, the chunks
+waiting for the modifier pool, and the messages remembered by `log_once`. Each
+of these sizes its buffers to fit its share, based on the average line length
+of the datasets if it is known from the catalog.
+"""
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Union
+
+from opustrainer import logger
+
+
+# Fraction of the memory limit each component gets
+DEFAULT_SHARES = {
+    'shuffle': 0.7,
+    'prefetch': 0.15,
+    'pool': 0.1,
+    'log': 0.05,
+}
+
+# Line length to assume if a dataset's statistics are not known yet
+ASSUMED_LINE_LENGTH = 256
+
+# Memory a line takes in Python on top of its length: the str or bytes object,
+# its slot in a list, and in the shuffler the random key and tuple with it.
+LINE_OVERHEAD = 128
+
+# Memory taken by a message remembered by `log_once`
+LOG_MESSAGE_SIZE = 512
+
+UNITS = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+
+
+def parse_size(text:str) -> int:
+    """Parses sizes like `512M`, `64G` or `1.5T` into a number of bytes."""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*', text, re.IGNORECASE)
+    if match is None:
+        raise ValueError(f'cannot parse size: {text}')
+    return int(float(match.group(1)) * UNITS[match.group(2).upper()])
+
+
+def format_size(size:float) -> str:
+    for unit in ['', 'K', 'M', 'G']:
+        if abs(size) < 1024:
+            return f'{size:.1f} {unit}iB' if unit else f'{size:.0f} B'
+        size /= 1024
+    return f'{size:.1f} TiB'
+
+
+def resident_memory(pid:Union[int,str]='self') -> Optional[int]:
+    """Memory currently used by a process, if the platform tells us."""
+    try:
+        with open(f'/proc/{pid}/statm', 'r') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+@dataclass(frozen=True)
+class MemoryBudget:
+    """Memory limit in bytes, and the fraction of it each component may use."""
+    limit: int
+    shares: Dict[str,float] = field(default_factory=lambda: dict(DEFAULT_SHARES))
+
+    def __post_init__(self):
+        if sum(self.shares.values()) > 1.0 + 1e-9:
+            raise ValueError('memory shares add up to more than the limit')
+
+    def share(self, component:str) -> int:
+        """Number of bytes `component` may use."""
+        return int(self.limit * self.shares[component])
+
+    def lines(self, component:str, line_length:Optional[float]=None, *, copies:int=1) -> int:
+        """Number of lines of `line_length` bytes that fit in the share of
+        `component` when it holds `copies` buffers of them at the same time."""
+        if line_length is None:
+            line_length = ASSUMED_LINE_LENGTH
+        return int(self.share(component) // (max(copies, 1) * (line_length + LINE_OVERHEAD)))
+
+    def log_allocation(self, loglevel:str="INFO") -> None:
+        logger.log(f"Memory limit {format_size(self.limit)}: " + ', '.join(
+            f"{component} {format_size(self.share(component))}"
+            for component in self.shares
+        ), loglevel=loglevel)
+
+
+def log_usage(usage:Dict[str,int], loglevel:str="INFO") -> None:
+    """Logs the (estimated) memory use of each component, and of the process."""
+    rss = resident_memory()
+    logger.log("Memory in use: " + ', '.join(
+        [f"{component} {format_size(size)}" for component, size in usage.items()]
+        + ([f"process total {format_size(rss)}"] if rss is not None else [])
+    ), loglevel=loglevel)
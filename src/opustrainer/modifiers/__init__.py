@@ -1 +1 @@
-from opustrainer.types import Modifier
\ No newline at end of file
+from opustrainer.types import Modifier, LineModifier, PairModifier, make_sparse
@@ -0,0 +1,361 @@
+"""Runs the modifiers in threads or subinterpreters of this process, instead of
+in worker processes.
+
+ModifierPool runs the modifiers in worker processes. Each process has its own
+copy of the modifiers, including any SentencePiece models, and lines are
+pickled on their way to the workers and back. On a free-threaded build of
+Python (3.13t and later), threads run in parallel. A ThreadModifierPool shares
+the modifiers between its threads and copies nothing. An
+InterpreterModifierPool runs them in subinterpreters that each have their own
+GIL (Python 3.14 and later). Each subinterpreter still needs its own copy of
+the modifiers, but there are no processes to start or lose.
+
+Each worker thread of a ThreadModifierPool has a random state of its own, which
+the modifiers draw from through `local_random()`. Each chunk is then seeded and
+modified the same way it would be in a worker process. Other threads keep using
+the random module, including the one that draws the seeds of the chunks. The
+threads only take modifiers that draw all their random numbers that way. Typos
+does not, as the library it uses draws from the random module, and neither may
+modifiers from elsewhere, so those need another backend.
+"""
+import concurrent.futures
+import os
+import pickle
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from itertools import chain
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from opustrainer.affinity import set_affinity, worker_cpus
+from opustrainer.modifiers import Modifier
+from opustrainer.modifiers.pool import Job, ChunkSeed, ChunkSeeder, ChunkSize, ChunkTimeoutError, DEFAULT_INFLIGHT_PER_WORKER, POLL_INTERVAL, \
+    apply_modifiers, batch_chunk_size, chunk_seed, count_chunks, describe_work
+from opustrainer.modifiers.transport import TransportStats
+from opustrainer.rng import CounterKey, attach_random
+
+
+# Where the modifiers run. auto picks threads if they run in parallel, and
+# processes otherwise.
+BACKENDS = ('auto', 'processes', 'threads', 'interpreters')
+
+def free_threaded() -> bool:
+    """Whether threads of this interpreter run Python code in parallel."""
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', None)
+    return is_gil_enabled is not None and not is_gil_enabled()
+
+
+def thread_unsafe(modifiers:Iterable[Modifier]) -> List[str]:
+    """Names of the classes of the modifiers that can't run in the threads of a
+    ThreadModifierPool, see `Modifier.thread_random`."""
+    return sorted({type(modifier).__name__ for modifier in modifiers if not modifier.thread_random})
+
+
+def resolve_backend(backend:str, modifiers:Iterable[Modifier]=()) -> str:
+    """The backend to use for `backend`, which may be auto, to run `modifiers`."""
+    if backend not in BACKENDS:
+        raise ValueError(f'unknown backend {backend}, choose from {", ".join(BACKENDS)}')
+    unsafe = thread_unsafe(modifiers)
+    if backend == 'auto':
+        return 'threads' if free_threaded() and not unsafe else 'processes'
+    if backend == 'threads' and unsafe:
+        raise ValueError(f'the threads backend cannot run {", ".join(unsafe)}, which draw from the random module')
+    if backend == 'interpreters' and not hasattr(concurrent.futures, 'InterpreterPoolExecutor'):
+        raise ValueError('the interpreters backend needs Python 3.14 or later')
+    return backend
+
+
+# A chunk or job in an executor, what it was, and whether it is the last one
+# of its batch. Batches without chunks have no future.
+Task = Tuple[Optional[Future], Any, bool]
+
+
+class ExecutorModifierPool:
+    """Same as ModifierPool, but runs the chunks as tasks of an executor from
+    concurrent.futures. Results are collected in the order the chunks were
+    submitted."""
+
+    """Number of threads or interpreters in the pool"""
+    workers: int
+
+    """Modifier list applied to the chunks submitted from now on"""
+    modifiers: List[Modifier]
+
+    """Maximum number of chunks `imap()` keeps in the workers, 0 for the default"""
+    max_inflight: int
+
+    """Seconds a chunk may take once it is running, 0 for no limit"""
+    chunk_timeout: float
+
+    """Number of chunks sent to the workers, and how long we waited for them"""
+    stats: TransportStats
+
+    # What the workers are, for messages
+    kind = 'worker'
+
+    def __init__(self, modifiers:List[Modifier], processes:int=0, max_inflight:int=0, chunk_timeout:float=0):
+        self.modifiers = modifiers
+        self.workers = processes if processes > 0 else min(os.cpu_count() or 1, 8)
+        self.max_inflight = max_inflight
+        self.chunk_timeout = chunk_timeout
+        self.stats = TransportStats()
+        self._executor: Optional[concurrent.futures.Executor] = None
+        # Set once a task got stuck, which can't be stopped
+        self._broken = False
+
+    def _start(self) -> concurrent.futures.Executor:
+        raise NotImplementedError()
+
+    def _run_chunk(self, lines:List[str], seed:ChunkSeed) -> Future:
+        raise NotImplementedError()
+
+    def _run_job(self, job:Job) -> Future:
+        raise NotImplementedError()
+
+    def __enter__(self) -> 'ExecutorModifierPool':
+        self._executor = self._start()
+        return self
+
+    def set_modifiers(self, modifiers:List[Modifier]) -> None:
+        """Replace the modifiers for the chunks submitted after this. Chunks
+        already submitted keep the modifiers they were submitted with."""
+        self.modifiers = modifiers
+
+    def __exit__(self, *args):
+        assert self._executor is not None
+        # A stuck task can't be interrupted, so don't wait for it
+        self._executor.shutdown(wait=not self._broken)
+
+    def log_stats(self, loglevel:str="INFO") -> None:
+        self.stats.log(loglevel)
+
+    def busy_time(self) -> Optional[float]:
+        """Seconds the workers spent on chunks so far, if known"""
+        return None
+
+    def _limit(self) -> int:
+        return self.max_inflight if self.max_inflight > 0 else DEFAULT_INFLIGHT_PER_WORKER * self.workers
+
+    def _submit(self, future:Future, lines:int) -> Future:
+        self.stats.chunks += 1
+        self.stats.lines += lines
+        self.stats.inflight += 1
+        self.stats.peak_inflight = max(self.stats.peak_inflight, self.stats.inflight)
+        return future
+
+    def _result(self, future:Future, work:Any) -> Any:
+        """Waits for the result of a task, and raises ChunkTimeoutError once it
+        has been running for longer than `chunk_timeout`."""
+        started = time.monotonic()
+        running_since: Optional[float] = None
+        try:
+            while True:
+                try:
+                    return future.result(timeout=POLL_INTERVAL if self.chunk_timeout > 0 else None)
+                except concurrent.futures.TimeoutError:
+                    now = time.monotonic()
+                    if running_since is None:
+                        running_since = now if future.running() else None
+                    elif now - running_since > self.chunk_timeout:
+                        self._broken = True
+                        raise ChunkTimeoutError(f'Modifier {self.kind} spent more than {self.chunk_timeout:g}s on {describe_work(work)}')
+        finally:
+            self.stats.stall_time += time.monotonic() - started
+            self.stats.inflight -= 1
+
+    def _collect(self, tasks:Deque[Task], results:List[Any], block:bool) -> Iterator[List[Any]]:
+        """Takes the oldest tasks that are done off `tasks`, waiting for the
+        first one if `block`, and yields the results of each batch of which all
+        chunks are done. `results` holds those of the batch so far."""
+        while tasks and (block or tasks[0][0] is None or tasks[0][0].done()):
+            future, work, last = tasks.popleft()
+            if future is not None:
+                results.append(self._result(future, work))
+            if last:
+                yield list(results)
+                results.clear()
+            block = False
+
+    def _drain(self, tasks:Deque[Task]) -> None:
+        """Cancels the tasks that have not started yet, and waits for those that
+        have, so they don't end up in the results of the next call."""
+        futures = [future for future, _, _ in tasks if future is not None]
+        for future in futures:
+            future.cancel()
+        if not self._broken:
+            concurrent.futures.wait(futures)
+        tasks.clear()
+        self.stats.inflight -= len(futures)
+
+    def _run(self, batches:Iterable[Tuple[List[Any], Callable[[Any], Future]]]) -> Iterator[List[Any]]:
+        """Submits the parts of each batch with `submit`, keeping up to
+        `max_inflight` of them in the workers across batches, and yields the
+        results of the parts of each batch in order."""
+        tasks: Deque[Task] = deque()
+        results: List[Any] = []
+        try:
+            for parts, submit in batches:
+                if not parts:
+                    tasks.append((None, None, True))
+                for index, part in enumerate(parts):
+                    while self.stats.inflight >= self._limit():
+                        yield from self._collect(tasks, results, block=True)
+                    tasks.append((submit(part), part, index == len(parts) - 1))
+                    yield from self._collect(tasks, results, block=False)
+            while tasks:
+                yield from self._collect(tasks, results, block=True)
+        finally:
+            self._drain(tasks)
+
+    def map(self, batch:List[str], chunksize:int=0, key:Optional[CounterKey]=None) -> List[str]:
+        modified = self.imap([(batch, lambda chunk, size: chunk_seed(chunk, size, key))], chunksize)
+        try:
+            return next(modified)
+        finally:
+            modified.close()
+
+    def imap(self, batches:Iterable[Tuple[List[str], ChunkSeeder]], chunksize:ChunkSize) -> Iterator[List[str]]:
+        """Same as `ModifierPool.imap()`."""
+        batch_chunk_size(chunksize)
+
+        def chunked() -> Iterator[Tuple[List[Any], Callable[[Any], Future]]]:
+            for lines, seeder in batches:
+                size = batch_chunk_size(chunksize)
+                chunks = [(index, lines[index * size:(index + 1) * size]) for index in range(count_chunks(len(lines), size))]
+                # The seed of a chunk is drawn when it is submitted
+                yield chunks, lambda chunk, seeder=seeder, size=size: self._run_chunk(chunk[1], seeder(chunk[0], size))
+
+        for results in self._run(chunked()):
+            yield list(chain(*results))
+
+    def imap_jobs(self, jobs:Iterable[Job]) -> Iterator[bytes]:
+        """Same as `ModifierPool.imap_jobs()`."""
+        for results in self._run(([job], self._run_job) for job in jobs):
+            yield results[0]
+
+
+class ThreadModifierPool(ExecutorModifierPool):
+    """Runs the modifiers in threads that share them. Only faster than a single
+    thread on a free-threaded build of Python."""
+
+    """CPUs the threads are spread over, if restricted"""
+    cpus: Optional[List[int]]
+
+    kind = 'thread'
+
+    def __init__(self, modifiers:List[Modifier], processes:int=0, max_inflight:int=0, chunk_timeout:float=0,
+                 cpus:Optional[List[int]]=None):
+        resolve_backend('threads', modifiers)
+        super().__init__(modifiers, processes, max_inflight, chunk_timeout)
+        self.cpus = cpus
+        self._started = 0
+        self._lock = threading.Lock()
+
+    def set_modifiers(self, modifiers:List[Modifier]) -> None:
+        resolve_backend('threads', modifiers)
+        super().set_modifiers(modifiers)
+
+    def _start(self) -> concurrent.futures.Executor:
+        return concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix='modifier', initializer=self._start_thread)
+
+    def _start_thread(self) -> None:
+        attach_random()
+        if self.cpus:
+            with self._lock:
+                index = self._started
+                self._started += 1
+            # On Linux, this only applies to the calling thread
+            set_affinity(worker_cpus(index % self.workers, self.workers, self.cpus))
+
+    def _run_chunk(self, lines:List[str], seed:ChunkSeed) -> Future:
+        assert self._executor is not None
+        return self._submit(self._executor.submit(apply_modifiers, self.modifiers, lines, seed), len(lines))
+
+    def _run_job(self, job:Job) -> Future:
+        assert self._executor is not None
+        return self._submit(self._executor.submit(job.run, self.modifiers), 0)
+
+
+# Modifiers of this interpreter and their version, in the interpreters of an
+# InterpreterModifierPool.
+_interpreter_modifiers: Tuple[int, List[Modifier]] = (-1, [])
+
+
+def interpreter_modifiers(version:int, path:str) -> List[Modifier]:
+    """Modifiers of `version`, unpickled from the file at `path` once per
+    interpreter."""
+    global _interpreter_modifiers
+    if _interpreter_modifiers[0] != version:
+        with open(path, 'rb') as fh:
+            _interpreter_modifiers = version, pickle.load(fh)
+    return _interpreter_modifiers[1]
+
+
+def run_chunk_in_interpreter(version:int, path:str, lines:List[str], seed:ChunkSeed) -> List[str]:
+    return apply_modifiers(interpreter_modifiers(version, path), lines, seed)
+
+
+def run_job_in_interpreter(version:int, path:str, job:Job) -> bytes:
+    return job.run(interpreter_modifiers(version, path))
+
+
+class InterpreterModifierPool(ExecutorModifierPool):
+    """Runs the modifiers in subinterpreters, each with its own GIL and its own
+    copy of the modifiers. The modifiers are pickled to a file once per
+    version, and each chunk only carries the version and the path of that
+    file, which an interpreter reads when it sees a new version. With Tags and
+    `spm_vocab`, the pickled modifiers include the SentencePiece models, which
+    would otherwise be copied with every chunk."""
+
+    kind = 'interpreter'
+
+    def __init__(self, modifiers:List[Modifier], processes:int=0, max_inflight:int=0, chunk_timeout:float=0):
+        super().__init__(modifiers, processes, max_inflight, chunk_timeout)
+        self.version = -1
+        # Files with the pickled modifiers of each version, written when the
+        # first chunk of that version is submitted, and removed on exit as
+        # chunks of older versions may still be waiting for an interpreter.
+        self._files: Dict[int, str] = {}
+        self.set_modifiers(modifiers)
+
+    def _start(self) -> concurrent.futures.Executor:
+        return getattr(concurrent.futures, 'InterpreterPoolExecutor')(self.workers, thread_name_prefix='modifier')
+
+    def __exit__(self, *args):
+        try:
+            super().__exit__(*args)
+        finally:
+            self._remove_files()
+
+    def _remove_files(self) -> None:
+        for path in self._files.values():
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        self._files.clear()
+
+    def set_modifiers(self, modifiers:List[Modifier]) -> None:
+        super().set_modifiers(modifiers)
+        self.version += 1
+
+    def _modifiers_file(self) -> str:
+        """Path of the file with the pickled modifiers of this version."""
+        if self.version not in self._files:
+            fd, path = tempfile.mkstemp(prefix='opustrainer-modifiers-', suffix='.pickle')
+            with os.fdopen(fd, 'wb') as fh:
+                pickle.dump(self.modifiers, fh)
+            self._files[self.version] = path
+        return self._files[self.version]
+
+    def _run_chunk(self, lines:List[str], seed:ChunkSeed) -> Future:
+        assert self._executor is not None
+        self.stats.queued_chunks += 1
+        return self._submit(self._executor.submit(run_chunk_in_interpreter, self.version, self._modifiers_file(), lines, seed), len(lines))
+
+    def _run_job(self, job:Job) -> Future:
+        assert self._executor is not None
+        return self._submit(self._executor.submit(run_job_in_interpreter, self.version, self._modifiers_file(), job), 0)
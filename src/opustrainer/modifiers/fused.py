@@ -0,0 +1,88 @@
+"""Runs consecutive modifiers over lines that are parsed once.
+
+Each modifier normally gets the lines as strings, and most split them into
+fields and tokens, and parse the alignments, to join them back together
+afterwards. PairModifiers can also work on SentencePairs: the tokens of the
+source and target and the alignment pairs. `fuse_modifiers()` replaces each run
+of them in a list of modifiers with a FusedModifier, which parses the lines
+into SentencePairs once, passes them through the run, and formats them once.
+Other modifiers still get the lines as strings.
+
+The modifiers of a run still go over the chunk one after the other, so they
+draw the same random numbers as they would have. The formatted lines have a
+single space between the tokens, so a line only comes out different if it did
+not have that to begin with. Chunks with a line that can't be parsed, e.g.
+because it doesn't have two or three fields, go through the modifiers of the
+run as strings.
+"""
+from typing import Iterable, List
+
+from opustrainer.alignments import parse_alignments, format_alignments
+from opustrainer.modifiers import Modifier, PairModifier
+from opustrainer.types import SentencePair
+
+
+def parse_pair(line:str) -> SentencePair:
+    """Parses a `src<tab>trg` or `src<tab>trg<tab>alignments` line. Raises a
+    ValueError if it has any other number of fields, or alignments that are not
+    valid for its tokens."""
+    fields = line.split('\t')
+    if len(fields) not in (2, 3):
+        raise ValueError(f'Expected 2 or 3 fields, got {len(fields)}')
+    src = fields[0].split()
+    trg = fields[1].split()
+    return SentencePair(src, trg, parse_alignments(fields[2], src, trg) if len(fields) == 3 else None)
+
+
+def format_pair(pair:SentencePair) -> str:
+    """Opposite of `parse_pair()`"""
+    fields = [' '.join(pair.src), ' '.join(pair.trg)]
+    if pair.alignments is not None:
+        fields.append(format_alignments(pair.alignments))
+    return '\t'.join(fields)
+
+
+class FusedModifier(Modifier):
+    """Runs PairModifiers over a batch that is parsed into SentencePairs once."""
+    modifiers: List[PairModifier]
+
+    def __init__(self, modifiers:List[PairModifier]):
+        super().__init__(max(modifier.probability for modifier in modifiers))
+        self.modifiers = modifiers
+
+    def noop(self) -> bool:
+        return all(modifier.noop() for modifier in self.modifiers)
+
+    @property # type: ignore # an attribute of other modifiers
+    def thread_random(self) -> bool:
+        return all(modifier.thread_random for modifier in self.modifiers)
+
+    def __call__(self, batch:List[str]) -> Iterable[str]:
+        try:
+            pairs = [parse_pair(line) for line in batch]
+        except ValueError:
+            for modifier in self.modifiers:
+                batch = list(modifier(batch))
+            return batch
+        for modifier in self.modifiers:
+            pairs = list(modifier.modify_pairs(pairs))
+        return [format_pair(pair) for pair in pairs]
+
+
+def fuse_modifiers(modifiers:List[Modifier]) -> List[Modifier]:
+    """`modifiers` with each run of two or more PairModifiers replaced by a
+    FusedModifier."""
+    fused: List[Modifier] = []
+    run: List[PairModifier] = []
+    for modifier in [*modifiers, None]:
+        if isinstance(modifier, PairModifier):
+            run.append(modifier)
+            continue
+        if len(run) > 1:
+            fused.append(FusedModifier(run))
+        else:
+            fused.extend(run)
+        run = []
+        if modifier is not None:
+            fused.append(modifier)
+    return fused
@@ -1,10 +1,11 @@
-import random
 from operator import attrgetter
 from pathlib import Path
 from typing import Set, List, Tuple, Optional, TypeVar, Iterable
 
-from opustrainer.alignments import Pair, parse_alignments, format_alignments
-from opustrainer.modifiers import Modifier
+from opustrainer.alignments import Pair, parse_alignments, format_alignments, check_alignments
+from opustrainer.modifiers import Modifier, PairModifier
+from opustrainer.rng import local_random
+from opustrainer.types import SentencePair, TokenList
 from opustrainer.tokenizers import SpaceDetokenizer, SpaceTokenizer, MosesDetokenizer, SentencePieceTokenizer
 from opustrainer.modifiers.retokenize import Retokenizer, remap_alignment_pairs
 from opustrainer import logger
@@ -13,7 +14,7 @@ from opustrainer import logger
 T = TypeVar('T')
 
 def random_weighted_choice(options:Iterable[Tuple[T,float]]) -> T:
-    choice = random.random()
+    choice = local_random().random()
     cumsum = 0
     for option, prob in options:
         cumsum += prob
@@ -33,7 +34,8 @@ def get_random_unicode_words(min_length: int=2, max_length: int=10, max_words: i
     Maybe should do special rules for emoji and CJK? Emoji wouldn't appear with spaces in between normally
     and CJK would normally be of maximum length of 3 per word."""
 
-    length: int = random.randint(min_length, max_length)
+    rng = local_random()
+    length: int = rng.randint(min_length, max_length)
 
     # Update this to include code point ranges to be sampled
     # https://jrgraphix.net/r/Unicode/
@@ -164,12 +166,12 @@ def get_random_unicode_words(min_length: int=2, max_length: int=10, max_words: i
        # (0xE0000, 0xE007F), # Tags
     ]
     # Select a character set
-    alphabet = random.choice(include_ranges)
+    alphabet = rng.choice(include_ranges)
     
     # Generate a random string of 1 - 3 words
     return [
-        ''.join(chr(random.randrange(*alphabet)) for _ in range(length))
-        for _ in range(random.randint(1, max_words))
+        ''.join(chr(rng.randrange(*alphabet)) for _ in range(length))
+        for _ in range(rng.randint(1, max_words))
     ]
 
 
@@ -222,7 +224,7 @@ def get_placeholding_candidates(src_trg: List[Pair]) -> List[Pair]:
     return [pair for pair in src_trg if pair in selection]
 
 
-class PlaceholderTagModifier(Modifier):
+class PlaceholderTagModifier(PairModifier):
     """Unpacks a line, removes the alignments, and applies placeholding. Supports trivial and non trivial detokenization
        using moses detokenizer, which should be used for CJK languages and languages where words are typically not space
        delimited.
@@ -250,6 +252,8 @@ class PlaceholderTagModifier(Modifier):
     # `spm_vocab` argument, but in tests we also set this to True for testing.
     print_alignments: bool
 
+    thread_random = True
+
     def __init__(self, probability: float=0.0, custom_detok_src: Optional[str]=None, custom_detok_trg: Optional[str]=None,
         spm_vocab: Optional[Path]=None,
         template: str="__source__ {src} __target__ {trg} __done__", augment: float=0, replace:float=0):
@@ -290,6 +294,13 @@ class PlaceholderTagModifier(Modifier):
             except Exception as exc:
                 logger.log(f'Skipping line because of exception: {exc!r}', 'WARNING')
 
+    def modify_pairs(self, batch:List[SentencePair]) -> Iterable[SentencePair]:
+        for pair in batch:
+            try:
+                yield self.apply_pair(pair)
+            except Exception as exc:
+                logger.log(f'Skipping line because of exception: {exc!r}', 'WARNING')
+
     def apply(self, line:str) -> str:
         """Applies tag to words in a line based on alignment info, and then removes the alignment info from the line.
            This is used to enable terminology support by tagging random words with their translation.
@@ -305,6 +316,25 @@ class PlaceholderTagModifier(Modifier):
         # Try parsing alignments. If we fail, the sentence will be thrown out
         # by the trainer.
         alignments = parse_alignments(rest[0], source, target)
+
+        source_detok, target_detok, pairs = self.tag(source, target, alignments)
+        if pairs is not None:
+            return source_detok + "\t" + target_detok + "\t" + format_alignments(pairs)
+        else:
+            return source_detok + "\t" + target_detok
+
+    def apply_pair(self, pair:SentencePair) -> SentencePair:
+        """Same as `apply()`, for a line parsed into a SentencePair."""
+        if pair.alignments is None:
+            raise ValueError('Line has no alignment info')
+        # Modifiers before this one may have changed the tokens
+        check_alignments(pair.alignments, pair.src, pair.trg)
+        source_detok, target_detok, pairs = self.tag(pair.src, pair.trg, pair.alignments)
+        return SentencePair(source_detok.split(), target_detok.split(), pairs)
+
+    def tag(self, source:TokenList, target:TokenList, alignments:List[Pair]) -> Tuple[str, str, Optional[List[Pair]]]:
+        """Tags words of `source` and `target`, and detokenizes them. Returns the
+        alignments between the retokenized texts if they are to be printed."""
         candidate_offset = 0;
 
         while self.probability > 0.0:
@@ -329,7 +359,7 @@ class PlaceholderTagModifier(Modifier):
             candidate_offset = candidate_index + 1
 
              # Skip words whose turn it isn't yet.
-            if random.random() >= self.probability:
+            if local_random().random() >= self.probability:
                 continue
             
             # Select mode (skip random_weighted_choices*() when 'tag' is the only mode)
@@ -393,10 +423,9 @@ class PlaceholderTagModifier(Modifier):
         target_detok, _, target_mapping = self.trg_retokenizer.retokenize(target)
         
         if self.print_alignments:
-            remapped_pairs = remap_alignment_pairs(source_mapping, target_mapping, alignments)
-            return source_detok + "\t" + target_detok + "\t" + format_alignments(remapped_pairs)
+            return source_detok, target_detok, remap_alignment_pairs(source_mapping, target_mapping, alignments)
         else:
-            return source_detok + "\t" + target_detok
+            return source_detok, target_detok, None
 
     def validate(self, context:List[Modifier]) -> None:
         """Current limitation of the tags modifier is that any other modifier might modify the
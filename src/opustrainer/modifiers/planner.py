@@ -0,0 +1,127 @@
+"""Decides, when a stage starts, whether its modifiers are worth sending to the
+modifier workers.
+
+Sending a chunk to a worker and getting it back costs the trainer pickling and
+unpickling the lines both ways, and some overhead per chunk. For cheap
+modifiers like `UpperCase: 0.05` that is more work than modifying the lines
+in the trainer. The planner times each modifier on the first lines of the
+stage and compares that with timing the pickling of those lines. The modifiers
+then all run in the trainer or all in the workers. A chunk is seeded once, and
+all modifiers draw from the same random state, so splitting them up would give
+different lines.
+
+Modifiers that leave every line as it is are dropped from the end of the list.
+Ones before other modifiers stay, as they still draw random numbers.
+"""
+import logging
+import pickle
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+
+from opustrainer import logger
+from opustrainer.modifiers import Modifier
+
+
+# Seconds the trainer spends on a chunk it sends to a worker, besides pickling
+CHUNK_OVERHEAD = 50e-6
+
+# Number of lines of the first batch of a stage the modifiers are timed on
+SAMPLE_LINES = 64
+
+
+@dataclass(frozen=True)
+class ModifierPlan:
+    """Modifiers of a stage, and where they run."""
+    modifiers: List[Modifier]
+
+    # Modifiers dropped from the end of the list because they do nothing
+    dropped: List[Modifier]
+
+    # Seconds per line each of `modifiers` took, and that sending a line to
+    # the workers and back takes. Empty and None if not timed.
+    costs: List[float]
+    transfer: Optional[float]
+
+    # Whether the modifiers run in the trainer instead of the workers
+    inline: bool
+
+    def log(self, stage:str, loglevel:str="DEBUG") -> None:
+        names = ', '.join(f'{type(modifier).__name__} ({cost * 1e6:.1f}us)' for modifier, cost in zip(self.modifiers, self.costs)) \
+            or ', '.join(type(modifier).__name__ for modifier in self.modifiers) or 'no modifiers'
+        transfer = f' vs {self.transfer * 1e6:.1f}us per line to send to the workers' if self.transfer is not None else ''
+        logger.log(f"Stage {stage}: {names}{transfer}, running {'in the trainer' if self.inline else 'in the workers'}", loglevel=loglevel)
+        if self.dropped:
+            logger.log(f"Stage {stage}: dropped {', '.join(type(modifier).__name__ for modifier in self.dropped)}, which do nothing", loglevel=loglevel)
+
+
+def drop_noops(modifiers:List[Modifier]) -> List[Modifier]:
+    """Modifiers without the ones at the end that do nothing. The same list if
+    there are none."""
+    end = len(modifiers)
+    while end > 0 and modifiers[end - 1].noop():
+        end -= 1
+    return modifiers if end == len(modifiers) else modifiers[:end]
+
+
+class _DropThread(logging.Filter):
+    """Drops the log messages of one thread"""
+    def __init__(self, ident:Optional[int]):
+        super().__init__()
+        self.ident = ident
+
+    def filter(self, record:logging.LogRecord) -> bool:
+        return record.thread != self.ident
+
+
+def measure_costs(modifiers:List[Modifier], sample:List[str]) -> List[float]:
+    """Seconds per line each modifier takes on `sample`. Leaves the global
+    random state as it was, and keeps whatever the modifiers log to itself."""
+    costs = []
+    state = random.getstate()
+    quiet = _DropThread(threading.get_ident())
+    logging.getLogger().addFilter(quiet)
+    try:
+        random.seed(len(sample))
+        lines = sample
+        for modifier in modifiers:
+            started = time.perf_counter()
+            lines = list(modifier(lines))
+            costs.append((time.perf_counter() - started) / len(sample))
+    finally:
+        logging.getLogger().removeFilter(quiet)
+        random.setstate(state)
+    return costs
+
+
+def transfer_cost(sample:List[str], chunk_size:int) -> float:
+    """Seconds per line the trainer spends to send lines to a worker and get
+    them back."""
+    started = time.perf_counter()
+    for _ in range(2): # there and back again
+        pickle.loads(pickle.dumps(sample))
+    return (time.perf_counter() - started) / len(sample) + CHUNK_OVERHEAD / chunk_size
+
+
+def plan_modifiers(modifiers:List[Modifier], sample:Optional[List[str]], chunk_size:int) -> ModifierPlan:
+    """Plans the modifiers of a stage by timing them on `sample`, lines of its
+    first batch. Without a sample, they run in the workers."""
+    kept = drop_noops(modifiers)
+    dropped = modifiers[len(kept):]
+
+    if not sample:
+        return ModifierPlan(kept, dropped, [], None, inline=False)
+
+    if not kept:
+        return ModifierPlan(kept, dropped, [], None, inline=True)
+
+    sample = sample[:SAMPLE_LINES]
+    try:
+        costs = measure_costs(kept, sample)
+    except Exception:
+        # The workers will run into it too, and report it the usual way
+        return ModifierPlan(kept, dropped, [], None, inline=False)
+    transfer = transfer_cost(sample, chunk_size)
+    return ModifierPlan(kept, dropped, costs, transfer, inline=sum(costs) <= transfer)
@@ -1,33 +1,222 @@
 import logging
 import os
+import pickle
 import random
-
-from multiprocessing import Queue, Process
+import queue
+import signal
+import time
+import multiprocessing
+
+from collections import deque
+from dataclasses import dataclass
+from multiprocessing import Queue
+from multiprocessing.shared_memory import SharedMemory
 from logging.handlers import QueueHandler, QueueListener
-from typing import List, Union
+from typing import TYPE_CHECKING, Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple, Union, cast
 from itertools import chain
 
+from opustrainer import logger
 from opustrainer.modifiers import Modifier
+from opustrainer.pipeline import spawn_lock
+from opustrainer.affinity import set_affinity, worker_cpus
+from opustrainer.rng import CounterKey, local_random
+from opustrainer.modifiers.transport import TRANSPORTS, DEFAULT_RING_SIZE, Block, Payload, Ring, OrderedRing, TransportStats, read_block, write_block
+
+if TYPE_CHECKING:
+    from opustrainer.modifiers.backends import ExecutorModifierPool
+
+
+# Ways to start the workers. With forkserver, workers are forked from a server
+# process that has only imported the modules below, so they don't inherit the
+# memory of the trainer and don't need to import these again.
+START_METHODS = ('fork', 'forkserver', 'spawn')
+
+FORKSERVER_PRELOAD = [
+    'opustrainer.modifiers.surface',
+    'opustrainer.modifiers.prefix',
+    'opustrainer.modifiers.placeholders', # imports sacremoses and sentencepiece
+    'opustrainer.modifiers.retokenize',
+    'opustrainer.modifiers.typos', # imports typo
+]
+
+
+# Seed of a chunk: a number to seed the random state with once for the whole
+# chunk, or the key of its batch and the index of its first line in it, to seed
+# each line with its own counter-based seed.
+ChunkSeed = Union[float, Tuple[CounterKey, int]]
+
+# Gives the seed of a chunk of a batch given its index and the chunk size, for
+# `imap()`, which asks for it when the chunk is submitted.
+ChunkSeeder = Callable[[int, int], ChunkSeed]
+
+# Chunk size for `imap()`: a number, or a function that gives the chunk size
+# of each next batch, for when it changes while running.
+ChunkSize = Union[int, Callable[[], int]]
+
+# Chunks in flight per worker in `imap()` if not given
+DEFAULT_INFLIGHT_PER_WORKER = 4
+
+# Seconds between checks on the workers while waiting for them
+POLL_INTERVAL = 1.0
+
+# Number of times dead workers are replaced before the pool gives up
+DEFAULT_MAX_RESTARTS = 10
+
+# Where the seeds of the chunks of a batch come from: the counter-based key of
+# the batch, a seed for a random state of its own, or the global random state.
+BatchSeed = Union[CounterKey, str, None]
+
+
+def apply_modifiers(modifiers:List[Modifier], batch:List[str], seed:ChunkSeed) -> List[str]:
+    """Runs a chunk of lines through the modifiers. Sets the random state the
+    modifiers use, see `local_random()`, so the worker and the order in which
+    chunks are processed are no longer relevant."""
+    rng = local_random()
+    if isinstance(seed, tuple):
+        key, offset = seed
+        output = []
+        for line_no, line in enumerate(batch, start=offset):
+            rng.seed(key.line_seed(line_no))
+            lines = [line]
+            for modifier in modifiers:
+                lines = list(modifier(lines))
+            output.extend(lines)
+        return output
+
+    rng.seed(seed)
+    for modifier in modifiers:
+        batch = list(modifier(batch))
+    return batch
+
+
+def chunk_seed(chunk:int, chunksize:int, key:Optional[CounterKey]) -> ChunkSeed:
+    """Draws a seed for each chunk from the global random state, unless the
+    lines are seeded by their counter."""
+    if key is not None:
+        return key, chunk * chunksize
+    return random.random()
+
+
+def batch_seeding(seed:BatchSeed) -> Tuple[ChunkSeeder, Callable[[List[str]], None]]:
+    """Functions that seed the chunks of a batch and shuffle it afterwards. With
+    a string, these give the same numbers as seeding the global random state
+    with it would."""
+    if isinstance(seed, CounterKey):
+        key = seed
+        return (lambda chunk, size: (key, chunk * size)), key.shuffle
+    generator: Any = random.Random(seed) if seed is not None else random
+    return (lambda chunk, size: generator.random()), generator.shuffle
+
+
+def count_chunks(lines:int, chunksize:int) -> int:
+    return -(-lines // chunksize)
+
+
+def batch_chunk_size(chunksize:ChunkSize) -> int:
+    """Chunk size of the next batch"""
+    size = chunksize() if callable(chunksize) else chunksize
+    if size <= 0:
+        raise ValueError("Need a chunksize > 0")
+    return size
+
+
+def describe_work(work:Any) -> str:
+    """Short description of a chunk or job, for error messages."""
+    if isinstance(work, list) and work:
+        return f'a chunk of {len(work)} lines, starting with {work[0][:100]!r}'
+    return repr(work)[:200]
+
+
+class Job:
+    """Task that a worker runs as a whole with its modifiers, instead of a chunk
+    of lines. Its result is the finished batch. See `ModifierPool.imap_jobs()`."""
+    def run(self, modifiers:List[Modifier]) -> bytes:
+        raise NotImplementedError()
+
+
+@dataclass
+class PendingBatch:
+    """Results of the chunks of a batch in `imap()`, as they come back."""
+    results: List[List[str]]
+    remaining: int
+
+    @classmethod
+    def empty(cls, chunks:int) -> 'PendingBatch':
+        return cls([[] for _ in range(chunks)], chunks)
+
 
+class ChunkTimeoutError(RuntimeError):
+    """A worker spent longer than the pool's `chunk_timeout` on a chunk."""
 
-class ModifierWorker(Process):
-    """Process that runs batches of sentences through a list of modifiers"""
+
+@dataclass
+class WorkerStatus:
+    """Chunk a worker is working on, shared with the pool"""
+    task: Any # multiprocessing.Value of the chunk id
+    started: Any # multiprocessing.Value of the time it started, 0 when idle
+    busy: Any # multiprocessing.Value of the seconds spent on chunks so far
+
+
+@dataclass
+class SharedBuffers:
+    """Shared memory a worker reads its chunks from and writes its results to"""
+    input: SharedMemory
+    output: SharedMemory
+    # Position up to which the trainer has read the results in `output`
+    output_tail: Any # multiprocessing.Value
+    # Index of this worker's output segment
+    segment: int
+    size: int
+
+
+class ModifierWorker:
+    """Runs batches of sentences through a list of modifiers. Its `run()` is
+    the target of a worker process."""
     tasks: Queue
     results: Queue
     messages: Queue
-    modifiers: List[Modifier]
 
-    def __init__(self, tasks:Queue, results:Queue, messages:Queue, modifiers:List[Modifier], **kwargs):
-        super().__init__(**kwargs)
+    """Queue through which this worker receives new lists of modifiers"""
+    control: Queue
+
+    loglevel: int
+
+    """Shared memory for the lines, if they're not sent through the queues"""
+    shared: Optional[SharedBuffers]
+
+    """Where this worker tells the pool what it is working on"""
+    status: Optional[WorkerStatus]
+
+    """CPUs to run on, if restricted"""
+    cpus: Optional[List[int]]
+
+    def __init__(self, tasks:Queue, results:Queue, messages:Queue, control:Queue, loglevel:int, shared:Optional[SharedBuffers]=None,
+                 status:Optional[WorkerStatus]=None, cpus:Optional[List[int]]=None):
         self.tasks = tasks
         self.results = results
         self.messages = messages
-        self.modifiers = modifiers
-        
+        self.control = control
+        self.loglevel = loglevel
+        self.shared = shared
+        self.status = status
+        self.cpus = cpus
+
     def run(self):
+        # Ctrl-c is handled by the main process, which will tell us to stop.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        set_affinity(self.cpus)
+
         handler = QueueHandler(self.messages)
         logging.getLogger().addHandler(handler)
-    
+        # Workers that are not forked from the trainer don't inherit its level
+        logging.getLogger().setLevel(self.loglevel)
+
+        modifiers: List[Modifier] = []
+        version = -1
+
+        ring = Ring(self.shared.size) if self.shared is not None else None
+
         while True:
             task = self.tasks.get()
 
@@ -35,20 +224,42 @@ class ModifierWorker(Process):
             if task is None:
                 break
 
-            # A task consists of a chunk id, batch seed, and lines
-            chunk, seed, batch = task
+            # A task consists of a chunk id, the version of the modifier list to
+            # apply, batch seed, and lines
+            chunk, task_version, seed, batch = task
+
+            if self.status is not None:
+                self.status.task.value = chunk
+                self.status.started.value = time.time()
 
             try:
-                # Set random seed for this batch, so the worker and the order
-                # in which batches are processed are no longer relevant
-                random.seed(seed)
+                # The new modifier list is sent before the first task that needs it
+                while version < task_version:
+                    version, payload = self.control.get()
+                    modifiers = pickle.loads(payload)
 
-                for modifier in self.modifiers:
-                    batch = list(modifier(batch))
+                if isinstance(batch, Job):
+                    self.results.put((chunk, batch.run(modifiers), None))
+                    continue
 
-                self.results.put((chunk, batch, None))
+                if isinstance(batch, Block):
+                    assert self.shared is not None
+                    batch = read_block(self.shared.input, batch)
+
+                result: Payload = apply_modifiers(modifiers, batch, seed)
+
+                if self.shared is not None and ring is not None:
+                    block = write_block(self.shared.output, ring, self.shared.segment, result, self.shared.output_tail.value)
+                    if block is not None:
+                        result = block
+
+                self.results.put((chunk, result, None))
             except Exception as exc:
                 self.results.put((chunk, None, exc))
+            finally:
+                if self.status is not None:
+                    self.status.busy.value += time.time() - self.status.started.value
+                    self.status.started.value = 0.0
         self.results.close()
 
 
@@ -56,6 +267,15 @@ class ModifierPool:
     """Pool of ModifierWorker that exposes `map()` to run a batch of sentences
     through a predefined list of modifiers. Similar to multiprocessing.Pool
     except that the `func` argument doesn't need to be passed for each call.
+
+    The list of modifiers can be replaced with `set_modifiers()`, which sends
+    it to the running workers instead of starting new ones.
+
+    If a worker dies, e.g. because it was killed for using too much memory,
+    all workers are replaced and the chunks that had not come back yet are
+    sent again. The queues the workers share may be left in an unusable
+    state by a worker that dies while using them, so those are replaced too.
+    As the seed of each chunk is part of the task, the results are the same.
     """
 
     """Number of worker processes in the pool"""
@@ -64,52 +284,340 @@ class ModifierPool:
     """Modifier list each worker applies to the batches"""
     modifiers: List[Modifier]
 
+    """Version of the modifier list, sent along with each task"""
+    version: int
+
+    """How the worker processes are started, one of START_METHODS"""
+    start_method: str
+
+    """Maximum number of chunks waiting in `tasks`, 0 for no limit"""
+    max_pending: int
+
+    """Maximum number of chunks `imap()` keeps in the workers, 0 for the default"""
+    max_inflight: int
+
+    """Seconds a worker may spend on a single chunk, 0 for no limit"""
+    chunk_timeout: float
+
+    """Number of times the workers may be replaced before giving up"""
+    max_restarts: int
+
+    """CPUs the workers are spread over, if restricted"""
+    cpus: Optional[List[int]]
+
     """Queue for submitting chunks of work to the workers"""
     tasks: Queue
 
     """Queue for receiving chunks from the workers"""
     results: Queue
 
+    """Queue per worker for sending it new modifier lists"""
+    controls: List[Queue]
+
+    """What each worker is working on"""
+    status: List[WorkerStatus]
+
+    """How lines are sent to and from the workers, one of TRANSPORTS"""
+    transport: str
+
+    """Size of each shared memory ring buffer, for the shm transport"""
+    ring_size: int
+
+    """Number of chunks and bytes sent to and from the workers"""
+    stats: TransportStats
+
     messages: Queue
 
     log_worker: QueueListener
 
-    def __init__(self, modifiers:List[Modifier], processes:int=0):
+    def __init__(self, modifiers:List[Modifier], processes:int=0, max_pending:int=0, start_method:str='fork',
+                 transport:str='queue', ring_size:int=DEFAULT_RING_SIZE, max_inflight:int=0, chunk_timeout:float=0,
+                 max_restarts:int=DEFAULT_MAX_RESTARTS, cpus:Optional[List[int]]=None):
+        if start_method not in START_METHODS:
+            raise ValueError(f'unknown start method {start_method}, choose from {", ".join(START_METHODS)}')
+        if transport not in TRANSPORTS:
+            raise ValueError(f'unknown transport {transport}, choose from {", ".join(TRANSPORTS)}')
         self.modifiers = modifiers
+        self.version = -1
         self.workers = processes if processes > 0 else min(os.cpu_count() or 1, 8)
+        self.max_pending = max_pending
+        self.start_method = start_method
+        self.transport = transport
+        self.ring_size = ring_size
+        self.max_inflight = max_inflight
+        self.chunk_timeout = chunk_timeout
+        self.max_restarts = max_restarts
+        self.cpus = cpus
+        self.stats = TransportStats()
+        # Position in the input ring to release once a chunk is done
+        self._releases: Dict[int,int] = {}
+        # Chunks sent to the workers that have not come back yet, by id, with
+        # everything needed to send them again.
+        self._outstanding: Dict[int,Tuple[int,Optional[ChunkSeed],Union[List[str],Job]]] = {}
+        # Pickled modifier lists by version, for workers that replace dead ones
+        self._pickled: Dict[int,bytes] = {}
+        # Set once the workers are stopped because one of them got stuck
+        self._broken = False
+        # Seconds spent on chunks by workers that have been replaced
+        self._retired_busy = 0.0
 
     def __enter__(self) -> 'ModifierPool':
-        self.tasks = Queue()
-        self.results = Queue()
-        
-        self.messages = Queue()
+        self._context = multiprocessing.get_context(self.start_method)
+        if self.start_method == 'forkserver':
+            self._context.set_forkserver_preload(FORKSERVER_PRELOAD)
+
+        # One ring for the chunks sent to the workers, and one for the results
+        # of each worker, so each ring has a single writer.
+        self.shared: List[SharedBuffers] = []
+        self.input_ring: Optional[OrderedRing] = None
+        if self.transport == 'shm':
+            self.input_ring = OrderedRing(self.ring_size)
+            self.input_shm = SharedMemory(create=True, size=self.ring_size)
+            self.shared = [
+                SharedBuffers(self.input_shm, SharedMemory(create=True, size=self.ring_size), self._context.Value('q', 0, lock=False), segment, self.ring_size)
+                for segment in range(self.workers)
+            ]
+
+        self._start_workers()
+
+        self.set_modifiers(self.modifiers)
+
+        return self
+
+    def _start_workers(self) -> None:
+        context = self._context
+
+        # With max_pending, map() waits for workers to pick up chunks before
+        # submitting more, instead of holding all of them in the queue.
+        self.tasks = context.Queue(maxsize=self.max_pending)
+        self.results = context.Queue()
+
+        self.messages = context.Queue()
         self.log_worker = QueueListener(self.messages, *logging.getLogger().handlers, respect_handler_level=True)
         self.log_worker.start()
 
-        self.processes = [
-            ModifierWorker(self.tasks, self.results, self.messages, self.modifiers, daemon=True)
-            for _ in range(self.workers)
-        ]
+        self.controls = [context.Queue() for _ in range(self.workers)]
 
-        for process in self.processes:
-            process.start()
+        self.status = [WorkerStatus(context.Value('q', -1, lock=False), context.Value('d', 0.0, lock=False), context.Value('d', 0.0, lock=False)) for _ in range(self.workers)]
 
-        return self
+        self.processes = [
+            context.Process(
+                target=ModifierWorker(self.tasks, self.results, self.messages, control, logging.getLogger().level,
+                                      self.shared[index] if self.shared else None, self.status[index],
+                                      worker_cpus(index, self.workers, self.cpus) if self.cpus else None).run,
+                daemon=True)
+            for index, control in enumerate(self.controls)
+        ]
 
-    def __exit__(self, *args):
-        # Tell workers to stop
-        for _ in self.processes:
-            self.tasks.put(None)
-        self.tasks.close()
+        with spawn_lock:
+            for process in self.processes:
+                process.start()
 
-        # Wait for workers to close down
+    def _stop_workers(self) -> None:
+        """Kills the workers without waiting for them, and abandons the queues
+        they shared, which may be in an unusable state."""
+        self._retired_busy += sum(status.busy.value for status in self.status)
         for process in self.processes:
+            if process.is_alive():
+                process.kill()
             process.join()
 
-        self.log_worker.stop()
-        self.messages.close()
+        for shared_queue in [self.tasks, self.results, *self.controls]:
+            shared_queue.cancel_join_thread()
+            shared_queue.close()
+
+        # Not stopped, as that needs the queue to still work. Its thread is a
+        # daemon and stops with the trainer.
+        self.messages.cancel_join_thread()
+
+    def _restart(self, dead:List[multiprocessing.process.BaseProcess]) -> None:
+        """Replaces all workers and sends them the chunks that haven't come back."""
+        self.stats.restarts += 1
+        if self.stats.restarts > self.max_restarts:
+            self._broken = True
+            self._stop_workers()
+            raise RuntimeError(f'Modifier workers died {self.stats.restarts} times, giving up')
+
+        logger.log(', '.join(f'Modifier worker {process.pid} died with exit code {process.exitcode}' for process in dead)
+                   + f'; replacing the workers and sending {len(self._outstanding)} chunks again', loglevel="WARNING")
+
+        self._stop_workers()
+
+        # The chunks are sent again from scratch, and the results in the rings
+        # won't be read anymore.
+        if self.input_ring is not None:
+            for end in self._releases.values():
+                self.input_ring.release(end)
+        self._releases = {}
+        for shared in self.shared:
+            shared.output_tail.value = 0
+
+        self._start_workers()
+
+        # Workers pick up the modifier list a task needs before they run it, so
+        # send those of older chunks still on their way too.
+        oldest = min((version for version, _, _ in self._outstanding.values()), default=self.version)
+        for version, payload in sorted(self._pickled.items()):
+            if version >= oldest:
+                for control in self.controls:
+                    control.put((version, payload))
+
+        tasks = self.tasks
+        for chunk in sorted(self._outstanding):
+            self._dispatch(chunk)
+            self.stats.redispatched += 1
+            # If the new workers died too, they were replaced again
+            if self.tasks is not tasks:
+                break
+
+    def _check_workers(self) -> None:
+        """Replaces the workers if any of them died, and raises an error if one
+        is stuck on a chunk."""
+        dead = [process for process in self.processes if process.exitcode is not None]
+        if dead:
+            self._restart(dead)
+            return
+
+        if self.chunk_timeout <= 0:
+            return
+
+        now = time.time()
+        for process, status in zip(self.processes, self.status):
+            started, chunk = status.started.value, status.task.value
+            if started > 0 and now - started > self.chunk_timeout and chunk in self._outstanding:
+                _, _, work = self._outstanding[chunk]
+                self._broken = True
+                self._stop_workers()
+                raise ChunkTimeoutError(f'Modifier worker {process.pid} spent more than {self.chunk_timeout:g}s on {describe_work(work)}')
+
+    def set_modifiers(self, modifiers:List[Modifier]) -> None:
+        """Replace the modifiers applied by `map()`. The list is pickled once
+        and sent to each worker, which picks it up before its next task."""
+        self.modifiers = modifiers
+        self.version += 1
+        payload = pickle.dumps(modifiers)
+        oldest = min((version for version, _, _ in self._outstanding.values()), default=self.version)
+        self._pickled = {version: data for version, data in self._pickled.items() if version >= oldest}
+        self._pickled[self.version] = payload
+        for control in self.controls:
+            control.put((self.version, payload))
 
-    def map(self, batch:List[str], chunksize:int=0) -> List[str]:
+    def __exit__(self, *args):
+        # A worker that died since the last chunk may have left the task queue
+        # unusable, and then the others would never see they can stop.
+        if not self._broken and any(process.exitcode is not None for process in self.processes):
+            self._broken = True
+            self._stop_workers()
+
+        if not self._broken:
+            # Tell workers to stop
+            for _ in self.processes:
+                self.tasks.put(None)
+            self.tasks.close()
+
+            # Wait for workers to close down
+            for process in self.processes:
+                process.join()
+
+            for control in self.controls:
+                control.close()
+
+            self.log_worker.stop()
+            self.messages.close()
+
+        if self.shared:
+            for shm in [self.input_shm] + [shared.output for shared in self.shared]:
+                shm.close()
+                shm.unlink()
+
+    def log_stats(self, loglevel:str="INFO") -> None:
+        self.stats.log(loglevel)
+
+    def busy_time(self) -> Optional[float]:
+        """Seconds the workers spent on chunks so far, all together"""
+        return self._retired_busy + sum(status.busy.value for status in self.status)
+
+    def _limit(self) -> int:
+        return self.max_inflight if self.max_inflight > 0 else DEFAULT_INFLIGHT_PER_WORKER * len(self.processes)
+
+    def _count(self, payload:Payload) -> None:
+        if isinstance(payload, Block):
+            self.stats.shared_bytes += payload.length
+        else:
+            self.stats.queued_chunks += 1
+
+    def _dispatch(self, chunk:int) -> None:
+        """Puts an outstanding chunk in the task queue, checking on the workers
+        while it is full."""
+        version, seed, work = self._outstanding[chunk]
+        payload: Union[Payload, Job] = work
+        if isinstance(work, list):
+            if self.input_ring is not None:
+                block = write_block(self.input_shm, self.input_ring, -1, work, self.input_ring.tail)
+                if block is not None:
+                    payload = block
+                    self._releases[chunk] = block.release
+            self._count(cast(Payload, payload))
+
+        tasks = self.tasks
+        while True:
+            try:
+                tasks.put((chunk, version, seed, payload), timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                self._check_workers()
+                # If the workers were replaced, this chunk was sent again
+                if self.tasks is not tasks:
+                    return
+
+    def _submit(self, chunk:int, seed:Optional[ChunkSeed], work:Union[List[str],Job]) -> None:
+        self._outstanding[chunk] = self.version, seed, work
+        self.stats.chunks += 1
+        if isinstance(work, list):
+            self.stats.lines += len(work)
+        self.stats.inflight += 1
+        self.stats.peak_inflight = max(self.stats.peak_inflight, self.stats.inflight)
+        self._dispatch(chunk)
+
+    def _receive(self) -> Tuple[int, Any, Optional[Exception]]:
+        """Waits for the next chunk to come back from any worker."""
+        started = time.monotonic()
+        while True:
+            try:
+                chunk, result, exc = self.results.get(timeout=POLL_INTERVAL)
+                break
+            except queue.Empty:
+                self._check_workers()
+        self.stats.stall_time += time.monotonic() - started
+        self.stats.inflight -= 1
+        del self._outstanding[chunk]
+        if chunk in self._releases:
+            assert self.input_ring is not None
+            self.input_ring.release(self._releases.pop(chunk))
+        if exc is not None:
+            return chunk, None, exc
+        if isinstance(result, bytes):
+            return chunk, result, None
+        self._count(result)
+        if isinstance(result, Block):
+            shared = self.shared[result.segment]
+            lines = read_block(shared.output, result)
+            # Let the worker reuse the space
+            shared.output_tail.value = result.release
+            result = lines
+        return chunk, result, None
+
+    def _drain(self) -> None:
+        """Waits for the chunks still in the workers, so they don't end up in
+        the results of the next call."""
+        while self.stats.inflight > 0 and not self._broken:
+            self._receive()
+        if self._broken:
+            self.stats.inflight = 0
+            self._outstanding.clear()
+            self._releases.clear()
+
+    def map(self, batch:List[str], chunksize:int=0, key:Optional[CounterKey]=None) -> List[str]:
         if chunksize > 0:
             chunks, remainder = divmod(len(batch), chunksize)
         else:
@@ -122,36 +630,155 @@ class ModifierPool:
             chunk * chunksize + (chunksize if chunk < chunks else remainder)
         )
 
-        # Submit tasks to workers
-        for chunk in range(chunks + (1 if remainder > 0 else 0)):
-            self.tasks.put((chunk, random.random(), batch[chunk_slice(chunk)]))
-
         # Placeholder for the returned chunks, in order
         chunk_results = [[]] * (chunks + (1 if remainder > 0 else 0))
 
-        # Retrieve results from workers
-        for _ in range(chunks + (1 if remainder > 0 else 0)):
-            chunk, result, exc = self.results.get()
-            if exc is not None:
-                raise exc
-            chunk_results[chunk] = result
+        try:
+            # Submit tasks to workers
+            for chunk in range(chunks + (1 if remainder > 0 else 0)):
+                self._submit(chunk, chunk_seed(chunk, chunksize, key), batch[chunk_slice(chunk)])
+
+            # Retrieve results from workers. If a chunk failed, still wait for the
+            # others so they don't end up in the results of the next call.
+            error: Optional[Exception] = None
+            for _ in range(chunks + (1 if remainder > 0 else 0)):
+                chunk, result, exc = self._receive()
+                if exc is not None:
+                    error = error or exc
+                else:
+                    chunk_results[chunk] = result
+            if error is not None:
+                raise error
+        finally:
+            self._drain()
 
         # Stitch the ordered result chunks back together into a single batch
         return list(chain(*chunk_results))
 
+    def imap(self, batches:Iterable[Tuple[List[str], ChunkSeeder]], chunksize:ChunkSize) -> Iterator[List[str]]:
+        """Like `map()`, but for a stream of batches, each with a function that
+        gives the seed of each of its chunks. Instead of waiting for all chunks
+        of a batch before submitting the next one, it keeps up to
+        `max_inflight` chunks in the workers across batches, and yields each
+        batch as soon as all of its chunks are back, in order.
+
+        A batch is only taken from `batches` once all chunks of the previous
+        one are submitted, and a chunk's seed is asked for when the chunk is
+        submitted. So is the chunk size of a batch, if `chunksize` is a
+        function, and `max_inflight` is looked at for each chunk."""
+        batch_chunk_size(chunksize)
+
+        # Batches of which chunks are in the workers, oldest first, and for each
+        # chunk in flight the batch and index it belongs to.
+        pending: Deque[PendingBatch] = deque()
+        owners: Dict[int,Tuple[PendingBatch,int]] = {}
+
+        # Batch being submitted, its seeder, and the next chunk to submit
+        current: Optional[Tuple[List[str], ChunkSeeder, PendingBatch]] = None
+        next_chunk = 0
+        task_id = 0
+        size = 0
+
+        batches = iter(batches)
+        exhausted = False
+
+        try:
+            while True:
+                while not exhausted and self.stats.inflight < self._limit():
+                    if current is None:
+                        try:
+                            lines, seeder = next(batches)
+                        except StopIteration:
+                            exhausted = True
+                            break
+                        size = batch_chunk_size(chunksize)
+                        current = lines, seeder, PendingBatch.empty(count_chunks(len(lines), size))
+                        pending.append(current[2])
+                        next_chunk = 0
+
+                    lines, seeder, slot = current
+                    if next_chunk < len(slot.results):
+                        self._submit(task_id, seeder(next_chunk, size), lines[next_chunk * size:(next_chunk + 1) * size])
+                        owners[task_id] = slot, next_chunk
+                        task_id += 1
+                        next_chunk += 1
+                    if next_chunk == len(slot.results):
+                        current = None
+
+                while pending and pending[0].remaining == 0:
+                    yield list(chain(*pending.popleft().results))
+
+                if self.stats.inflight == 0:
+                    if exhausted:
+                        break
+                    continue
+
+                chunk, result, exc = self._receive()
+                slot, index = owners.pop(chunk)
+                if exc is not None:
+                    raise exc
+                assert result is not None
+                slot.results[index] = result
+                slot.remaining -= 1
+        finally:
+            self._drain()
+
+    def imap_jobs(self, jobs:Iterable[Job]) -> Iterator[bytes]:
+        """Runs each job in a worker, keeping up to `max_inflight` of them in
+        the workers, and yields their results in order."""
+        results: Dict[int,bytes] = {}
+        submitted, yielded = 0, 0
+
+        jobs = iter(jobs)
+        exhausted = False
+
+        try:
+            while True:
+                while not exhausted and self.stats.inflight < self._limit():
+                    job = next(jobs, None)
+                    if job is None:
+                        exhausted = True
+                        break
+                    self._submit(submitted, None, job)
+                    submitted += 1
+
+                while yielded in results:
+                    yield results.pop(yielded)
+                    yielded += 1
+
+                if self.stats.inflight == 0:
+                    if exhausted:
+                        break
+                    continue
+
+                task, result, exc = self._receive()
+                if exc is not None:
+                    raise exc
+                results[task] = result
+        finally:
+            self._drain()
+
 
 class ErzatsModifierPool:
     """Same as ModifierPool, but does all the work on the main thread."""
-    def __init__(self, modifiers:List[Modifier], processes:int=0):
+    def __init__(self, modifiers:List[Modifier], processes:int=0, max_pending:int=0, start_method:str='fork',
+                 transport:str='queue', ring_size:int=DEFAULT_RING_SIZE, max_inflight:int=0, chunk_timeout:float=0,
+                 max_restarts:int=DEFAULT_MAX_RESTARTS, cpus:Optional[List[int]]=None):
         self.modifiers = modifiers
 
     def __enter__(self) -> 'ErzatsModifierPool':
         return self
 
+    def set_modifiers(self, modifiers:List[Modifier]) -> None:
+        self.modifiers = modifiers
+
     def __exit__(self, *args):
         pass
 
-    def map(self, batch:List[str], chunksize:int=0) -> List[str]:
+    def log_stats(self, loglevel:str="INFO") -> None:
+        pass # Lines never leave this process
+
+    def map(self, batch:List[str], chunksize:int=0, key:Optional[CounterKey]=None) -> List[str]:
         if chunksize > 0:
             chunks, remainder = divmod(len(batch), chunksize)
         else:
@@ -167,7 +794,7 @@ class ErzatsModifierPool:
 
         # Submit tasks to workers
         for chunk in range(chunks + (1 if remainder > 0 else 0)):
-            tasks.append((chunk, random.random(), batch[chunk_slice(chunk)]))
+            tasks.append((chunk, chunk_seed(chunk, chunksize, key), batch[chunk_slice(chunk)]))
 
         # Placeholder for the returned chunks, in order
         chunk_results = [[]] * (chunks + (1 if remainder > 0 else 0))
@@ -175,23 +802,55 @@ class ErzatsModifierPool:
         random_state = random.getstate()
 
         for chunk, seed, batch in tasks:
-            # Set random seed for this batch, so the worker and the order
-            # in which batches are processed are no longer relevant
-            random.seed(seed)
-
-            for modifier in self.modifiers:
-                batch = list(modifier(batch))
-
-            chunk_results[chunk] = batch
+            chunk_results[chunk] = apply_modifiers(self.modifiers, batch, seed)
 
         random.setstate(random_state)
         
         # Stitch the ordered result chunks back together into a single batch
         return list(chain(*chunk_results))
 
-
-def make_modifier_pool(modifiers:List[Modifier], processes:int) -> Union[ModifierPool, ErzatsModifierPool]:
+    def imap(self, batches:Iterable[Tuple[List[str], ChunkSeeder]], chunksize:ChunkSize) -> Iterator[List[str]]:
+        batch_chunk_size(chunksize)
+
+        for batch, seeder in batches:
+            size = batch_chunk_size(chunksize)
+            chunk_results = []
+            for chunk in range(count_chunks(len(batch), size)):
+                seed = seeder(chunk, size)
+                random_state = random.getstate()
+                chunk_results.append(apply_modifiers(self.modifiers, batch[chunk * size:(chunk + 1) * size], seed))
+                random.setstate(random_state)
+            yield list(chain(*chunk_results))
+
+    def imap_jobs(self, jobs:Iterable[Job]) -> Iterator[bytes]:
+        for job in jobs:
+            random_state = random.getstate()
+            result = job.run(self.modifiers)
+            random.setstate(random_state)
+            yield result
+
+
+def make_modifier_pool(modifiers:List[Modifier], processes:int, max_pending:int=0, start_method:str='fork', transport:str='queue',
+                       max_inflight:int=0, chunk_timeout:float=0, cpus:Optional[List[int]]=None,
+                       backend:str='processes', stage_workers:Optional[Dict[str,int]]=None) -> Union[ModifierPool, ErzatsModifierPool, 'ExecutorModifierPool']:
+    """Pool with `processes` workers of `backend`, one of BACKENDS, or one that
+    does all the work on the calling thread if `processes` is 0. The options of
+    the processes backend that don't apply to the others are ignored. With
+    `stage_workers`, the modifiers run as a pipeline of worker processes with
+    that many workers per modifier class instead, see PipelineModifierPool."""
+    # Imported here because the backends build on this module
+    from opustrainer.modifiers.backends import resolve_backend, ThreadModifierPool, InterpreterModifierPool
+    from opustrainer.modifiers.stages import PipelineModifierPool
+    backend = resolve_backend(backend, modifiers)
     if processes == 0:
-        return ErzatsModifierPool(modifiers, processes)
+        return ErzatsModifierPool(modifiers, processes, max_pending, start_method, transport, max_inflight=max_inflight, chunk_timeout=chunk_timeout)
+    if stage_workers is not None:
+        logger.log(f"Running the modifiers as a pipeline of processes, {', '.join(f'{name}: {count}' for name, count in stage_workers.items()) or '1 each'}", loglevel="DEBUG")
+        return PipelineModifierPool(modifiers, stage_workers, max_inflight=max_inflight, chunk_timeout=chunk_timeout, start_method=start_method)
+    logger.log(f"Running the modifiers in {processes} {backend}", loglevel="DEBUG")
+    if backend == 'threads':
+        return ThreadModifierPool(modifiers, processes, max_inflight=max_inflight, chunk_timeout=chunk_timeout, cpus=cpus)
+    elif backend == 'interpreters':
+        return InterpreterModifierPool(modifiers, processes, max_inflight=max_inflight, chunk_timeout=chunk_timeout)
     else:
-        return ModifierPool(modifiers, processes)
+        return ModifierPool(modifiers, processes, max_pending, start_method, transport, max_inflight=max_inflight, chunk_timeout=chunk_timeout, cpus=cpus)
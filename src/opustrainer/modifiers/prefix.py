@@ -1,9 +1,10 @@
-import random
-from typing import List, Iterable
-from opustrainer.modifiers import Modifier
+from typing import List, Iterable, Optional
+from opustrainer.modifiers import LineModifier, PairModifier
+from opustrainer.rng import local_random
+from opustrainer.types import SentencePair
 
 
-class PrefixModifier(Modifier):
+class PrefixModifier(LineModifier, PairModifier):
     """Prefixes the source sentence with a phrase from the target sentence. 
     Note that if the target is ZH, JA or basically any other language that is not space segmented,
     this wouldn't work as we would be prefixing the whole sentence (or very large part of it).
@@ -22,6 +23,8 @@ class PrefixModifier(Modifier):
     max_words: int
     template: str
 
+    thread_random = True
+
     def __init__(self, probability: float=0.0, min_words: int=2,
         max_words: int=5, template: str="__start__ {trg} __end__ "):
         super().__init__(probability)
@@ -29,24 +32,40 @@ class PrefixModifier(Modifier):
         self.max_words = max_words
         self.template = template
 
-    def __call__(self, batch:List[str]) -> Iterable[str]:
-        for line in batch:
-            yield self.apply(line)
-
     def apply(self, line:str) -> str:
+        if self.probability < local_random().random():
+            return line
+        return self.modify(line)
+
+    def apply_pair(self, pair:SentencePair) -> SentencePair:
+        if self.probability < local_random().random():
+            return pair
+        return self.modify_pair(pair)
+
+    def modify(self, line:str) -> str:
         """Takes a line in the form of "I like pie. Me gustan los pasteles."
            and turns it into: "__start__ los pasteles __end__ I like pie. Me
            gustan los pasteles."
         """
-        if self.probability < random.random():
-            return line
-        
         # Take care of cases where we could have the alignment info at the end.
         fields: List[str] = line.split('\t')
-        target_tok: List[str] = fields[1].split()
+        prefix = self.sample_prefix(fields[1].split())
+        return prefix + line if prefix is not None else line
+
+    def modify_pair(self, pair:SentencePair) -> SentencePair:
+        prefix = self.sample_prefix(pair.trg)
+        if prefix is None:
+            return pair
+        # The template need not end in a space, so join before splitting
+        return pair._replace(src=(prefix + ' '.join(pair.src)).split())
+
+    def sample_prefix(self, target_tok:List[str]) -> Optional[str]:
+        """The template filled in with a random phrase from the target tokens,
+        or None if there are too few of them."""
+        rng = local_random()
 
         # determine the length of the sample
-        num_tokens = random.randint(self.min_words, self.max_words)
+        num_tokens = rng.randint(self.min_words, self.max_words)
 
         # Select start token, accounting for the fact that we need at least num_tokens in the sentence
         max_start_token = len(target_tok) - num_tokens
@@ -54,14 +73,13 @@ class PrefixModifier(Modifier):
         # If we have a negative max_start_token it means that the sentence
         # is too short for this augmentation and we should just skip it.
         if max_start_token < 0:
-            return line
+            return None
 
         # random.randrange(x) generates a number in the interval of [0, X)
         # max_start_token is computed as the difference in length of the two sequences which means that
         # we want random.ranrange(x) to produce [0, X], therefore we increment it by one.
-        start_token = random.randrange(max_start_token + 1)
+        start_token = rng.randrange(max_start_token + 1)
         
         augment_substring:str  = " ".join(target_tok[start_token:start_token + num_tokens])
 
-        # Return the modified string
-        return self.template.format(trg=augment_substring) + line
+        return self.template.format(trg=augment_substring)
@@ -1,9 +1,9 @@
 from typing import List, Dict, NamedTuple, Tuple, Iterable
 
-from opustrainer.types import Pair, TokenList, TokenMapping, Tokenizer, Detokenizer
-from opustrainer.alignments import parse_alignments, format_alignments
+from opustrainer.types import Pair, SentencePair, TokenList, TokenMapping, Tokenizer, Detokenizer
+from opustrainer.alignments import parse_alignments, format_alignments, check_alignments
 from opustrainer.tokenizers import make_tokenizer, make_detokenizer
-from opustrainer.modifiers import Modifier
+from opustrainer.modifiers import PairModifier
 from opustrainer import logger
 
 
@@ -75,7 +75,7 @@ def remap_alignment_pairs(src_mapping:TokenMapping, trg_mapping:TokenMapping, al
     return sorted(remapped)
 
 
-class RetokenizeModifier(Modifier):
+class RetokenizeModifier(PairModifier):
     """Retokenizes the input line, fixing up the alignments *but giving you the detokenized text*.
     The probability argument is ignored. Most of this functionality is already built into the Tags
     placeholder.
@@ -104,6 +104,9 @@ class RetokenizeModifier(Modifier):
     src: Retokenizer
     trg: Retokenizer
 
+    # Draws no random numbers at all
+    thread_random = True
+
     def __init__(self, probability: float=0.0, src:dict=dict(), trg:dict=dict()):
         super().__init__(probability) # probability is very much ignored lol.
         self.src = make_retokenizer(src)
@@ -116,9 +119,26 @@ class RetokenizeModifier(Modifier):
                 src_tokens = src.split()
                 trg_tokens = trg.split()
                 pairs = parse_alignments(alignments, src_tokens, trg_tokens)
-                new_src, _, src_mapping = self.src.retokenize(src_tokens)
-                new_trg, _, trg_mapping = self.trg.retokenize(trg_tokens)
-                remapped_pairs = remap_alignment_pairs(src_mapping, trg_mapping, pairs)
+                new_src, new_trg, remapped_pairs = self.retokenize(src_tokens, trg_tokens, pairs)
                 yield '\t'.join((new_src, new_trg, format_alignments(remapped_pairs)))
             except Exception as exc:
                 logger.log(f'Exception while processing line, skipping line: {exc!r}', 'WARNING')
+
+    def modify_pairs(self, batch:List[SentencePair]) -> Iterable[SentencePair]:
+        for pair in batch:
+            try:
+                if pair.alignments is None:
+                    raise ValueError('Line has no alignment info')
+                # Modifiers before this one may have changed the tokens
+                check_alignments(pair.alignments, pair.src, pair.trg)
+                new_src, new_trg, remapped_pairs = self.retokenize(pair.src, pair.trg, pair.alignments)
+                yield SentencePair(new_src.split(), new_trg.split(), remapped_pairs)
+            except Exception as exc:
+                logger.log(f'Exception while processing line, skipping line: {exc!r}', 'WARNING')
+
+    def retokenize(self, src_tokens:TokenList, trg_tokens:TokenList, pairs:List[Pair]) -> Tuple[str, str, List[Pair]]:
+        """Detokenized source and target, and the alignments between their
+        retokenized tokens."""
+        new_src, _, src_mapping = self.src.retokenize(src_tokens)
+        new_trg, _, trg_mapping = self.trg.retokenize(trg_tokens)
+        return new_src, new_trg, remap_alignment_pairs(src_mapping, trg_mapping, pairs)
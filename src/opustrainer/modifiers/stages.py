@@ -0,0 +1,420 @@
+"""Runs the modifier list as a pipeline, with a group of worker processes for
+each modifier.
+
+Every ModifierWorker runs the whole modifier list, so an expensive modifier
+like Tags with `spm_vocab` gets the same share of the workers as a cheap one.
+A PipelineModifierPool makes each modifier a stage of a pipeline, each with
+its own number of worker processes, connected by bounded queues. A chunk
+enters the first stage and comes out of the last one.
+
+All modifiers of a chunk normally draw from one random state, seeded once per
+chunk, or once per line with the philox generator. Each chunk therefore moves
+through the pipeline with the random state the previous stage left it in: one
+for the chunk, or one for the lines that came from each line. The lines are
+then the same as when a single worker runs all modifiers. The state itself is
+about 3.7 KB pickled, more than the lines, so instead the seed is passed on
+with the number of 32-bit words drawn since, and each stage seeds again and
+draws them once more. See `save_state()`.
+
+How busy the workers of each stage were is logged with the other statistics
+of the pool, so the workers can be rebalanced.
+"""
+import concurrent.futures
+import logging
+import multiprocessing
+import queue
+import random
+import signal
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from logging.handlers import QueueHandler, QueueListener
+from multiprocessing import Queue
+from typing import Any, Dict, List, Optional, Tuple
+
+from opustrainer import logger
+from opustrainer.modifiers import Modifier
+from opustrainer.modifiers.pool import Job, ChunkSeed, POLL_INTERVAL, START_METHODS, FORKSERVER_PRELOAD
+from opustrainer.modifiers.backends import ExecutorModifierPool
+from opustrainer.pipeline import spawn_lock
+
+
+# Chunks waiting in the queue of a stage, per worker of that stage, if not given
+DEFAULT_QUEUE_PER_WORKER = 2
+
+# Number of 32-bit words in the state of the Mersenne Twister behind `random`,
+# which it draws them from until it computes the next ones
+STATE_WORDS = 624
+
+# Times the next words may have been computed before a group carries its whole
+# random state instead of the number of words drawn, which takes longer to
+# find and to draw again
+MAX_REFILLS = 4
+
+# Random state of a group between two stages: the seed and the number of
+# 32-bit words drawn since, or what `random.getstate()` gave if it could not be
+# told apart that way.
+GroupState = Tuple[Any, ...]
+
+# Lines of a chunk between two stages, in groups that each continue from their
+# own random state: one group for a chunk seeded once, one per line of the
+# original chunk if seeded per line.
+Groups = List[Tuple[List[str], GroupState]]
+
+
+def save_state(previous:GroupState) -> GroupState:
+    """The current random state, which continues from `previous`, as the seed of
+    `previous` and the number of words drawn since it was seeded."""
+    state = random.getstate()
+    _, words, gauss_next = state
+    # Only a seed can be carried on, and gauss() keeps a number of its own
+    if len(previous) != 2 or gauss_next is not None:
+        return state
+    seed, _ = previous
+    reference = random.Random(seed)
+    if reference.getstate()[1] == words:
+        return seed, 0
+    # Last is the position of the next word in the others
+    position = words[-1]
+    for refills in range(MAX_REFILLS):
+        reference.getrandbits(32 * STATE_WORDS)
+        if reference.getstate()[1][:-1] == words[:-1]:
+            return seed, refills * STATE_WORDS + position
+    return state
+
+
+def restore_state(state:GroupState) -> None:
+    """Sets the random state to one saved by `save_state()`."""
+    if len(state) != 2:
+        random.setstate(state)
+        return
+    seed, drawn = state
+    random.seed(seed)
+    if drawn > 0:
+        random.getrandbits(32 * drawn)
+
+
+def start_groups(lines:List[str], seed:ChunkSeed) -> Groups:
+    """Seeds a chunk the same way `apply_modifiers()` does."""
+    if isinstance(seed, tuple):
+        key, offset = seed
+        return [([line], (key.line_seed(line_no), 0)) for line_no, line in enumerate(lines, start=offset)]
+    return [(lines, (seed, 0))]
+
+
+def run_groups(modifiers:List[Modifier], groups:Groups) -> Groups:
+    """Runs each group through the modifiers, continuing from its random state."""
+    output = []
+    for lines, state in groups:
+        restore_state(state)
+        for modifier in modifiers:
+            lines = list(modifier(lines))
+        output.append((lines, save_state(state)))
+    return output
+
+
+@dataclass
+class StageCounters:
+    """Work done by the workers of a stage, shared with the pool"""
+    busy: Any # multiprocessing.Value of the seconds spent modifying, of all workers together
+    chunks: Any # multiprocessing.Value of the number of chunks done
+
+
+class StageWorker:
+    """Runs chunks through the modifiers of one stage of the pipeline, and
+    hands them to the next. Its `run()` is the target of a worker process."""
+    modifiers: List[Modifier]
+    first: bool
+    last: bool
+    tasks: Queue
+    output: Queue
+    results: Queue
+    messages: Queue
+    loglevel: int
+    counters: StageCounters
+
+    def __init__(self, modifiers:List[Modifier], first:bool, last:bool, tasks:Queue, output:Queue, results:Queue,
+                 messages:Queue, loglevel:int, counters:StageCounters):
+        self.modifiers = modifiers
+        self.first = first
+        self.last = last
+        self.tasks = tasks
+        self.output = output
+        self.results = results
+        self.messages = messages
+        self.loglevel = loglevel
+        self.counters = counters
+
+    def run(self):
+        # Ctrl-c is handled by the main process, which will tell us to stop.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        logging.getLogger().addHandler(QueueHandler(self.messages))
+        logging.getLogger().setLevel(self.loglevel)
+
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+
+            chunk, data = task
+            started = time.perf_counter()
+            try:
+                groups = run_groups(self.modifiers, start_groups(*data) if self.first else data)
+                busy = time.perf_counter() - started
+                if self.last:
+                    self.output.put((chunk, [line for lines, _ in groups for line in lines], None))
+                else:
+                    self.output.put((chunk, groups))
+            except Exception as exc:
+                busy = time.perf_counter() - started
+                # Straight to the pool, past the other stages
+                self.results.put((chunk, None, exc))
+            with self.counters.busy.get_lock():
+                self.counters.busy.value += busy
+            with self.counters.chunks.get_lock():
+                self.counters.chunks.value += 1
+
+        self.output.close()
+        self.results.close()
+
+
+class ModifierPipeline:
+    """Worker processes for each modifier of a list, and the queues between
+    them. Chunks are submitted with `submit()`, which returns a future of the
+    modified lines."""
+
+    """The modifier list, one stage per modifier"""
+    modifiers: List[Modifier]
+
+    """Number of workers of each stage"""
+    workers: List[int]
+
+    def __init__(self, context:Any, modifiers:List[Modifier], workers:List[int], queue_sizes:List[int]):
+        self.modifiers = modifiers
+        self.workers = workers
+        self.queues: List[Queue] = [context.Queue(maxsize=size) for size in queue_sizes]
+        self.results: Queue = context.Queue()
+        self.messages: Queue = context.Queue()
+        self.counters = [StageCounters(context.Value('d', 0.0), context.Value('q', 0)) for _ in modifiers]
+        self.processes: List[List[multiprocessing.process.BaseProcess]] = [
+            [
+                context.Process(
+                    target=StageWorker([modifier], index == 0, index == len(modifiers) - 1,
+                                       self.queues[index], self.queues[index + 1] if index + 1 < len(modifiers) else self.results,
+                                       self.results, self.messages, logging.getLogger().level, self.counters[index]).run,
+                    daemon=True)
+                for _ in range(count)
+            ]
+            for index, (modifier, count) in enumerate(zip(modifiers, workers))
+        ]
+        self.broken = False
+        # Why it broke, for the chunks submitted after that
+        self._error: Optional[Exception] = None
+        self._stopping = False
+        self._futures: Dict[int, Future] = {}
+        self._next = 0
+        self._lock = threading.Lock()
+
+        self.log_worker = QueueListener(self.messages, *logging.getLogger().handlers, respect_handler_level=True)
+        self.log_worker.start()
+
+        with spawn_lock:
+            for process in self._all_processes():
+                process.start()
+        self.started = time.monotonic()
+
+        self._collector = threading.Thread(target=self._collect, name='pipeline', daemon=True)
+        self._collector.start()
+
+    def _all_processes(self) -> List[multiprocessing.process.BaseProcess]:
+        return [process for processes in self.processes for process in processes]
+
+    def _fail(self, exc:Exception) -> None:
+        with self._lock:
+            if not self.broken:
+                self.broken = True
+                self._error = exc
+            futures, self._futures = self._futures, {}
+        for future in futures.values():
+            future.set_exception(exc)
+
+    def _collect(self) -> None:
+        """Resolves the futures of the chunks that come out of the pipeline."""
+        while True:
+            try:
+                item = self.results.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                dead = [process for process in self._all_processes() if process.exitcode is not None]
+                if dead and not self._stopping:
+                    self._fail(RuntimeError(f'Modifier pipeline worker {dead[0].pid} died with exit code {dead[0].exitcode}'))
+                if self.broken:
+                    return
+                continue
+            if item is None:
+                return
+            chunk, result, exc = item
+            with self._lock:
+                future = self._futures.pop(chunk, None)
+            if future is None:
+                continue # already failed
+            if exc is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+    def submit(self, lines:List[str], seed:ChunkSeed) -> Future:
+        future: Future = Future()
+        # Running from the moment it is in the pipeline, and can't be cancelled
+        future.set_running_or_notify_cancel()
+        # Checked together with registering it, so _fail() either fails it or
+        # has already marked the pipeline broken
+        with self._lock:
+            if self.broken:
+                future.set_exception(RuntimeError('Modifier pipeline is broken') if self._error is None else self._error)
+                return future
+            chunk = self._next
+            self._next += 1
+            self._futures[chunk] = future
+        while not self.broken:
+            try:
+                self.queues[0].put((chunk, (lines, seed)), timeout=POLL_INTERVAL)
+                break
+            except queue.Full:
+                continue
+        return future
+
+    def utilisation(self) -> List[Tuple[float, int]]:
+        """Fraction of the time the workers of each stage were busy, and the
+        number of chunks each stage did."""
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return [
+            (counters.busy.value / (elapsed * workers), counters.chunks.value)
+            for counters, workers in zip(self.counters, self.workers)
+        ]
+
+    def log(self, loglevel:str="INFO") -> None:
+        for index, ((busy, chunks), modifier, workers) in enumerate(zip(self.utilisation(), self.modifiers, self.workers)):
+            logger.log(f"Modifier stage {index} ({type(modifier).__name__}), {workers} workers: {busy:.0%} busy, {chunks} chunks", loglevel=loglevel)
+
+    def shutdown(self, wait:bool=True) -> None:
+        """Stops the workers, stage by stage so every chunk gets through, or
+        right away if not `wait`."""
+        self._stopping = True
+        if wait and not self.broken:
+            for processes, tasks in zip(self.processes, self.queues):
+                for _ in processes:
+                    tasks.put(None)
+                for process in processes:
+                    process.join()
+            self.results.put(None)
+            self._collector.join()
+            self.log_worker.stop()
+            self.messages.close()
+        else:
+            self._fail(RuntimeError('Modifier pipeline was stopped'))
+            for process in self._all_processes():
+                if process.is_alive():
+                    process.kill()
+                process.join()
+            self._collector.join(timeout=2 * POLL_INTERVAL)
+            for shared_queue in [*self.queues, self.results, self.messages]:
+                shared_queue.cancel_join_thread()
+        for shared_queue in [*self.queues, self.results]:
+            shared_queue.close()
+
+
+class PipelineModifierPool(ExecutorModifierPool):
+    """Same as ModifierPool, but with the modifiers as a pipeline of stages,
+    each with `stage_workers[name]` worker processes for modifiers whose class
+    is called `name`, and 1 for the others.
+
+    A new modifier list gets a new pipeline, once all chunks have come out of
+    the old one."""
+
+    """Number of workers for the stages of each modifier class, by class name"""
+    stage_workers: Dict[str, int]
+
+    """How the worker processes are started, one of START_METHODS"""
+    start_method: str
+
+    """Chunks waiting in the queue of each stage, per worker, 0 for the default"""
+    queue_size: int
+
+    kind = 'pipeline'
+
+    def __init__(self, modifiers:List[Modifier], stage_workers:Dict[str,int], max_inflight:int=0, chunk_timeout:float=0,
+                 start_method:str='fork', queue_size:int=0):
+        if start_method not in START_METHODS:
+            raise ValueError(f'unknown start method {start_method}, choose from {", ".join(START_METHODS)}')
+        self._pipeline: Optional[ModifierPipeline] = None
+        super().__init__(modifiers, 1, max_inflight, chunk_timeout)
+        self.stage_workers = stage_workers
+        self.start_method = start_method
+        self.queue_size = queue_size
+        self._submitted: List[Future] = []
+        # Seconds spent on chunks by the workers of earlier pipelines
+        self._retired_busy = 0.0
+
+    @property
+    def _broken(self) -> bool:
+        """Set once a chunk got stuck, or the pipeline broke because one of its
+        workers died, after which its chunks are not waited for."""
+        return self._stuck or (self._pipeline is not None and self._pipeline.broken)
+
+    @_broken.setter
+    def _broken(self, value:bool) -> None:
+        self._stuck = value
+
+    def _build(self) -> ModifierPipeline:
+        workers = [max(self.stage_workers.get(type(modifier).__name__, 1), 1) for modifier in self.modifiers]
+        queue_sizes = [(self.queue_size or DEFAULT_QUEUE_PER_WORKER) * count for count in workers]
+        self.workers = sum(workers)
+        return ModifierPipeline(self._context, self.modifiers, workers, queue_sizes)
+
+    def __enter__(self) -> 'PipelineModifierPool':
+        self._context = multiprocessing.get_context(self.start_method)
+        if self.start_method == 'forkserver':
+            self._context.set_forkserver_preload(FORKSERVER_PRELOAD)
+        if self.modifiers:
+            self._pipeline = self._build()
+        return self
+
+    def __exit__(self, *args):
+        if self._pipeline is not None:
+            self._pipeline.shutdown(wait=not self._broken)
+
+    def log_stats(self, loglevel:str="INFO") -> None:
+        super().log_stats(loglevel)
+        if self._pipeline is not None:
+            self._pipeline.log(loglevel)
+
+    def busy_time(self) -> Optional[float]:
+        busy = self._retired_busy
+        if self._pipeline is not None:
+            busy += sum(counters.busy.value for counters in self._pipeline.counters)
+        return busy
+
+    def _run_chunk(self, lines:List[str], seed:ChunkSeed) -> Future:
+        if self._pipeline is None or self._pipeline.modifiers is not self.modifiers:
+            # The chunks in the old pipeline were submitted with its modifiers
+            concurrent.futures.wait(self._submitted)
+            if self._pipeline is not None:
+                self._pipeline.log("DEBUG")
+                self._pipeline.shutdown()
+                self._retired_busy += sum(counters.busy.value for counters in self._pipeline.counters)
+            self._pipeline = self._build() if self.modifiers else None
+        self._submitted = [future for future in self._submitted if not future.done()]
+
+        if self._pipeline is None:
+            # Nothing to run, but seeded all the same
+            future: Future = Future()
+            future.set_result(list(lines))
+        else:
+            future = self._pipeline.submit(lines, seed)
+            self._submitted.append(future)
+        return self._submit(future, len(lines))
+
+    def _run_job(self, job:Job) -> Future:
+        raise ValueError('a modifier pipeline only modifies lines read by the trainer')
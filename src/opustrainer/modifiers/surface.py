@@ -1,24 +1,33 @@
-import random
 from typing import Callable, Type, List, Iterable
 
-from opustrainer.modifiers import Modifier
+from opustrainer.modifiers import LineModifier, PairModifier
+from opustrainer.types import SentencePair
 
 
-class TitleCaseModifier(Modifier):
+def title_case(tokens:List[str]) -> List[str]:
+    return [word[0].upper() + word[1:] for word in tokens]
+
+
+class TitleCaseModifier(LineModifier, PairModifier):
     """Applies titlecase to a sentence. Beware of tabs as src and trg separator
     """
-    def __call__(self, batch:List[str]) -> Iterable[str]:
-        for line in batch:
-            if self.probability <= random.random():
-                yield line
-            else:
-                sections: List[str] = line.split('\t')
-                for i in range(len(sections)):
-                    sections[i] = ' '.join([word[0].upper() + word[1:] for word in sections[i].split()])
-                yield '\t'.join(sections)
-
-
-class UpperCaseModifier(Modifier):
-    def __call__(self, batch:List[str]) -> Iterable[str]:
-        for line in batch:
-            yield line.upper() if self.probability > random.random() else line
+    thread_random = True
+
+    def modify(self, line:str) -> str:
+        sections: List[str] = line.split('\t')
+        for i in range(len(sections)):
+            sections[i] = ' '.join(title_case(sections[i].split()))
+        return '\t'.join(sections)
+
+    def modify_pair(self, pair:SentencePair) -> SentencePair:
+        return pair._replace(src=title_case(pair.src), trg=title_case(pair.trg))
+
+
+class UpperCaseModifier(LineModifier, PairModifier):
+    thread_random = True
+
+    def modify(self, line:str) -> str:
+        return line.upper()
+
+    def modify_pair(self, pair:SentencePair) -> SentencePair:
+        return pair._replace(src=[token.upper() for token in pair.src], trg=[token.upper() for token in pair.trg])
@@ -0,0 +1,150 @@
+"""Moves chunks of lines between the trainer and the modifier workers through
+shared memory, instead of pickling them through a multiprocessing.Queue.
+
+Each side that sends lines owns a ring buffer in a shared memory segment: the
+trainer one for the chunks it sends to the workers, and each worker one for the
+chunks it sends back. The lines of a chunk are joined with newlines, encoded
+as UTF-8 and copied into the ring, and only a small Block describing where
+they are goes through the queue. The receiver decodes them and hands the space
+back by moving the tail of the ring past them.
+
+If a chunk does not fit in the free space of the ring, or one of its lines
+contains a newline, it is sent through the queue as a list instead.
+"""
+from collections import deque
+from dataclasses import dataclass
+from multiprocessing.shared_memory import SharedMemory
+from typing import Deque, List, NamedTuple, Optional, Set, Tuple, Union
+
+from opustrainer import logger
+
+
+TRANSPORTS = ('queue', 'shm')
+
+# Size of each ring buffer. Shared memory is only backed by memory once it is
+# written to, so most of this is never allocated for small batches.
+DEFAULT_RING_SIZE = 16 * 2**20
+
+
+class Block(NamedTuple):
+    """Location of a chunk of lines in a shared memory segment."""
+    segment: int # index of the segment, for the rings of the workers
+    offset: int
+    length: int
+    lines: int
+    release: int # position to move the tail of the ring to once read
+
+
+# Lines of a chunk as sent through the queue: either the lines themselves, or
+# where to find them in shared memory.
+Payload = Union[List[str], Block]
+
+
+def pack_lines(lines:List[str]) -> Optional[bytes]:
+    """Encodes lines as a newline separated block, or returns None if that
+    would not decode to the same lines."""
+    joined = '\n'.join(lines)
+    if joined.count('\n') != max(len(lines) - 1, 0):
+        return None
+    return joined.encode('utf-8')
+
+
+def unpack_lines(data:memoryview, lines:int) -> List[str]:
+    if lines == 0:
+        return []
+    return str(data, 'utf-8').split('\n')
+
+
+class Ring:
+    """Hands out space for blocks in a shared memory segment. Blocks are
+    contiguous, and space is handed back in the order it was handed out, by
+    moving the tail past it. Positions only ever grow; the offset in the
+    segment is the position modulo its size."""
+    size: int
+    head: int
+
+    def __init__(self, size:int):
+        self.size = size
+        self.head = 0
+
+    def reserve(self, length:int, tail:int) -> Optional[Tuple[int,int]]:
+        """Offset of `length` free bytes and the position that releases them,
+        or None if they don't fit right now."""
+        start = self.head
+        # Blocks don't wrap around, skip to the start of the segment instead
+        if start % self.size + length > self.size:
+            start += self.size - start % self.size
+        end = start + length
+        if end - tail > self.size:
+            return None
+        self.head = end
+        return start % self.size, end
+
+
+class OrderedRing(Ring):
+    """Ring whose blocks can be released in any order. The tail only moves
+    past blocks once all blocks before them are released too."""
+    tail: int
+
+    def __init__(self, size:int):
+        super().__init__(size)
+        self.tail = 0
+        self._reserved: Deque[int] = deque()
+        self._released: Set[int] = set()
+
+    def reserve(self, length:int, tail:Optional[int]=None) -> Optional[Tuple[int,int]]:
+        space = super().reserve(length, self.tail)
+        if space is not None:
+            self._reserved.append(space[1])
+        return space
+
+    def release(self, end:int) -> None:
+        self._released.add(end)
+        while self._reserved and self._reserved[0] in self._released:
+            self.tail = self._reserved.popleft()
+            self._released.remove(self.tail)
+
+
+@dataclass
+class TransportStats:
+    """Number of chunks and bytes moved between the trainer and the workers, in
+    both directions, and how long the trainer waited for them."""
+    chunks: int = 0
+    lines: int = 0
+    shared_bytes: int = 0
+    queued_chunks: int = 0
+    # Chunks sent to the workers whose results have not come back yet
+    inflight: int = 0
+    peak_inflight: int = 0
+    # Seconds spent waiting for results from the workers
+    stall_time: float = 0.0
+    # Times the workers were replaced because one died, and the number of
+    # chunks that were sent again because of it
+    restarts: int = 0
+    redispatched: int = 0
+
+    def log(self, loglevel:str="INFO") -> None:
+        logger.log(f"Moved {self.chunks} chunks ({self.lines} lines) between trainer and modifier workers: "
+                   f"{self.shared_bytes} bytes through shared memory, {self.queued_chunks} chunks through the queue", loglevel=loglevel)
+        logger.log(f"Modifier workers: {self.inflight} chunks in flight, at most {self.peak_inflight}; "
+                   f"waited {self.stall_time:.2f}s for results", loglevel=loglevel)
+        if self.restarts:
+            logger.log(f"Modifier workers were replaced {self.restarts} times, sending {self.redispatched} chunks again", loglevel=loglevel)
+
+
+def write_block(shm:SharedMemory, ring:Ring, segment:int, lines:List[str], tail:int) -> Optional[Block]:
+    """Copies lines into the ring, or returns None if they should go through
+    the queue instead."""
+    data = pack_lines(lines)
+    if data is None:
+        return None
+    space = ring.reserve(len(data), tail)
+    if space is None:
+        return None
+    offset, end = space
+    shm.buf[offset:offset + len(data)] = data
+    return Block(segment, offset, len(data), len(lines), end)
+
+
+def read_block(shm:SharedMemory, block:Block) -> List[str]:
+    return unpack_lines(shm.buf[block.offset:block.offset + block.length], block.lines)
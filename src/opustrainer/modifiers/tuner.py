@@ -0,0 +1,189 @@
+"""Adjusts the chunk size and the number of active modifier workers while
+running, for each stage on its own.
+
+Which settings work best depends on the modifiers: a stage with Tags and
+`spm_vocab` wants all workers and small chunks, a stage with only UpperCase
+larger chunks that cost the trainer less to send. Every few seconds the tuner
+looks at where the time went since its last decision:
+
+- waiting for the trainer program to take the batches,
+- waiting for the workers to send back chunks,
+- in opustrainer itself, reading and sending the lines,
+
+and how busy the workers were, and changes one setting, within its bounds.
+
+Fewer active workers means fewer chunks in flight: at most one per active
+worker. With the philox generator, the batches don't depend on either setting,
+so the tuner can only change how fast they come. Without it, the chunk size
+decides which random numbers go to which lines, so the tuner is not used.
+"""
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, Optional, Union
+
+from opustrainer import logger
+from opustrainer.modifiers.pool import ModifierPool, count_chunks
+
+if TYPE_CHECKING:
+    from opustrainer.modifiers.backends import ExecutorModifierPool
+
+# Pools the tuner can adjust
+TunablePool = Union[ModifierPool, 'ExecutorModifierPool']
+
+
+# Minimum number of seconds between decisions
+DEFAULT_INTERVAL = 5.0
+
+# Fractions of the time above which the trainer program, waiting for the
+# workers, or opustrainer itself is considered the bottleneck
+CONSUMER_BOUND = 0.5
+STALL_BOUND = 0.3
+MAIN_BOUND = 0.5
+
+# Fraction of the time workers may be busy while we wait for them before we
+# suspect the chunks are too small to be worth sending
+IDLE_WORKERS = 0.5
+
+
+@dataclass
+class TunerSettings:
+    """Chunk size and number of active workers of a stage"""
+    chunk_size: int
+    workers: int
+
+
+@dataclass(frozen=True)
+class TunerWindow:
+    """Where the time went since the last decision, as fractions of it"""
+    seconds: float
+    consumer: float
+    stall: float
+    main: float
+    # Fraction of the time the active workers were busy, if the pool knows
+    utilisation: Optional[float]
+
+    def describe(self) -> str:
+        busy = f', workers {self.utilisation:.0%} busy' if self.utilisation is not None else ''
+        return f"trainer {self.consumer:.0%}, waiting for workers {self.stall:.0%}, opustrainer {self.main:.0%}{busy}"
+
+
+class Autotuner:
+    """Picks the chunk size and number of active workers for each stage, and
+    applies them to a pool. Call `start_stage()` when a stage starts, and
+    `batch_done()` after each batch, with the time spent waiting for the
+    trainer to take it."""
+
+    """Bounds of the chunk size and the number of workers"""
+    min_chunk_size: int
+    max_chunk_size: int
+    min_workers: int
+    max_workers: int
+
+    """Minimum number of seconds between decisions"""
+    interval: float
+
+    """Settings of the current stage"""
+    settings: TunerSettings
+
+    def __init__(self, chunk_size:int, workers:int, batch_size:int, *, interval:float=DEFAULT_INTERVAL,
+                 min_chunk_size:int=1, max_chunk_size:Optional[int]=None, min_workers:int=1):
+        self.batch_size = batch_size
+        self.min_chunk_size = max(min_chunk_size, 1)
+        self.max_chunk_size = max(max_chunk_size if max_chunk_size is not None else batch_size, self.min_chunk_size)
+        self.min_workers = max(min_workers, 1)
+        self.max_workers = max(workers, self.min_workers)
+        self.interval = interval
+        self.initial = TunerSettings(min(max(chunk_size, self.min_chunk_size), self.max_chunk_size), self.max_workers)
+        self.settings = TunerSettings(self.initial.chunk_size, self.initial.workers)
+        self.stage: Optional[str] = None
+        # Settings of the stages seen so far, to pick up where they left off
+        self._stages: Dict[str, TunerSettings] = {}
+        # The pool's own limit on chunks in flight, used with all workers active
+        self._max_inflight: Optional[int] = None
+        self._reset(None)
+
+    def _reset(self, pool:Optional[TunablePool]) -> None:
+        self._started = time.monotonic()
+        self._consumer = 0.0
+        self._stall = pool.stats.stall_time if pool is not None else 0.0
+        self._busy = pool.busy_time() if pool is not None else None
+
+    @property
+    def chunk_size(self) -> int:
+        return self.settings.chunk_size
+
+    def start_stage(self, name:str, pool:TunablePool) -> None:
+        """Switches to the settings of stage `name`, and applies them to
+        `pool`, which runs its modifiers."""
+        if self.stage is not None:
+            self._stages[self.stage] = self.settings
+        self.stage = name
+        self.settings = self._stages.get(name, TunerSettings(self.initial.chunk_size, self.initial.workers))
+        if self._max_inflight is None:
+            self._max_inflight = pool.max_inflight
+        self._apply(pool)
+        self._reset(pool)
+
+    def _apply(self, pool:TunablePool) -> None:
+        pool.max_inflight = self._max_inflight if self.settings.workers >= self.max_workers else self.settings.workers
+
+    def measure(self, pool:TunablePool) -> TunerWindow:
+        """Where the time went since the last decision."""
+        seconds = max(time.monotonic() - self._started, 1e-9)
+        consumer = min(self._consumer / seconds, 1.0)
+        stall = min((pool.stats.stall_time - self._stall) / seconds, 1.0 - consumer)
+        busy = pool.busy_time()
+        utilisation = None
+        if busy is not None and self._busy is not None:
+            utilisation = min((busy - self._busy) / (seconds * self.settings.workers), 1.0)
+        return TunerWindow(seconds, consumer, stall, 1.0 - consumer - stall, utilisation)
+
+    def decide(self, window:TunerWindow) -> Optional[str]:
+        """Changes the settings based on `window`, and says why, or returns None
+        if they are fine as they are."""
+        settings = self.settings
+        # Chunks of each batch there would be to go round the active workers
+        fits = lambda chunk_size, workers: count_chunks(self.batch_size, chunk_size) >= workers
+
+        if window.consumer > CONSUMER_BOUND and settings.workers > self.min_workers:
+            settings.workers -= 1
+            return "the trainer is the bottleneck, leaving it a CPU"
+
+        if window.stall > STALL_BOUND:
+            if window.utilisation is not None and window.utilisation < IDLE_WORKERS \
+                    and settings.chunk_size * 2 <= self.max_chunk_size and fits(settings.chunk_size * 2, settings.workers):
+                settings.chunk_size *= 2
+                return "waiting for workers that are mostly idle, sending larger chunks"
+            if settings.workers < self.max_workers:
+                settings.workers += 1
+                return "waiting for the workers, adding one"
+            if not fits(settings.chunk_size, settings.workers) and settings.chunk_size // 2 >= self.min_chunk_size:
+                settings.chunk_size //= 2
+                return "waiting for the workers, splitting batches into more chunks"
+            return None
+
+        if window.main > MAIN_BOUND and settings.chunk_size * 2 <= self.max_chunk_size \
+                and fits(settings.chunk_size * 2, settings.workers):
+            settings.chunk_size *= 2
+            return "opustrainer is the bottleneck, sending larger chunks"
+
+        return None
+
+    def batch_done(self, pool:TunablePool, consumer:float) -> None:
+        """Counts `consumer` seconds spent waiting for the trainer to take a
+        batch, and once `interval` has passed, decides on new settings for the
+        stage and applies them to `pool`."""
+        self._consumer += consumer
+        if time.monotonic() - self._started < self.interval:
+            return
+        window = self.measure(pool)
+        before = TunerSettings(self.settings.chunk_size, self.settings.workers)
+        reason = self.decide(window)
+        if reason is not None:
+            self._apply(pool)
+            logger.log(f"Stage {self.stage}: {window.describe()}; {reason}: chunk size {before.chunk_size} -> {self.settings.chunk_size}, "
+                       f"{before.workers} -> {self.settings.workers} active workers")
+        else:
+            logger.log(f"Stage {self.stage}: {window.describe()}; keeping chunk size {self.settings.chunk_size} "
+                       f"and {self.settings.workers} active workers", loglevel="DEBUG")
+        self._reset(pool)
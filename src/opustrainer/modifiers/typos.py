@@ -146,6 +146,8 @@ class TypoModifier(Modifier):
 
     probabilities: Dict[str,float]
 
+    # Not thread_random: typo.StrErrer seeds the random module and draws from it
+
     def __init__(self, probability:float, **probabilities:float):
         """
         Apply typo modifiers to the input. If no specific typo modifiers are
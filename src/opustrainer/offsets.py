@@ -0,0 +1,151 @@
+"""Reading the lines of the shuffled datasets in the modifier workers.
+
+By default the trainer reads every line of the shuffled datasets, checks it,
+and sends it to the modifier workers. With `--read-by-offset`, the shuffler
+also writes the offset of each line, and the trainer only decides which lines
+go into a batch: for each dataset a range of bytes in its shuffled file. A
+worker reads and checks those lines itself, modifies them, shuffles the batch
+and sends back the finished batch as one block of bytes.
+
+The lines that are skipped because they are not well formed are then only
+skipped once the batch is read, which makes the batch that much smaller
+instead of taking the next line of the dataset.
+"""
+import io
+import mmap
+import os
+import threading
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from opustrainer import logger
+from opustrainer.iohints import fadvise
+from opustrainer.modifiers import Modifier
+from opustrainer.modifiers.pool import Job, BatchSeed, apply_modifiers, batch_seeding, count_chunks
+
+
+def check_line(line:str, num_fields:Optional[int], dataset:str) -> Optional[str]:
+    """Returns the line if it is well formed, cut down to `num_fields` fields
+    if there are more, or None if it should be skipped."""
+    # We can't call the function inside the string format prior to python 3.12
+    # so we will have it here instead so that we can refer to it when logging if necessary.
+    original_line: str = line.rstrip('\r\n')
+
+    # Assert that the line is well formed, meaning non of the fields is the empty string
+    fields: List[str] = original_line.split('\t')
+    if any(field == '' for field in fields):
+        logger.log_once(f"[Trainer] Empty field in {dataset} line: \"{original_line}\", skipping...", loglevel="WARNING")
+        return None
+
+    # Try to see if we have the right number of fields and remove lines
+    # that don't have all the fields or remove extra fields.
+    if num_fields is not None:
+        if len(fields) > num_fields:
+            return '\t'.join(fields[:num_fields]) + '\n'
+        elif len(fields) < num_fields:
+            logger.log_once(f"[Trainer] Expected {num_fields} fields in {dataset} line: \"{original_line}\" but only got {len(fields)}, skipping...", loglevel="WARNING")
+            return None
+
+    return line
+
+
+@dataclass(frozen=True)
+class LineRange:
+    """Consecutive lines of a shuffled dataset, as the bytes `start` up to
+    `end` of its file."""
+    dataset: str
+    path: str
+    start: int
+    end: int
+    num_fields: Optional[int]
+
+    def read(self) -> List[str]:
+        """The well formed lines in the range, without their line ending."""
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            data = os.pread(fd, self.end - self.start, self.start)
+            # Each range is read only once
+            fadvise(fd, self.start, self.end - self.start, 'DONTNEED')
+        finally:
+            os.close(fd)
+
+        # Read it the same way the trainer reads the shuffled file
+        lines = []
+        for line in io.TextIOWrapper(io.BytesIO(data), encoding='utf-8'):
+            checked = check_line(line, self.num_fields, self.dataset)
+            if checked is not None:
+                lines.append(checked.rstrip('\r\n'))
+        return lines
+
+
+class EpochFile:
+    """Shuffled file of a dataset for one epoch, and the offsets of its lines.
+    It is removed once the reader has moved on to the next epoch and none of
+    its ranges are still being read."""
+    path: str
+    lines: int
+
+    def __init__(self, path:str, index:str):
+        self.path = path
+        with open(index, 'rb') as fh:
+            self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        os.unlink(index)
+        self._offsets = memoryview(self._map).cast('Q')
+        self.lines = len(self._offsets) - 1
+        # Ranges handed out and not released yet. Ranges are handed out by the
+        # thread reading, and released by the one modifying.
+        self._refs = 0
+        self._retired = False
+        self._lock = threading.Lock()
+
+    @property
+    def removed(self) -> bool:
+        return self._map.closed
+
+    def range(self, dataset:str, line:int, count:int, num_fields:Optional[int]) -> LineRange:
+        with self._lock:
+            self._refs += 1
+        return LineRange(dataset, self.path, self._offsets[line], self._offsets[line + count], num_fields)
+
+    def release(self) -> None:
+        with self._lock:
+            self._refs -= 1
+            if self._retired and self._refs == 0:
+                self.remove()
+
+    def retire(self) -> None:
+        with self._lock:
+            self._retired = True
+            if self._refs == 0:
+                self.remove()
+
+    def remove(self) -> None:
+        if self.removed:
+            return
+        self._offsets.release()
+        self._map.close()
+        os.unlink(self.path)
+
+
+@dataclass(frozen=True)
+class ReadJob(Job):
+    """Reads the lines of a batch, modifies them in chunks of `chunk_size` the
+    same way ModifierPool does, and shuffles the batch."""
+    ranges: Tuple[LineRange, ...]
+    seed: BatchSeed
+    chunk_size: int
+    shuffle: bool
+
+    def run(self, modifiers:List[Modifier]) -> bytes:
+        batch = [line for line_range in self.ranges for line in line_range.read()]
+        seeder, shuffle = batch_seeding(self.seed)
+
+        output: List[str] = []
+        for chunk in range(count_chunks(len(batch), self.chunk_size)):
+            lines = batch[chunk * self.chunk_size:(chunk + 1) * self.chunk_size]
+            output.extend(apply_modifiers(modifiers, lines, seeder(chunk, self.chunk_size)))
+
+        if self.shuffle:
+            shuffle(output)
+
+        return ('\n'.join(output) + '\n').encode('utf-8') if output else b''
@@ -0,0 +1,74 @@
+"""Helpers to run the stages of the trainer (reading, modifying, writing) in
+parallel, connected by bounded queues."""
+import subprocess
+from queue import Queue, Full
+from threading import Thread, Event, Lock
+from typing import Iterable, Iterator, TypeVar, Optional, Tuple, Any
+
+
+T = TypeVar('T')
+
+# Held while starting child processes. When one thread forks a worker process
+# while another is inside subprocess.Popen, the worker inherits the pipe Popen
+# uses to wait for exec(), and Popen blocks until that worker exits.
+spawn_lock = Lock()
+
+# Sentinel that marks the end of the stream in the queue
+_END = object()
+
+
+def spawn(*args, **kwargs) -> subprocess.Popen:
+    """subprocess.Popen, but safe to call while other threads start processes."""
+    with spawn_lock:
+        return subprocess.Popen(*args, **kwargs)
+
+
+def threaded(iterable:Iterable[T], maxsize:int=1, *, name:Optional[str]=None) -> Iterator[T]:
+    """Iterates over `iterable` in a background thread, keeping at most
+    `maxsize` items ready in a queue. Exceptions raised by the iterable are
+    re-raised in the consuming thread. Closing the returned generator stops the
+    background thread, and closes `iterable` from that thread if it is a
+    generator.
+    """
+    queue: "Queue[Tuple[Any, Optional[BaseException]]]" = Queue(maxsize=max(maxsize, 1))
+    stop = Event()
+
+    def put(item:Tuple[Any, Optional[BaseException]]) -> bool:
+        # Poll the stop event so we don't block forever on a full queue that
+        # nobody will read from anymore.
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def worker() -> None:
+        it = iter(iterable)
+        try:
+            for item in it:
+                if not put((item, None)):
+                    return
+            put((_END, None))
+        except BaseException as exc:
+            put((_END, exc))
+        finally:
+            close = getattr(it, 'close', None)
+            if close is not None:
+                close()
+
+    thread = Thread(target=worker, name=name, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item, exc = queue.get()
+            if exc is not None:
+                raise exc
+            if item is _END:
+                break
+            yield item
+    finally:
+        stop.set()
+        thread.join()
@@ -0,0 +1,92 @@
+"""Counter-based random numbers for the modifiers.
+
+By default, each chunk of a batch gets a seed from the global random state, and
+all lines in a chunk share one random stream. The modified lines then depend
+on how a batch is cut into chunks, and thus on `--chunk-size`.
+
+With `--rng philox`, every line gets its own stream instead, seeded with the
+output of the Philox4x32-10 counter-based generator [1] for the key
+(curriculum seed) and counter (stage, batch, line). Any line's stream can be
+computed without computing those before it, so the lines come out the same no
+matter which worker processes them, in which chunk, and in which order. The
+state needed to continue is just the position in the curriculum, which the
+training state already contains.
+
+The modifiers draw their random numbers from `local_random()`, which is the
+random module, and thus the global random state, unless the calling thread was
+given a random state of its own with `attach_random()`. The threads of a
+ThreadModifierPool each are, so they can seed and modify chunks side by side.
+
+[1] Salmon et al., "Parallel random numbers: as easy as 1, 2, 3", SC 2011.
+"""
+import random
+import threading
+from dataclasses import dataclass
+from typing import Any, Tuple
+
+
+RNG_MODES = ('legacy', 'philox')
+
+MASK32 = 0xFFFFFFFF
+
+PHILOX_M0 = 0xD2511F53
+PHILOX_M1 = 0xCD9E8D57
+PHILOX_W0 = 0x9E3779B9
+PHILOX_W1 = 0xBB67AE85
+
+# Line number used to draw the seed for shuffling the batch itself
+SHUFFLE_LINE = MASK32
+
+# Random state of the threads that were given one
+_thread = threading.local()
+
+
+def local_random() -> Any:
+    """Where modifiers draw random numbers from: the random state of the calling
+    thread if it has one, and the random module otherwise. Either has the
+    methods of random.Random."""
+    return getattr(_thread, 'random', random)
+
+
+def attach_random() -> None:
+    """Gives the calling thread a random state of its own, for `local_random()`."""
+    _thread.random = random.Random()
+
+
+def philox4x32(counter:Tuple[int,int,int,int], key:Tuple[int,int], rounds:int=10) -> Tuple[int,int,int,int]:
+    """Philox4x32 bijection: four 32-bit words of output for four 32-bit words
+    of counter and two of key."""
+    c0, c1, c2, c3 = counter
+    k0, k1 = key
+    for _ in range(rounds):
+        p0 = PHILOX_M0 * c0
+        p1 = PHILOX_M1 * c2
+        c0, c1, c2, c3 = (p1 >> 32) ^ c1 ^ k0, p1 & MASK32, (p0 >> 32) ^ c3 ^ k1, p0 & MASK32
+        k0 = (k0 + PHILOX_W0) & MASK32
+        k1 = (k1 + PHILOX_W1) & MASK32
+    return c0, c1, c2, c3
+
+
+@dataclass(frozen=True)
+class CounterKey:
+    """Position of a batch in the curriculum, from which the seed of each of
+    its lines is derived."""
+    seed: int
+    stage: int
+    batch: int
+
+    def line_seed(self, line:int) -> int:
+        """128-bit seed for the line at index `line` of the batch, as it was
+        read from the datasets."""
+        words = philox4x32(
+            (line & MASK32, self.batch & MASK32, (self.batch >> 32) & MASK32, self.stage & MASK32),
+            (self.seed & MASK32, (self.seed >> 32) & MASK32))
+        return words[0] | words[1] << 32 | words[2] << 64 | words[3] << 96
+
+    def shuffle_seed(self) -> int:
+        """Seed for shuffling the batch after it has been modified."""
+        return self.line_seed(SHUFFLE_LINE)
+
+    def shuffle(self, batch:list) -> None:
+        """Shuffles `batch` in place, without touching the global random state."""
+        random.Random(self.shuffle_seed()).shuffle(batch)
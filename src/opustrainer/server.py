@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""Serves the batches of a trainer to any number of consumers over a Unix
+domain socket, so the datasets are shuffled and modified once per host instead
+of once per consumer.
+
+Every message is a frame with a fixed size header (message type, batch id and
+payload length) followed by the payload. The server sends BATCH frames with
+the UTF-8 encoded, newline terminated lines of a batch as payload, and an END
+frame once all batches have been consumed. Clients send an ACK frame for each
+batch once they've consumed it. A client never has more than `max_inflight`
+batches that it hasn't acknowledged yet, which is what slows the server down
+if the consumers can't keep up. Batches that were not acknowledged when their
+client disconnected are sent to the next client that asks for one.
+
+The training state is saved for the last batch of which it and all batches
+before it have been acknowledged. Resuming from that state may send batches
+that were acknowledged after it again.
+"""
+import os
+import sys
+import socket
+import struct
+import argparse
+
+from collections import OrderedDict
+from threading import Thread, Lock, Condition, Event
+from typing import Dict, Iterator, List, Optional, Tuple, cast
+
+from opustrainer.trainer import Trainer, TrainerState, StateTracker
+from opustrainer import logger
+
+
+# Message type, batch id, payload length
+HEADER = struct.Struct('!BQI')
+
+MSG_BATCH = 1
+MSG_END = 2
+MSG_ACK = 3
+
+
+def send_frame(sock:socket.socket, msg_type:int, batch_id:int=0, payload:bytes=b'') -> None:
+    sock.sendall(HEADER.pack(msg_type, batch_id, len(payload)) + payload)
+
+
+def recv_exactly(sock:socket.socket, size:int) -> Optional[bytes]:
+    """Reads `size` bytes, or returns None if the connection was closed."""
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = sock.recv(size - len(buffer))
+        if not chunk:
+            return None
+        buffer.extend(chunk)
+    return bytes(buffer)
+
+
+def recv_frame(sock:socket.socket) -> Optional[Tuple[int,int,bytes]]:
+    """Reads a frame as (message type, batch id, payload), or returns None if
+    the connection was closed."""
+    header = recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    msg_type, batch_id, length = HEADER.unpack(header)
+    payload = recv_exactly(sock, length) if length > 0 else b''
+    if payload is None:
+        return None
+    return msg_type, batch_id, payload
+
+
+class Dispatcher:
+    """Hands out the batches of a trainer to the connections, and keeps track
+    of which ones have been acknowledged."""
+    def __init__(self, batches:Iterator[Tuple[int,bytes,TrainerState]], state_tracker:Optional[StateTracker]=None):
+        self._batches = batches
+        self._state_tracker = state_tracker
+
+        # Protects reading from `_batches`, which can take a while. Taken
+        # before `_cond` if both are needed.
+        self._producer = Lock()
+        self._cond = Condition()
+
+        # Batches that have been handed out but not acknowledged, in order.
+        # Batch id => (payload, state after batch, acknowledged)
+        self._unacked: "OrderedDict[int,Tuple[bytes,TrainerState,bool]]" = OrderedDict()
+
+        # Batches that need to be handed out again
+        self._redeliver: List[int] = []
+
+        self._exhausted = False
+
+        # State after the last batch that, together with all before it, has
+        # been acknowledged.
+        self.state: Optional[TrainerState] = None
+
+        self.error: Optional[BaseException] = None
+        self.finished = Event()
+
+    def take(self, *, block:bool) -> Optional[Tuple[int,bytes]]:
+        """Next batch to send as (batch id, payload). Returns None if there is
+        no batch available right now and `block` is False, and raises
+        StopIteration once all batches have been acknowledged."""
+        while True:
+            with self._cond:
+                if self._redeliver:
+                    batch_id = self._redeliver.pop(0)
+                    return batch_id, self._unacked[batch_id][0]
+                if self._exhausted:
+                    if not self._unacked or self.error is not None:
+                        raise StopIteration
+                    if not block:
+                        return None
+                    self._cond.wait()
+                    continue
+
+            with self._producer:
+                with self._cond:
+                    if self._exhausted or self._redeliver:
+                        continue
+                try:
+                    batch_id, payload, state = next(self._batches)
+                except StopIteration:
+                    self._finish()
+                    continue
+                except BaseException as exc:
+                    self.error = exc
+                    self._finish()
+                    raise StopIteration
+                with self._cond:
+                    self._unacked[batch_id] = (payload, state, False)
+                return batch_id, payload
+
+    def _finish(self) -> None:
+        with self._cond:
+            self._exhausted = True
+            if not self._unacked or self.error is not None:
+                self.finished.set()
+            self._cond.notify_all()
+
+    def ack(self, batch_id:int) -> None:
+        with self._cond:
+            if batch_id not in self._unacked:
+                return # acknowledged twice, or never sent
+            payload, state, _ = self._unacked[batch_id]
+            self._unacked[batch_id] = (payload, state, True)
+
+            # Move the checkpoint forward past all acknowledged batches
+            advanced = False
+            while self._unacked:
+                first_id, (_, first_state, acked) = next(iter(self._unacked.items()))
+                if not acked:
+                    break
+                del self._unacked[first_id]
+                self.state = first_state
+                advanced = True
+
+            if advanced and self._state_tracker is not None and self._state_tracker.dump and self._state_tracker.due():
+                self._state_tracker.save(cast(TrainerState, self.state))
+
+            if self._exhausted and not self._unacked:
+                self.finished.set()
+                self._cond.notify_all()
+
+    def requeue(self, batch_ids:List[int]) -> None:
+        """Hand out these batches again, e.g. because their client is gone."""
+        with self._cond:
+            self._redeliver = sorted(set(self._redeliver) | {batch_id for batch_id in batch_ids if batch_id in self._unacked})
+            self._cond.notify_all()
+
+
+class BatchServer:
+    """Listens on a Unix domain socket and serves the batches of a trainer to
+    everyone that connects."""
+    path: str
+    max_inflight: int
+
+    def __init__(self, path:str, *, max_inflight:int=4):
+        self.path = path
+        self.max_inflight = max_inflight
+        self._ready = Event()
+
+    def wait_until_ready(self, timeout:Optional[float]=None) -> bool:
+        """Blocks until the server is accepting connections."""
+        return self._ready.wait(timeout)
+
+    def _batches(self, trainer:Trainer, **kwargs) -> Iterator[Tuple[int,bytes,TrainerState]]:
+        for batch in trainer.run(binary=True, **kwargs):
+            state = trainer.state()
+            # state.batch is the number of batches read after this one, which
+            # is also the same across restarts.
+            yield state.batch - 1, cast(bytes, batch), state
+
+    def _serve_client(self, conn:socket.socket, dispatcher:Dispatcher) -> None:
+        inflight: Dict[int,None] = {}
+        try:
+            while True:
+                if len(inflight) < self.max_inflight:
+                    try:
+                        item = dispatcher.take(block=not inflight)
+                    except StopIteration:
+                        send_frame(conn, MSG_END)
+                        return
+                    if item is not None:
+                        batch_id, payload = item
+                        inflight[batch_id] = None
+                        send_frame(conn, MSG_BATCH, batch_id, payload)
+                        continue
+
+                # Wait for the client to acknowledge one of its batches
+                frame = recv_frame(conn)
+                if frame is None:
+                    return
+                msg_type, batch_id, _ = frame
+                if msg_type == MSG_ACK and batch_id in inflight:
+                    del inflight[batch_id]
+                    dispatcher.ack(batch_id)
+        except OSError:
+            pass
+        finally:
+            if inflight:
+                logger.log(f"Client disconnected with {len(inflight)} unacknowledged batches, sending them to other clients", loglevel="DEBUG")
+                dispatcher.requeue(list(inflight))
+            conn.close()
+
+    def serve(self, trainer:Trainer, state_tracker:Optional[StateTracker]=None, **kwargs) -> Optional[TrainerState]:
+        """Serves batches until all of them have been acknowledged. Other
+        keyword arguments are passed to `trainer.run()`. Returns the state
+        after the last acknowledged batch."""
+        if state_tracker is not None:
+            state_tracker.resume(trainer)
+
+        dispatcher = Dispatcher(self._batches(trainer, **kwargs), state_tracker)
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        clients: List[Thread] = []
+        try:
+            server.bind(self.path)
+            server.listen()
+            server.settimeout(0.1)
+            self._ready.set()
+            logger.log(f"Serving batches on {self.path}")
+
+            while not dispatcher.finished.is_set():
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    continue
+                conn.settimeout(None)
+                thread = Thread(target=self._serve_client, args=(conn, dispatcher), daemon=True)
+                thread.start()
+                clients.append(thread)
+
+            # Let the clients that are still connected know we're done
+            for thread in clients:
+                thread.join()
+        finally:
+            server.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            if state_tracker is not None and state_tracker.dump and dispatcher.state is not None:
+                state_tracker.save(dispatcher.state)
+
+        if dispatcher.error is not None:
+            raise dispatcher.error
+
+        return dispatcher.state
+
+
+class BatchClient:
+    """Receives batches from a BatchServer. Iterate over it to get the batches
+    as (batch id, lines), and acknowledge each of them once consumed."""
+    def __init__(self, path:str):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+
+    def __iter__(self) -> Iterator[Tuple[int,bytes]]:
+        while True:
+            frame = recv_frame(self.sock)
+            if frame is None:
+                raise ConnectionError('server closed the connection')
+            msg_type, batch_id, payload = frame
+            if msg_type == MSG_END:
+                return
+            yield batch_id, payload
+
+    def ack(self, batch_id:int) -> None:
+        send_frame(self.sock, MSG_ACK, batch_id)
+
+    def close(self) -> None:
+        self.sock.close()
+
+    def __enter__(self) -> 'BatchClient':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Reads batches from an opustrainer server and writes them to stdout.")
+    parser.add_argument("socket", type=str, help='Path to the Unix domain socket of the server')
+    args = parser.parse_args()
+
+    with BatchClient(args.socket) as client:
+        for batch_id, payload in client:
+            # Only acknowledge once the lines have been handed over
+            sys.stdout.buffer.write(payload)
+            sys.stdout.buffer.flush()
+            client.ack(batch_id)
+
+
+if __name__ == '__main__':
+    main()
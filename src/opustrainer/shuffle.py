@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 import heapq
+import json
 import os
 import subprocess
+from array import array
 from argparse import ArgumentParser, FileType
 from dataclasses import dataclass
 from itertools import islice, chain
@@ -12,7 +14,11 @@ from shutil import which
 from struct import Struct
 from tempfile import mkstemp
 from threading import Thread
-from typing import TypeVar, Iterator, Iterable, List, Optional, Tuple, Callable
+from typing import BinaryIO, TypeVar, Iterator, Iterable, List, Optional, Tuple, Callable
+
+from opustrainer.affinity import parse_cpu_list, set_affinity
+from opustrainer.catalog import StatsCollector, dump_stats
+from opustrainer.iohints import READAHEAD, DirectWriter, fadvise
 
 
 # Buffer size for reading files. Bufsize that Python assigns is generally too small?
@@ -21,8 +27,15 @@ BUFSIZE=2**16
 # Prefer pigz if available, but fall back to calling gzip
 PATH_TO_GZIP = which("pigz") or which("gzip")
 
+# Extensions of columnar datasets that are read through pyarrow
+PARQUET_EXTENSIONS = ('.parquet', '.pq')
+ARROW_EXTENSIONS = ('.arrow', '.feather', '.ipc')
+
 HEADER = Struct('@fI') # f for random float, I for line length
 
+# Number of offsets to collect before writing them to the index
+INDEX_BLOCK = 2**16
+
 
 @dataclass(frozen=True)
 class SortTask:
@@ -32,9 +45,12 @@ class SortTask:
 	are picked up and finished may not be."""
 	fileno: int
 	chunk: List[Tuple[float,bytes]]
+	direct_io: bool = False
 
 	def __call__(self) -> None:
-		with os.fdopen(self.fileno, 'wb', buffering=BUFSIZE) as fh:
+		# Chunks are only read once, and not soon. No need to keep them in the
+		# page cache if we can bypass it.
+		with (DirectWriter(self.fileno) if self.direct_io else os.fdopen(self.fileno, 'wb', buffering=BUFSIZE)) as fh:
 			self.chunk.sort(key=itemgetter(0))
 			for rand, line in self.chunk:
 				fh.write(HEADER.pack(rand, len(line)))
@@ -53,6 +69,8 @@ def task_worker(queue:"Queue[Optional[Callable[[],None]]]") -> None:
 
 def iter_shuffled_file(filename:str) -> Iterable[Tuple[float,bytes]]:
 	with open(filename, 'rb', buffering=BUFSIZE) as fh:
+		fadvise(fh.fileno(), 0, 0, 'SEQUENTIAL')
+		offset, dropped = 0, 0
 		while True:
 			header = fh.read(HEADER.size)
 			if header == b'':
@@ -60,10 +78,19 @@ def iter_shuffled_file(filename:str) -> Iterable[Tuple[float,bytes]]:
 			random, length = HEADER.unpack(header)
 			yield random, fh.read(length)
 
+			# Drop the bits of the chunk we've already merged from the page cache
+			offset += HEADER.size + length
+			if offset - dropped >= READAHEAD:
+				fadvise(fh.fileno(), dropped, offset - dropped, 'DONTNEED')
+				dropped = offset
+		fadvise(fh.fileno(), 0, 0, 'DONTNEED')
 
-def shuffle(fin: Iterable[bytes], lines:int, *, seed:Optional[int]=None, threads:int=1, tmpdir:Optional[str]=None) -> Iterable[bytes]:
+
+def shuffle(fin: Iterable[bytes], lines:int, *, seed:Optional[int]=None, threads:int=1, tmpdir:Optional[str]=None, direct_io:bool=False) -> Iterable[bytes]:
 	"""Shuffle a list by reading it into a bunch of files (of `lines` length)
-	and shuffling all of these with `threads` in-memory sorters."""
+	and shuffling all of these with `threads` in-memory sorters. If `direct_io`
+	is set, these files are written with O_DIRECT so they don't fill up the page
+	cache."""
 	random = Random(seed)
 
 	chunks: List[str] = []
@@ -96,7 +123,7 @@ def shuffle(fin: Iterable[bytes], lines:int, *, seed:Optional[int]=None, threads
 					chunks.append(filename)
 					# And immediately start shuffling & writing that chunk in another thread
 					# so we can use this thread to continue ingesting chunks
-					queue.put(SortTask(fileno, chunk))
+					queue.put(SortTask(fileno, chunk, direct_io))
 			finally:
 				# Tell sorters that they can stop waiting
 				for _ in sorters:
@@ -115,7 +142,7 @@ def shuffle(fin: Iterable[bytes], lines:int, *, seed:Optional[int]=None, threads
 				fileno, filename = mkstemp(dir=tmpdir)
 				chunks.append(filename)
 
-				task = SortTask(fileno, chunk)
+				task = SortTask(fileno, chunk, direct_io)
 				task()				
 
 		# Open all chunks. We'll be reading the next line from a random one of them.
@@ -133,11 +160,53 @@ def shuffle(fin: Iterable[bytes], lines:int, *, seed:Optional[int]=None, threads
 			os.unlink(filename)
 
 
+def write_index(lines:Iterable[bytes], fh:BinaryIO) -> Iterable[bytes]:
+	"""Passes lines through, while writing the offset at which each line starts
+	in the output to `fh`, followed by the size of the output, as native 64-bit
+	unsigned integers. Lines of a shuffled file can then be found without
+	reading it."""
+	offsets = array('Q')
+	offset = 0
+	for line in lines:
+		offsets.append(offset)
+		offset += len(line)
+		if len(offsets) == INDEX_BLOCK:
+			offsets.tofile(fh)
+			del offsets[:]
+		yield line
+	offsets.append(offset)
+	offsets.tofile(fh)
+
+
+def is_columnar(filename:str) -> bool:
+	"""Whether the file is a Parquet or Arrow IPC dataset instead of TSV."""
+	return filename.endswith(PARQUET_EXTENSIONS + ARROW_EXTENSIONS)
+
+
+def import_pyarrow():
+	try:
+		import pyarrow
+		import pyarrow.compute
+		import pyarrow.parquet
+		import pyarrow.ipc
+		return pyarrow
+	except ImportError:
+		raise RuntimeError('Reading Parquet or Arrow datasets requires pyarrow, install it with `pip install opustrainer[arrow]`')
+
+
 class Reader(Iterable[bytes]):
 	"""Lazily opens a file only once you start trying to read it. Also magically
-	reads gzipped files."""
-	def __init__(self, filename:str):
+	reads gzipped files, and Parquet and Arrow IPC files.
+
+	For the columnar formats, `columns` selects which columns make up the fields
+	of the line, in that order. If it is not given, the first `num_fields`
+	columns are used, or all of them. If `seed` is given, the row groups (or
+	record batches) are read in random order."""
+	def __init__(self, filename:str, *, columns:Optional[List[str]]=None, num_fields:Optional[int]=None, seed:Optional[int]=None):
 		self.filename = filename
+		self.columns = columns
+		self.num_fields = num_fields
+		self.seed = seed
 
 	def _read_gzip(self, filename:str) -> Iterable[bytes]:
 		"""Open gzipped files through gzip subprocess. It is faster than Python's
@@ -153,11 +222,79 @@ class Reader(Iterable[bytes]):
 
 	def _read_plain(self, filename:str) -> Iterable[bytes]:
 		with open(filename, 'rb') as fh:
-			yield from fh
+			fadvise(fh.fileno(), 0, 0, 'SEQUENTIAL')
+			offset = 0
+			while True:
+				# Ask the kernel to start reading the region after this one
+				# while we're still busy with this one. This one is read
+				# right away anyway.
+				fadvise(fh.fileno(), offset + READAHEAD, READAHEAD, 'WILLNEED')
+				lines = fh.readlines(READAHEAD)
+				if not lines:
+					break
+				yield from lines
+				offset = fh.tell()
+
+	def _project(self, schema_names:List[str]) -> List[str]:
+		if self.columns is not None:
+			missing = [name for name in self.columns if name not in schema_names]
+			if missing:
+				raise ValueError(f'{self.filename} does not have columns {missing!r}')
+			return self.columns
+		return schema_names[:self.num_fields]
+
+	def _read_record_batches(self, pa, batches:Iterable) -> Iterable[bytes]:
+		"""Turns record batches into tab separated lines. Joining happens in
+		pyarrow, only the finished lines are turned into Python objects."""
+		for batch in batches:
+			fields = [
+				pa.compute.fill_null(column.cast(pa.string()), '')
+				for column in batch.columns
+			]
+			# Join the fields with tabs, and then join that with an empty string
+			# using a newline as separator to end up with a newline at the end.
+			lines = pa.compute.binary_join_element_wise(*fields, '\t')
+			lines = pa.compute.binary_join_element_wise(lines, pa.scalar(''), '\n')
+			yield from lines.cast(pa.large_binary()).to_pylist()
+
+	def _read_parquet(self, filename:str) -> Iterable[bytes]:
+		pa = import_pyarrow()
+		fh = pa.parquet.ParquetFile(filename)
+		columns = self._project(fh.schema_arrow.names)
+		order = list(range(fh.num_row_groups))
+		if self.seed is not None:
+			Random(self.seed).shuffle(order)
+		yield from self._read_record_batches(pa, (
+			batch
+			for row_group in order
+			for batch in fh.read_row_group(row_group, columns=columns).to_batches()
+		))
+
+	def _read_arrow(self, filename:str) -> Iterable[bytes]:
+		pa = import_pyarrow()
+		with pa.memory_map(filename, 'r') as source:
+			# Try the IPC file format (random access) first, then the stream format
+			try:
+				fh = pa.ipc.open_file(source)
+				order = list(range(fh.num_record_batches))
+				if self.seed is not None:
+					Random(self.seed).shuffle(order)
+				batches = (fh.get_batch(i) for i in order)
+				columns = self._project(fh.schema.names)
+			except pa.ArrowInvalid:
+				source.seek(0)
+				stream = pa.ipc.open_stream(source)
+				batches = iter(stream)
+				columns = self._project(stream.schema.names)
+			yield from self._read_record_batches(pa, (batch.select(columns) for batch in batches))
 
 	def __iter__(self) -> Iterator[bytes]:
 		if self.filename.endswith('.gz'):
 			return iter(self._read_gzip(self.filename))
+		elif self.filename.endswith(PARQUET_EXTENSIONS):
+			return iter(self._read_parquet(self.filename))
+		elif self.filename.endswith(ARROW_EXTENSIONS):
+			return iter(self._read_arrow(self.filename))
 		else:
 			return iter(self._read_plain(self.filename))
 
@@ -168,21 +305,49 @@ def main() -> None:
 	parser.add_argument('--threads', '-j', type=int, default=0, help=f'number of concurrent shuffle threads. Defaults to none')
 	parser.add_argument('--temporary-directory', '-T', type=str, help='temporary directory for shuffling batches')
 	parser.add_argument('--no-shuffle', '-n', action="store_false", help='Do not shuffle, to be used for debugging', dest="shuffle")
+	parser.add_argument('--direct-io', action='store_true', help='write temporary chunks with O_DIRECT, bypassing the page cache')
+	parser.add_argument('--columns', type=str, help='comma separated list of columns to read from Parquet and Arrow files')
+	parser.add_argument('--num-fields', type=int, help='number of columns to read from Parquet and Arrow files if --columns is not given')
+	parser.add_argument('--stats', type=str, help='write line count, byte size, field count and line length distribution of the input as json to this file')
+	parser.add_argument('--index', type=FileType('wb', bufsize=BUFSIZE), help='write the offset of each line in the output to this file')
+	parser.add_argument('--cpus', type=str, help='list of CPUs to run on, e.g. 0-3,8')
 	parser.add_argument('seed', type=int)
 	parser.add_argument('output', type=FileType('wb', bufsize=BUFSIZE), default='-')
 	parser.add_argument('files', nargs='+')
 
 	args = parser.parse_args()
 
+	if args.cpus:
+		set_affinity(parse_cpu_list(args.cpus))
+
 	# Read the lines
-	it: Iterable[bytes] = chain.from_iterable(Reader(filename) for filename in args.files)
+	it: Iterable[bytes] = chain.from_iterable(
+		Reader(filename,
+			columns=args.columns.split(',') if args.columns else None,
+			num_fields=args.num_fields,
+			seed=args.seed if args.shuffle else None)
+		for filename in args.files)
+
+	# Gather statistics while we're reading the lines anyway
+	if args.stats:
+		it = collector = StatsCollector(it)
 
 	# Shuffle the lines
 	if args.shuffle:
-		it = shuffle(it, lines=args.batch_size, seed=args.seed, threads=args.threads, tmpdir=args.temporary_directory)
+		it = shuffle(it, lines=args.batch_size, seed=args.seed, threads=args.threads, tmpdir=args.temporary_directory, direct_io=args.direct_io)
+
+	if args.index:
+		it = write_index(it, args.index)
 
 	args.output.writelines(it)
 
+	if args.index:
+		args.index.close()
+
+	if args.stats:
+		with open(args.stats, 'w', encoding='utf-8') as fh:
+			json.dump(dump_stats(collector.stats()), fh)
+
 
 if __name__ == '__main__':
 	main()
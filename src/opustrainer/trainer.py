@@ -9,23 +9,43 @@ import argparse
 import random
 import subprocess
 import shlex
+import shutil
+import json
 import time
 
 from dataclasses import dataclass
-from typing import List, Tuple, Dict, Any, Optional, Union, Type, TextIO, cast, Iterable, Iterable, Callable, TypeVar, get_type_hints, get_args, get_origin
-from tempfile import TemporaryFile
-from itertools import islice
+from math import gcd
+from functools import partial
+from io import TextIOWrapper
+from typing import IO, List, Tuple, Dict, Any, Optional, Union, Type, TextIO, cast, Iterable, Iterable, Callable, Deque, TypeVar, get_type_hints, get_args, get_origin
+from tempfile import TemporaryFile, mkstemp, mkdtemp
+from collections import deque
+from itertools import chain, groupby, islice
 from pathlib import Path
 
 import yaml
 
-from opustrainer.modifiers import Modifier
+from opustrainer.modifiers import Modifier, make_sparse
+from opustrainer.modifiers.fused import fuse_modifiers
 from opustrainer.modifiers.prefix import PrefixModifier
 from opustrainer.modifiers.surface import UpperCaseModifier, TitleCaseModifier
 from opustrainer.modifiers.placeholders import PlaceholderTagModifier
 from opustrainer.modifiers.typos import TypoModifier
 from opustrainer.modifiers.retokenize import RetokenizeModifier
-from opustrainer.modifiers.pool import make_modifier_pool
+from opustrainer.modifiers.pool import make_modifier_pool, ModifierPool, ErzatsModifierPool, BatchSeed, ChunkSeeder, ChunkSize, START_METHODS, batch_seeding
+from opustrainer.modifiers.tuner import Autotuner, TunablePool, DEFAULT_INTERVAL as AUTOTUNE_INTERVAL
+from opustrainer.modifiers.backends import ExecutorModifierPool, BACKENDS, resolve_backend
+from opustrainer.modifiers.planner import ModifierPlan, plan_modifiers
+from opustrainer.modifiers.transport import TRANSPORTS
+from opustrainer.catalog import DatasetCatalog, DatasetStats, load_stats
+from opustrainer.iohints import fadvise
+from opustrainer.shuffle import is_columnar, import_pyarrow
+from opustrainer.pipeline import threaded, spawn
+from opustrainer.rng import CounterKey, RNG_MODES
+from opustrainer.offsets import EpochFile, LineRange, ReadJob, check_line
+from opustrainer.memory import MemoryBudget, ASSUMED_LINE_LENGTH, LINE_OVERHEAD, LOG_MESSAGE_SIZE, parse_size, log_usage, resident_memory
+from opustrainer.writer import PipeWriter, BufferedConsumer, TeeWriter, WriteTracker, SLOW_CONSUMER_POLICIES, set_pipe_size
+from opustrainer.affinity import plan_layout, set_affinity, format_cpu_list
 from opustrainer import logger
 
 def ignore_sigint():
@@ -36,6 +56,13 @@ def ignore_sigint():
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
 
+def prepare_trainer(cpus:List[int]) -> None:
+    """Pre-exec hook for the trainer program that, besides `ignore_sigint()`,
+    runs it on the CPUs reserved for it, if any."""
+    ignore_sigint()
+    set_affinity(cpus)
+
+
 # Available batch modifiers
 # TODO: Import these lazy, on demand?
 MODIFIERS = {
@@ -47,6 +74,23 @@ MODIFIERS = {
     'Retokenize': RetokenizeModifier,
 }
 
+
+def parse_stage_workers(text:str) -> Dict[str,int]:
+    """Parses a list like `Tags=3,Typos=2` into the number of pipeline
+    workers for each modifier, by class name."""
+    stage_workers = {}
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, count = part.partition('=')
+        if name not in MODIFIERS:
+            raise ValueError(f'unknown modifier {name}, choose from {", ".join(MODIFIERS)}')
+        if not count.isdigit() or int(count) < 1:
+            raise ValueError(f'cannot parse number of workers for {name}: {count}')
+        stage_workers[MODIFIERS[name].__name__] = int(count)
+    return stage_workers
+
 @dataclass(frozen=True)
 class Dataset:
     name: str
@@ -81,6 +125,10 @@ class Curriculum:
     # Too many should select the N first fields. Too few should drop the row.
     num_fields: Optional[int]
 
+    # Columns to read, in order, from Parquet and Arrow datasets. Defaults to
+    # the first `num_fields` columns, or all of them.
+    columns: Optional[List[str]] = None
+
     def __post_init__(self):
         if len(self.stages) != len(frozenset(self.stages)):
             raise ValueError('stages can only occur once')
@@ -110,6 +158,48 @@ class TrainerState:
     epoch_tracker_state: EpochTrackerState
     datasets: Dict[str,DatasetState]
 
+    # Number of batches produced so far, counting the batches of all ranks
+    batch: int = 0
+
+
+@dataclass(frozen=True)
+class StageProgress:
+    stage: str
+    until_dataset: str
+    until_epoch: Optional[int]
+
+    # Fraction of the until clause that has been read. None if the stage runs
+    # forever or the size of the until dataset is not known yet.
+    progress: Optional[float]
+
+    # Estimated number of seconds until the until clause is met
+    eta: Optional[float]
+
+    # Expected number of lines read from each dataset during the whole stage
+    expected_lines: Dict[str,int]
+
+
+@dataclass(frozen=True)
+class StageSpan:
+    stage: Stage
+
+    # Index of the first batch of the stage
+    first_batch: int
+
+    # Number of batches in the stage, None if it never ends
+    batches: Optional[int]
+
+    # Number of lines read from each dataset since the start of training, at
+    # the start of the stage
+    lines_read: Dict[str,int]
+
+    # Number of lines each batch of the stage reads from each dataset
+    quotas: Dict[str,int]
+
+    @property
+    def batch_lines(self) -> int:
+        return sum(self.quotas.values())
+
 
 class DatasetReader:
     """Repeats, shuffles and reads a dataset ad infinitum."""
@@ -119,14 +209,38 @@ class DatasetReader:
     epoch: int
     shuffle: bool
     num_fields: Optional[int]
+    columns: Optional[List[str]]
+    catalog: Optional[DatasetCatalog]
+    direct_io: bool
+
+    # Number of bytes the shuffler may hold in memory, if limited
+    shuffle_memory: Optional[int]
+
+    # Whether lines are handed out as ranges of the shuffled file, to be read
+    # elsewhere, instead of read here. See `read_range()`.
+    offsets: bool
+
+    # CPUs the shuffler runs on, if restricted
+    cpus: Optional[List[int]]
 
     tmpdir: Optional[str]
 
     _fh: Optional[TextIO] = None
     _next_line: str
 
+    # In offset mode, the shuffled file of the current epoch, and of earlier
+    # epochs that still have ranges being read, by path.
+    _epoch_file: Optional[EpochFile] = None
+    _epoch_files: Dict[str, EpochFile]
+
+    # Tell the kernel to drop the part of the shuffled file we've read every
+    # this many lines.
+    DROP_CONSUMED_INTERVAL = 2**16
+
     def __init__(self, dataset:Dataset, seed:int, tmpdir:Optional[str]=None, shuffle:bool=True,
-                 num_fields:Optional[int]=None):
+                 num_fields:Optional[int]=None, catalog:Optional[DatasetCatalog]=None, direct_io:bool=False,
+                 columns:Optional[List[str]]=None, shuffle_memory:Optional[int]=None, offsets:bool=False,
+                 cpus:Optional[List[int]]=None):
         """
         Parameters
         ----------
@@ -141,6 +255,21 @@ class DatasetReader:
         num_fields: int, optional
             Optionally specify the number of fields each line should have. Trim to the required number if they are
             more than the necessary fields, or remove lines that don't have the required number of fields.
+        catalog: DatasetCatalog, optional
+            Catalog to add the statistics of this dataset to while it is shuffled, if they're not in there yet.
+        direct_io: bool
+            Write the temporary chunks of the shuffler with O_DIRECT, bypassing the page cache.
+        columns: list of str, optional
+            Columns to read from Parquet and Arrow files. If not given, the first `num_fields` columns are read.
+        shuffle_memory: int, optional
+            Number of bytes the shuffler may hold in memory. Its chunk size is derived from this and the average
+            line length in the catalog.
+        offsets: bool
+            Hand out lines with `read_range()` as ranges of bytes in the shuffled file, without reading them.
+            Lines are then checked by whoever reads the ranges, and `line` counts lines whether or not they are
+            well formed.
+        cpus: list of int, optional
+            CPUs the shuffler runs on. By default it runs on any CPU this process may use.
         """
         self.dataset = dataset
         self.seed = seed
@@ -149,6 +278,13 @@ class DatasetReader:
         self.line = 0
         self.shuffle = shuffle
         self.num_fields = num_fields
+        self.catalog = catalog
+        self.direct_io = direct_io
+        self.columns = columns
+        self.shuffle_memory = shuffle_memory
+        self.offsets = offsets
+        self.cpus = cpus
+        self._epoch_files = {}
 
     def state(self) -> DatasetState:
         return DatasetState(self.seed, self.line, self.epoch)
@@ -160,40 +296,109 @@ class DatasetReader:
         self.epoch = state.epoch
 
         # Skip forward
-        for _ in range(state.line):
-            next(self)
+        if self.offsets:
+            self.release(self.read_range(state.line))
+        else:
+            for _ in range(state.line):
+                next(self)
 
         return self
 
     def close(self):
         if self._fh:
             self._fh.close()
+        for epoch_file in self._epoch_files.values():
+            epoch_file.remove()
+        self._epoch_files = {}
+        self._epoch_file = None
+
+    def stats(self) -> Optional[DatasetStats]:
+        """Statistics of this dataset, if they are in the catalog."""
+        return self.catalog.get(self.dataset.files) if self.catalog is not None else None
+
+    def _make_stats_file(self) -> Optional[str]:
+        """Temporary file for the shuffler to write the statistics of the dataset
+        to, if the catalog doesn't know them yet."""
+        if self.catalog is None or self.stats() is not None:
+            return None
+        fd, filename = mkstemp(suffix='.json', dir=self.tmpdir)
+        os.close(fd)
+        return filename
 
-    def _open(self):
-        logger.log(f"Reading {self.dataset.name} for epoch {self.epoch}")
-        # Open temporary file which will contain shuffled version of `cat self.files`
-        fh = TemporaryFile(mode='w+', encoding='utf-8', dir=self.tmpdir)
+    def _read_stats_file(self, filename:Optional[str]) -> None:
+        if filename is None:
+            return
+        try:
+            with open(filename, 'r', encoding='utf-8') as fh:
+                stats = load_stats(json.load(fh))
+            assert self.catalog is not None
+            self.catalog.update(self.dataset.files, stats)
+            logger.log(f"Dataset {self.dataset.name} has {stats.lines} lines, {stats.bytes} bytes", loglevel="DEBUG")
+        finally:
+            os.unlink(filename)
 
-        # Shuffle data to the temporary file.
-        # TODO: With the reimplementation of shuffle.py, it is technically
-        # feasible to just write to a named pipe (or even stdout) instead of
-        # a temporary file, and let the trainer read directly from that. Not 
-        # sure if that has any performance or stability benefits/drawbacks.
-        subprocess.check_call([sys.executable,
+    def shuffle_batch_size(self) -> Optional[int]:
+        """Number of lines the shuffler may hold in memory at once, if limited."""
+        if self.shuffle_memory is None:
+            return None
+        stats = self.stats()
+        line_length = stats.mean_line_length if stats is not None else ASSUMED_LINE_LENGTH
+        return max(1, int(self.shuffle_memory // (line_length + LINE_OVERHEAD)))
+
+    def shuffle_memory_usage(self) -> int:
+        """Memory used by shufflers running in the background."""
+        return 0
+
+    def _shuffle_command(self, seed:int, fileno:int, stats:Optional[str]=None, index:Optional[str]=None, tmpdir:Optional[str]=None) -> List[str]:
+        """Command line for shuffling the dataset into the file descriptor
+        `fileno`. Its temporary chunks go in `tmpdir` if given."""
+        batch_size = self.shuffle_batch_size()
+        tmpdir = tmpdir or self.tmpdir
+        return [sys.executable,
             '-m', 'opustrainer.shuffle',
-            *(['--temporary-directory', self.tmpdir] if self.tmpdir else []),
+            *(['--batch-size', str(batch_size)] if batch_size is not None else []),
+            *(['--temporary-directory', tmpdir] if tmpdir else []),
             *([] if self.shuffle else ['--no-shuffle']),
-            str(self.seed),
-            f'/dev/fd/{fh.fileno()}',
+            *(['--stats', stats] if stats else []),
+            *(['--index', index] if index else []),
+            *(['--direct-io'] if self.direct_io else []),
+            *(['--columns', ','.join(self.columns)] if self.columns else []),
+            *(['--num-fields', str(self.num_fields)] if self.num_fields is not None else []),
+            *(['--cpus', format_cpu_list(self.cpus)] if self.cpus else []),
+            str(seed),
+            f'/dev/fd/{fileno}',
             *self.dataset.files
-        ], pass_fds=(fh.fileno(),))
+        ]
+
+    def _make_output(self) -> Tuple[TextIO, Optional[str], Optional[str]]:
+        """Temporary file for the shuffler to write to. In offset mode, it needs
+        a name so others can read it, and the shuffler also writes an index."""
+        if not self.offsets:
+            return cast(TextIO, TemporaryFile(mode='w+', encoding='utf-8', dir=self.tmpdir)), None, None
+        fd, path = mkstemp(suffix='.shuffled', dir=self.tmpdir)
+        index_fd, index = mkstemp(suffix='.index', dir=self.tmpdir)
+        os.close(index_fd)
+        return cast(TextIO, open(fd, 'w+', encoding='utf-8')), path, index
+
+    def _start_epoch(self, fh:TextIO, path:Optional[str], index:Optional[str]) -> None:
+        """Starts reading the shuffled file of the new epoch."""
+        self.line = 0
+
+        if path is not None:
+            assert index is not None
+            fh.close()
+            epoch_file = EpochFile(path, index)
+            if epoch_file.lines == 0:
+                epoch_file.retire()
+                raise RuntimeError('reading from empty shuffled file')
+            self._epoch_file = epoch_file
+            self._epoch_files[path] = epoch_file
+            return
 
         # Replace open file handle with this new file
-        self._fh = cast(TextIO, fh) # TODO: Not sure why TemporaryFile is an
-                                    # IO[str] according to typing, but seems
-                                    # to implement TextIO.
+        self._fh = fh
         self._fh.seek(0)
-        self.line = 0
+        fadvise(self._fh.fileno(), 0, 0, 'SEQUENTIAL')
 
         # Buffer the first line, also asserting that we're not reading an empty file.
         try:
@@ -201,45 +406,78 @@ class DatasetReader:
         except StopIteration:
             raise RuntimeError('reading from empty shuffled file')
 
+    def _open(self):
+        logger.log(f"Reading {self.dataset.name} for epoch {self.epoch}")
+        # Open temporary file which will contain shuffled version of `cat self.files`
+        fh, path, index = self._make_output()
+
+        # Shuffle data to the temporary file.
+        # TODO: With the reimplementation of shuffle.py, it is technically
+        # feasible to just write to a named pipe (or even stdout) instead of
+        # a temporary file, and let the trainer read directly from that. Not 
+        # sure if that has any performance or stability benefits/drawbacks.
+        stats = self._make_stats_file()
+        command = self._shuffle_command(self.seed, fh.fileno(), stats, index)
+        with spawn(command, pass_fds=(fh.fileno(),)) as proc:
+            if proc.wait() != 0:
+                raise subprocess.CalledProcessError(proc.returncode, command)
+        self._read_stats_file(stats)
+
+        self._start_epoch(fh, path, index)
+
     def _read_line(self) -> None:
         try:
-            # Try to find the next non-empty line
+            # Try to find the next well formed line
             while True:
-                self._next_line = self._fh.readline() # type: ignore # _fh can't be none.
+                line = self._fh.readline() # type: ignore # _fh can't be none.
 
                 # Empty return, not even a line ending, means EOF
-                if self._next_line == '':
+                if line == '':
                     raise StopIteration
 
-                # We can't call the function inside the string format prior to python 3.12
-                # so we will have it here instead so that we can refer to it when logging if necessary.
-                original_line: str = self._next_line.rstrip('\r\n')
-
-                # Assert that the line is well formed, meaning non of the fields is the empty string
-                # If not, try to get a new line from the corpus
-                fields: List[str] = original_line.split('\t')
-                if any(field == '' for field in fields):
-                    logger.log_once(f"[Trainer] Empty field in {self.dataset.name} line: \"{original_line}\", skipping...", loglevel="WARNING")
-                    continue
-
-                # Try to see if we have the right number of fields and remove lines
-                # that don't have all the fields or remove extra fields.
-                if self.num_fields is not None:
-                    if len(fields) == self.num_fields:
-                        return
-                    elif len(fields) > self.num_fields:
-                        self._next_line = '\t'.join(fields[:self.num_fields]) + '\n'
-                        return
-                    elif len(fields) < self.num_fields:
-                        logger.log_once(f"[Trainer] Expected {self.num_fields} fields in {self.dataset.name} line: \"{original_line}\" but only got {len(fields)}, skipping...", loglevel="WARNING")
-                        continue
-
-                return
+                # If it's not well formed, try to get a new line from the corpus
+                checked = check_line(line, self.num_fields, self.dataset.name)
+                if checked is not None:
+                    self._next_line = checked
+                    return
         except StopIteration:
             self._fh.close() # type: ignore # _fh can't be none.
             self.seed += 1
             self.epoch += 1
 
+    def read_range(self, count:int) -> List[LineRange]:
+        """In offset mode, hands out the next `count` lines as ranges of the
+        shuffled files, one for each epoch they span. Each range needs to be
+        given back to `release()` once it has been read."""
+        assert self.offsets
+        ranges = []
+        while count > 0:
+            if self._epoch_file is None:
+                self._open()
+            assert self._epoch_file is not None
+            epoch_file = self._epoch_file
+
+            lines = min(count, epoch_file.lines - self.line)
+            ranges.append(epoch_file.range(self.dataset.name, self.line, lines, self.num_fields))
+            self.line += lines
+            count -= lines
+
+            # Like `__next__()`, move on to the next epoch right after reading the
+            # last line, but leave `line` until the next epoch is opened.
+            if self.line == epoch_file.lines:
+                epoch_file.retire()
+                self._epoch_file = None
+                self.seed += 1
+                self.epoch += 1
+        return ranges
+
+    def release(self, ranges:List[LineRange]) -> None:
+        for line_range in ranges:
+            epoch_file = self._epoch_files[line_range.path]
+            epoch_file.release()
+            if epoch_file.removed:
+                del self._epoch_files[line_range.path]
+
     def __iter__(self):
         return self
 
@@ -253,6 +491,11 @@ class DatasetReader:
         line = self._next_line
         self.line += 1
 
+        # The shuffled file is read only once, so don't let the bit we've read
+        # take up space in the page cache.
+        if self.line % self.DROP_CONSUMED_INTERVAL == 0:
+            fadvise(self._fh.fileno(), 0, cast(TextIOWrapper, self._fh).buffer.tell(), 'DONTNEED')
+
         # Read next line into memory and test we're not at EOF
         self._read_line()
 
@@ -264,6 +507,13 @@ class ShuffledFile:
     seed: int
     proc: subprocess.Popen
     file: TextIO
+    stats: Optional[str]
+    # Name of `file` and of its index, in offset mode
+    path: Optional[str] = None
+    index: Optional[str] = None
+    # Directory of its own for the temporary chunks of the shuffler, so they
+    # can be removed if it is killed before it removes them itself
+    chunks: Optional[str] = None
 
 
 class AsyncDatasetReader(DatasetReader):
@@ -275,21 +525,25 @@ class AsyncDatasetReader(DatasetReader):
 
     def _open_async(self, seed:int):
         # Open temporary file which will contain shuffled version of `cat self.files`
-        fh = TemporaryFile(mode='w+', encoding='utf-8', dir=self.tmpdir)
+        fh, path, index = self._make_output()
+        stats = self._make_stats_file()
+        chunks = mkdtemp(dir=self.tmpdir)
 
         self._pending = ShuffledFile(
             seed=seed,
-            file=cast(TextIO, fh),
-            proc=subprocess.Popen([sys.executable,
-                '-m', 'opustrainer.shuffle',
-                *(['--temporary-directory', self.tmpdir] if self.tmpdir else []),
-                *([] if self.shuffle else ['--no-shuffle']),
-                str(seed),
-                f'/dev/fd/{fh.fileno()}',
-                *self.dataset.files
-            ], pass_fds=(fh.fileno(),))
+            file=fh,
+            proc=spawn(self._shuffle_command(seed, fh.fileno(), stats, index, chunks), pass_fds=(fh.fileno(),)),
+            stats=stats,
+            path=path,
+            index=index,
+            chunks=chunks
         )
 
+    def shuffle_memory_usage(self) -> int:
+        if self._pending is None or self._pending.proc.poll() is not None:
+            return 0
+        return resident_memory(self._pending.proc.pid) or 0
+
     def _kill_async(self):
         if self._pending is None:
             return
@@ -297,6 +551,11 @@ class AsyncDatasetReader(DatasetReader):
         self._pending.proc.kill()
         self._pending.proc.wait()
         self._pending.file.close()
+        for filename in [self._pending.stats, self._pending.path, self._pending.index]:
+            if filename is not None:
+                os.unlink(filename)
+        if self._pending.chunks is not None:
+            shutil.rmtree(self._pending.chunks, ignore_errors=True)
         self._pending = None
 
     def _open(self):
@@ -315,21 +574,14 @@ class AsyncDatasetReader(DatasetReader):
         # started last iteration)
         self._pending.proc.wait()
         assert self._pending.proc.returncode == 0
+        self._read_stats_file(self._pending.stats)
+        if self._pending.chunks is not None:
+            shutil.rmtree(self._pending.chunks, ignore_errors=True)
 
         # Swap out the current _fh for the newly prepared one
         assert self._fh is None or self._fh.closed
-        self._fh = self._pending.file
-        self._pending = None
-
-        # Make sure we start reading from the start again
-        self._fh.seek(0)
-        self.line = 0
-
-        # Buffer the first line, also asserting that we're not reading an empty file.
-        try:
-            self._read_line()
-        except StopIteration:
-            raise RuntimeError('reading from empty shuffled file')
+        pending, self._pending = self._pending, None
+        self._start_epoch(pending.file, pending.path, pending.index)
 
         # Start shuffling next
         self._open_async(self.seed + 1)
@@ -362,7 +614,8 @@ class StateLoader:
             datasets={
                 dataset_name: DatasetState(int(seed), int(line), int(epoch))
                 for dataset_name, [seed, line, epoch] in ymldata['datasets'].items()
-            }
+            },
+            batch=int(ymldata.get('batch', 0))
         )
 
     def dump(self, state:TrainerState, fh:TextIO) -> None:
@@ -373,7 +626,8 @@ class StateLoader:
             'datasets': {
                 dataset_name: [state.seed, state.line, state.epoch] #TODO: why a tuple, why not a dict? Isn't a dict more forward compatible?
                 for dataset_name, state in state.datasets.items()
-            }
+            },
+            'batch': state.batch
         }, fh, allow_unicode=True, sort_keys=False) #TODO: is safe_dump not sufficient?
 
 
@@ -402,7 +656,8 @@ class CurriculumV1Loader:
             stages_order=stages_order,
             stages=self._load_stages(ymldata, basepath, stages_order, datasets),
             modifiers=self._load_modifiers(ymldata, basepath),
-            num_fields=int(ymldata['num_fields']) if 'num_fields' in ymldata else None
+            num_fields=int(ymldata['num_fields']) if 'num_fields' in ymldata else None,
+            columns=self._load_columns(ymldata)
         )
 
     def _load_datasets(self, ymldata:dict, basepath:str) -> Dict[str,Dataset]:
@@ -410,13 +665,38 @@ class CurriculumV1Loader:
         ```yml
         datasets:
           clean: path/to/clean.gz
+          warehouse: path/to/export.parquet
         ```
         """
-        return {
+        datasets = {
             name: Dataset(name, [os.path.join(basepath, filepath)])
             for name, filepath in ymldata['datasets'].items()
         }
 
+        # Fail early if we won't be able to read any of the columnar datasets
+        if any(is_columnar(filename) for dataset in datasets.values() for filename in dataset.files):
+            try:
+                import_pyarrow()
+            except RuntimeError as exc:
+                raise CurriculumLoaderError(str(exc)) from exc
+
+        return datasets
+
+    def _load_columns(self, ymldata:dict) -> Optional[List[str]]:
+        """Reads
+        ```yml
+        columns: [src, trg, alignment]
+        ```
+        """
+        if 'columns' not in ymldata:
+            return None
+        columns = ymldata['columns']
+        if not isinstance(columns, list) or not all(isinstance(column, str) for column in columns):
+            raise CurriculumLoaderError("columns should be a list of column names")
+        if 'num_fields' in ymldata and int(ymldata['num_fields']) != len(columns):
+            raise CurriculumLoaderError(f"num_fields is {ymldata['num_fields']} but {len(columns)} columns are selected")
+        return list(columns)
+
     def _load_stage_order(self, ymldata:dict) -> List[str]:
         """Reads
         ```yaml
@@ -612,6 +892,62 @@ class EpochTracker:
     def state(self) -> EpochTrackerState:
         return EpochTrackerState(self.epoch_offset, self.line_offset)
 
+    def lines(self, dataset_lines:int) -> int:
+        """Number of lines the reader has progressed since the tracker started
+        tracking, given the number of lines in one epoch of the dataset."""
+        return (self.reader.epoch - self.epoch_offset) * dataset_lines + self.reader.line - self.line_offset
+
+
+def reader_position(lines_read:int, dataset_lines:int) -> Tuple[int,int]:
+    """Epoch and line of a DatasetReader that has read `lines_read` lines since
+    the start of training. Right after reading the last line of an epoch, the
+    reader is in the next epoch, but its line is only reset on the next read."""
+    if lines_read > 0 and lines_read % dataset_lines == 0:
+        return lines_read // dataset_lines, dataset_lines
+    return divmod(lines_read, dataset_lines)
+
+
+def until_batches(start:int, quota:int, dataset_lines:int, until_epoch:int) -> Optional[int]:
+    """Number of batches after which the EpochTracker of a stage reports that
+    `until_epoch` epochs have been read, if the until dataset had read `start`
+    lines when the stage started and each batch reads `quota` lines from it.
+    None if that never happens."""
+    epoch_offset, line_offset = reader_position(start, dataset_lines)
+
+    def met(batches:int) -> bool:
+        epoch, line = reader_position(start + batches * quota, dataset_lines)
+        return epoch - epoch_offset - (1 if line < line_offset else 0) >= until_epoch
+
+    if met(0):
+        return 0
+    if quota <= 0:
+        return None
+
+    # The tracker counts floor((lines_read - origin) / dataset_lines) epochs,
+    # except right at the end of an epoch, where it counts one more if the
+    # stage did not start at the beginning of one.
+    origin = epoch_offset * dataset_lines + line_offset
+    last = max(0, -(-(origin + until_epoch * dataset_lines - start) // quota))
+    first = max(0, -(-(origin + (until_epoch - 1) * dataset_lines - start) // quota))
+
+    # First batch in [first, last) that ends exactly at the end of an epoch,
+    # i.e. start + batches * quota = 0 (mod dataset_lines)
+    divisor = gcd(quota, dataset_lines)
+    if line_offset > 0 and start % divisor == 0:
+        modulus = dataset_lines // divisor
+        solution = (-start // divisor) * pow(quota // divisor, -1, modulus) % modulus
+        batches = first + (solution - first) % modulus
+        if batches < last and met(batches):
+            return batches
+
+    return last
+
+
+# Batch as read from the datasets: the stage it belongs to, its index, its lines
+# (or where to read them, with `read_by_offset`) and the state of the readers
+# right after reading it.
+RawBatch = Tuple[Stage, int, Union[List[str],List[LineRange]], Dict[str,DatasetState], EpochTrackerState]
+
 
 class Trainer:
     """Writes lines to a trainer program according to the curriculum."""
@@ -624,16 +960,97 @@ class Trainer:
     tmpdir:Optional[str]
     # For debugging purposes, whether to shuffle or not
     shuffle:bool
+    # Statistics about the datasets, used to report progress
+    catalog:Optional[DatasetCatalog]
+    # Whether the shuffler should bypass the page cache for its temporary files
+    direct_io:bool
+
+    # When training data-parallel, this process only produces every
+    # `world_size`-th batch, starting at batch `rank`.
+    rank:int
+    world_size:int
+
+    # Memory the shufflers, queues and caches may use, if limited
+    memory:Optional[MemoryBudget]
+
+    # Random numbers for the modifiers and batch shuffling, one of RNG_MODES
+    rng:str
+
+    # Whether the modifier workers read the lines of the batches themselves
+    read_by_offset:bool
+
+    # Whether modifiers that change lines one by one pick the lines to change
+    # up front, see LineModifier
+    sparse:bool
+
+    # Whether runs of modifiers that can work on parsed lines get them parsed
+    # once, see opustrainer.modifiers.fused
+    fuse:bool
 
     # Reader class to use (I.e. DatasetReader or AsyncDatasetReader)
     _reader_impl: Type[DatasetReader]
 
+    # Batch size of the current run, used to estimate the stage length
+    _batch_size: int
+
+    # Time and number of lines read from the until dataset when the current
+    # stage was entered (or resumed), used to estimate the remaining time.
+    _stage_started: Tuple[float,Optional[int]]
+
+    # State belonging to the last batch handed out by `run()`. While running,
+    # the readers may be ahead of that.
+    _snapshot: Optional[TrainerState]
+
+    # Index of the next batch that will be read
+    _batch: int
+
+    # Modifier pool of the current run, if any
+    _pool: Optional[Union[ModifierPool, ErzatsModifierPool, ExecutorModifierPool]]
+
+    # Batches of this rank read, and handed out by `run()`. The difference is
+    # queued between the reading, modifying and handing out.
+    _batches_read: int
+    _batches_out: int
+
+    # Size of `logger.log_once` before the memory limit changed it, restored
+    # on `close()`
+    _log_once_maxsize: Optional[int]
+
     def __init__(self, curriculum:Curriculum, *, reader:Type[DatasetReader] = DatasetReader, \
-                 tmpdir:Optional[str]=None, shuffle:bool=True):
+                 tmpdir:Optional[str]=None, shuffle:bool=True, catalog:Optional[DatasetCatalog]=None,
+                 direct_io:bool=False, rank:int=0, world_size:int=1, memory:Optional[MemoryBudget]=None,
+                 rng:str='legacy', read_by_offset:bool=False, shuffle_cpus:Optional[List[int]]=None, sparse:bool=False,
+                 fuse:bool=False):
+        if world_size < 1 or not 0 <= rank < world_size:
+            raise ValueError(f'rank {rank} is not part of world size {world_size}')
+        if rng not in RNG_MODES:
+            raise ValueError(f'unknown random number generator {rng}, choose from {", ".join(RNG_MODES)}')
+        if read_by_offset and rng == 'legacy' and world_size == 1:
+            # The workers would need the global random state of the trainer
+            raise ValueError('reading by offset needs the philox random number generator, or a world size larger than 1')
         self.curriculum = curriculum
         self.tmpdir = tmpdir
         self.shuffle = shuffle
+        self.catalog = catalog
+        self.direct_io = direct_io
+        self.rank = rank
+        self.world_size = world_size
+        self.memory = memory
+        self.rng = rng
+        self.read_by_offset = read_by_offset
+        self.shuffle_cpus = shuffle_cpus
+        self.sparse = sparse
+        self.fuse = fuse
+        self._log_once_maxsize = logger.log_once.maxsize
+        if memory is not None:
+            memory.log_allocation()
+            logger.log_once.maxsize = max(1, memory.share('log') // LOG_MESSAGE_SIZE)
         self._reader_impl = reader
+        self._batch_size = 100
+        self._snapshot = None
+        self._pool = None
+        self._batches_read = 0
+        self._batches_out = 0
         random.seed(self.curriculum.seed)
         first_stage_name = self.curriculum.stages_order[0]
 
@@ -650,19 +1067,32 @@ class Trainer:
         ))
 
     def restore(self, state:TrainerState):
+        self._snapshot = None
+        self._batch = state.batch
         random.setstate(state.random_state)
         self.stage = self.curriculum.stages[state.stage]
         self.readers = {
             dataset.name: self._reader_impl(dataset, self.curriculum.seed,
                 tmpdir=self.tmpdir,
                 shuffle=self.shuffle,
-                num_fields=self.curriculum.num_fields
+                num_fields=self.curriculum.num_fields,
+                catalog=self.catalog,
+                direct_io=self.direct_io,
+                columns=self.curriculum.columns,
+                # Any of the datasets may be shuffling at the same time
+                shuffle_memory=self.memory.share('shuffle') // len(self.curriculum.datasets) if self.memory is not None else None,
+                offsets=self.read_by_offset,
+                cpus=self.shuffle_cpus
             ).restore(state.datasets[dataset.name])
             for dataset in self.curriculum.datasets.values()
         }
         self.epoch_tracker = EpochTracker(self.readers[self.stage.until_dataset]).restore(state.epoch_tracker_state)
+        self._mark_stage_start()
 
     def state(self) -> TrainerState:
+        if self._snapshot is not None:
+            return self._snapshot
+
         return TrainerState(
             stage=self.stage.name if self.stage is not None else '',
             random_state=random.getstate(),
@@ -670,13 +1100,16 @@ class Trainer:
             datasets={
                 name: reader.state()
                 for name, reader in self.readers.items()
-            }
+            },
+            batch=self._batch
         )
 
     def close(self):
         for reader in self.readers.values():
             reader.close()
         self.readers = {}
+        if self.memory is not None:
+            logger.log_once.maxsize = self._log_once_maxsize
 
     def next_stage(self) -> Optional[Stage]:
         """Move to the next stage. Will return this next stage or None if there is no next stage."""
@@ -690,46 +1123,536 @@ class Trainer:
         # TODO: when self.stage is None, should we delete the EpochTracker?
         if self.stage is not None:
             self.epoch_tracker = EpochTracker(self.readers[self.stage.until_dataset])
+            self._mark_stage_start()
 
         return self.stage
 
-    def run(self, *, batch_size:int=100, chunk_size:int=16, processes:int=0) -> Iterable[List[str]]:
-        """Yield batches, moving through the stages of training as datasets are consumed."""
-        while self.stage is not None:
-            logger.log(f"Starting stage {self.stage.name}")
-            # Stage level modifiers take precedence over global modifiers,
-            # but you can combine them yourself using YAML references.
-            if self.stage.modifiers is not None:
-                modifiers = self.stage.modifiers
+    def _until_lines(self) -> Optional[int]:
+        """Lines read from the until dataset during the current stage, if known."""
+        if self.stage is None:
+            return None
+        stats = self.readers[self.stage.until_dataset].stats()
+        return self.epoch_tracker.lines(stats.lines) if stats is not None else None
+
+    def _mark_stage_start(self) -> None:
+        self._stage_started = (time.monotonic(), self._until_lines())
+
+    def progress(self) -> Optional[StageProgress]:
+        """Estimates how far along the current stage is, using the dataset
+        statistics in the catalog. Datasets that have not been shuffled yet in
+        this run or any previous run with the same catalog are not known."""
+        if self.stage is None:
+            return None
+
+        until_stats = self.readers[self.stage.until_dataset].stats()
+        weights = {dataset.name: weight for dataset, weight in self.stage.datasets}
+
+        progress, eta = None, None
+        expected_lines: Dict[str,int] = {}
+
+        if until_stats is not None and until_stats.lines > 0 and self.stage.until_epoch is not None:
+            total = self.stage.until_epoch * until_stats.lines
+            done = self.epoch_tracker.lines(until_stats.lines)
+            progress = done / total
+
+            # Estimate the time left from the progress made since we started
+            # (or resumed) this stage.
+            started_at, started_lines = self._stage_started
+            elapsed = time.monotonic() - started_at
+            if started_lines is not None and done > started_lines and elapsed > 0:
+                eta = (total - done) * elapsed / (done - started_lines)
+
+            # The until clause is checked after every batch, and each batch
+            # reads a fixed number of lines from each dataset.
+            quota = int(self._batch_size * weights[self.stage.until_dataset])
+            if quota > 0:
+                batches = -(-total // quota)
+                expected_lines = {
+                    name: batches * int(self._batch_size * weight)
+                    for name, weight in weights.items()
+                }
+
+        return StageProgress(
+            stage=self.stage.name,
+            until_dataset=self.stage.until_dataset,
+            until_epoch=self.stage.until_epoch,
+            progress=progress,
+            eta=eta,
+            expected_lines=expected_lines)
+
+    def stage_spans(self, batch_size:int) -> Iterable[StageSpan]:
+        """Where each stage starts and how many batches it takes, computed from
+        the number of lines of each dataset in the catalog. This assumes that
+        every line of the datasets is valid, i.e. none are skipped."""
+        dataset_lines: Dict[str,int] = {}
+        for name, reader in self.readers.items():
+            stats = reader.stats()
+            if stats is None or stats.lines == 0:
+                raise ValueError(f'number of lines of dataset {name} is not known. It is added to the catalog the first time the dataset is shuffled')
+            dataset_lines[name] = stats.lines
+
+        lines_read = {name: 0 for name in self.curriculum.datasets}
+        first_batch = 0
+
+        for name in self.curriculum.stages_order:
+            stage = self.curriculum.stages[name]
+            quotas = {dataset.name: int(batch_size * weight) for dataset, weight in stage.datasets}
+
+            if stage.until_epoch is None:
+                batches = None
             else:
-                modifiers = self.curriculum.modifiers
+                batches = until_batches(
+                    lines_read[stage.until_dataset],
+                    quotas.get(stage.until_dataset, 0),
+                    dataset_lines[stage.until_dataset],
+                    stage.until_epoch)
 
-            with make_modifier_pool(modifiers, processes) as pool:
-                while self.stage.until_epoch is None or self.epoch_tracker.epoch < self.stage.until_epoch:
-                    batch: List[str] = []
+            yield StageSpan(stage, first_batch, batches, dict(lines_read), quotas)
 
-                    # Read from each dataset according to its weight in this stage
-                    # (They will reshuffle and repeat if necessary)
-                    for dataset, weight in self.stage.datasets:
-                        batch.extend(
-                            line.rstrip('\r\n') for line in
-                            islice(self.readers[dataset.name], 0, int(batch_size * weight))
-                        )
+            if batches is None:
+                return
 
-                    # Apply any modifiers to random lines in the batch, or sentence
-                    # (Multiple modifiers can be applied to the same line)
-                    batch = pool.map(batch, chunk_size)
+            for dataset_name, quota in quotas.items():
+                lines_read[dataset_name] += batches * quota
+            first_batch += batches
+
+    def _own_batches(self, end:int) -> int:
+        """Number of batches before batch `end` that belong to this rank."""
+        return max(0, -(-(end - self.rank) // self.world_size))
+
+    def skip_to(self, *, steps:Optional[int]=None, lines:Optional[int]=None, batch_size:int=100, chunk_size:int=16) -> TrainerState:
+        """Restores the state after this process produced `steps` batches, or
+        the batches that contain the first `lines` lines, without reading any
+        of them. The stage and the position in each dataset are computed from
+        the dataset sizes in the catalog (see `stage_spans()`). With the legacy
+        generator, the random state is found by repeating only the random
+        calls of each batch, which assumes no modifier drops lines."""
+        if (steps is None) == (lines is None):
+            raise ValueError('give either steps or lines to skip to')
+
+        if self.rng == 'legacy' and chunk_size <= 0:
+            raise ValueError('need a chunk_size > 0 to compute the random state')
+
+        self._batch_size = batch_size
+        spans = list(self.stage_spans(batch_size))
+
+        if lines is not None:
+            steps = 0
+            for span in spans:
+                own = None if span.batches is None else self._own_batches(span.first_batch + span.batches) - self._own_batches(span.first_batch)
+                if own is None or lines < own * span.batch_lines:
+                    steps += lines // span.batch_lines if span.batch_lines > 0 else 0
+                    lines = 0
+                    break
+                lines -= own * span.batch_lines
+                steps += own
+            if lines > 0:
+                raise ValueError('the curriculum ends before reaching that many lines')
+
+        assert steps is not None
+
+        # Number of batches of all ranks read when this rank produced `steps`
+        batches = (steps - 1) * self.world_size + self.rank + 1 if steps > 0 else 0
+
+        for span in spans:
+            if span.batches is None or batches < span.first_batch + span.batches or span is spans[-1]:
+                break
+        if span.batches is not None and batches > span.first_batch + span.batches:
+            raise ValueError('the curriculum ends before reaching that many batches')
+
+        lines_read = {
+            name: read + (batches - span.first_batch) * span.quotas.get(name, 0)
+            for name, read in span.lines_read.items()
+        }
 
-                    if self.shuffle:
-                        random.shuffle(batch)
+        datasets = {}
+        for name, read in lines_read.items():
+            stats = self.readers[name].stats()
+            assert stats is not None
+            # Position right at the start of an epoch, as that is where
+            # DatasetReader.restore() opens the next epoch.
+            epoch, line = divmod(read, stats.lines)
+            datasets[name] = DatasetState(seed=self.curriculum.seed + epoch, line=line, epoch=epoch)
+
+        until_stats = self.readers[span.stage.until_dataset].stats()
+        assert until_stats is not None
+        epoch_tracker_state = EpochTrackerState(*reader_position(span.lines_read[span.stage.until_dataset], until_stats.lines))
+
+        rand = random.Random(self.curriculum.seed)
+        if self.rng == 'legacy' and steps > 0:
+            # Per batch, the modifier pool draws a seed for each chunk, and
+            # then the modified batch is shuffled.
+            def replay(batch_lines:int) -> None:
+                for _ in range(-(-batch_lines // chunk_size)):
+                    rand.random()
+                if self.shuffle:
+                    rand.shuffle([None] * batch_lines)
+
+            if self.world_size > 1:
+                rand.seed(f'{self.curriculum.seed}:{batches - 1}')
+                replay(next(span.batch_lines for span in reversed(spans) if span.first_batch < batches and span.batches != 0))
+            else:
+                for replayed in spans:
+                    count = min(batches - replayed.first_batch, replayed.batches if replayed.batches is not None else batches)
+                    for _ in range(max(0, count)):
+                        replay(replayed.batch_lines)
+
+        state = TrainerState(
+            stage=span.stage.name,
+            random_state=rand.getstate(),
+            epoch_tracker_state=epoch_tracker_state,
+            datasets=datasets,
+            batch=batches)
+
+        logger.log(f"Skipping to batch {batches} in stage {span.stage.name}: " + ', '.join(
+            f"{name} epoch {dataset.epoch} line {dataset.line}" for name, dataset in datasets.items()))
+
+        self.restore(state)
+        return state
+
+    def _line_length(self) -> Optional[float]:
+        """Longest average line length of the datasets, if known."""
+        lengths = [stats.mean_line_length for stats in (reader.stats() for reader in self.readers.values()) if stats is not None]
+        return max(lengths) if lengths else None
+
+    def prefetch_limit(self, batch_size:int, prefetch:int) -> int:
+        """Number of batches each thread may read or modify ahead, given the
+        memory limit. There are up to three queues of that many batches: after
+        reading, after modifying, and before writing."""
+        if self.memory is None or prefetch <= 0:
+            return prefetch
+        batches = self.memory.lines('prefetch', self._line_length(), copies=3) // max(batch_size, 1)
+        return max(1, min(prefetch, batches))
+
+    def _pool_limit(self, chunk_size:int, processes:int) -> int:
+        """Maximum number of chunks waiting for the modifier pool, or 0 for no
+        limit. Always enough to keep all workers busy."""
+        if self.memory is None:
+            return 0
+        return max(processes, 1, self.memory.lines('pool', self._line_length()) // max(chunk_size, 1))
+
+    def memory_usage(self) -> Dict[str,int]:
+        """Estimated memory in use by each component."""
+        line_size = (self._line_length() or ASSUMED_LINE_LENGTH) + LINE_OVERHEAD
+        # Batches read and not handed out yet, in the queues between the threads
+        queued = max(0, self._batches_read - self._batches_out)
+        # Chunks sent to the workers and not back yet, of the average size so far
+        stats = self._pool.stats if self._pool is not None and not isinstance(self._pool, ErzatsModifierPool) else None
+        inflight_lines = stats.inflight * stats.lines // stats.chunks if stats is not None and stats.chunks > 0 else 0
+        return {
+            'shuffle': sum(reader.shuffle_memory_usage() for reader in self.readers.values()),
+            'prefetch': int(queued * self._batch_size * line_size),
+            'pool': int(inflight_lines * line_size),
+            'log': len(logger.log_once) * LOG_MESSAGE_SIZE,
+        }
+
+    def log_memory_usage(self, loglevel:str="INFO") -> None:
+        if self.memory is not None:
+            log_usage(self.memory_usage(), loglevel=loglevel)
+
+    def log_pool_stats(self, loglevel:str="INFO") -> None:
+        """Logs how much was sent to and from the modifier workers so far."""
+        if self._pool is not None:
+            self._pool.log_stats(loglevel=loglevel)
 
-                    # Tell anyone whose listening that something interesting happened
-                    # TODO: Yield something useful, e.g. progress.
-                    yield [line + '\n' for line in batch]
+    def _read_batches(self, batch_size:int) -> Iterable[RawBatch]:
+        """Reads batches according to the mix of each stage, moving through the
+        stages as datasets are consumed. Each batch comes with the state of the
+        readers right after reading it. Batches that belong to other ranks are
+        read, to keep the readers in step, but not yielded."""
+        while self.stage is not None:
+            logger.log(f"Starting stage {self.stage.name}")
+            self.log_memory_usage()
+            progress = self.progress()
+            if progress is not None and progress.expected_lines:
+                logger.log(f"Stage {self.stage.name} is expected to read " + ', '.join(
+                    f"{lines} lines from {name}" for name, lines in progress.expected_lines.items()
+                ), loglevel="DEBUG")
+
+            while self.stage.until_epoch is None or self.epoch_tracker.epoch < self.stage.until_epoch:
+                batch: Union[List[str],List[LineRange]]
+
+                # Read from each dataset according to its weight in this stage
+                # (They will reshuffle and repeat if necessary)
+                if self.read_by_offset:
+                    batch = [
+                        line_range
+                        for dataset, weight in self.stage.datasets
+                        for line_range in self.readers[dataset.name].read_range(int(batch_size * weight))
+                    ]
+                else:
+                    batch = [
+                        line.rstrip('\r\n')
+                        for dataset, weight in self.stage.datasets
+                        for line in islice(self.readers[dataset.name], 0, int(batch_size * weight))
+                    ]
+
+                index = self._batch
+                self._batch += 1
+
+                if index % self.world_size == self.rank:
+                    self._batches_read += 1
+                    yield self.stage, index, batch, {name: reader.state() for name, reader in self.readers.items()}, self.epoch_tracker.state()
+                elif self.read_by_offset:
+                    self._release(cast(List[LineRange], batch))
 
             # Move onto next stage. May be `None`, which would end this generator
             self.next_stage()
 
+    def _release(self, ranges:List[LineRange]) -> None:
+        """Lets the readers remove shuffled files once all their ranges are read."""
+        for line_range in ranges:
+            self.readers[line_range.dataset].release([line_range])
+
+    def _modify_batches(self, batches:Iterable[RawBatch], *, chunk_size:int, processes:int, binary:bool, start_method:str, transport:str,
+                        inflight:int=0, chunk_timeout:float=0, worker_cpus:Optional[List[int]]=None, backend:str='auto',
+                        stage_workers:Optional[Dict[str,int]]=None, autotune:Optional[float]=None) -> Iterable[Tuple[Union[List[str],bytes], TrainerState]]:
+        """Runs the modifiers of the stage over each batch and shuffles it. This
+        is the only place where the global random state is used, so it stays the
+        same regardless of whether reading happens ahead or not.
+
+        When training data-parallel, the random state is seeded per batch, so
+        each rank can modify its batches without having seen those of the other
+        ranks. The batches of all ranks combined are then the same for any
+        world size larger than 1.
+
+        With the `philox` generator, the global random state is not used at
+        all. Each line is seeded from its position in the curriculum, and the
+        batches are the same for any world size, chunk size and number of
+        workers.
+
+        Unless the global random state is used, the chunks of the next batches
+        are handed to the workers while those of earlier batches are still being
+        modified, with up to `inflight` chunks in the workers at a time. With
+        the global random state, a batch has to be shuffled before the seeds of
+        the chunks of the next one can be drawn.
+
+        With `read_by_offset`, each batch is a job for a single worker, which
+        reads its lines from the shuffled files, and modifies and shuffles them
+        the same way.
+
+        Otherwise, when a stage starts, its modifiers are timed on its first
+        batch. If they take less time than sending the lines to the workers,
+        they run in this process for the whole stage. See ModifierPlan.
+
+        With `autotune`, the chunk size and the number of active workers of
+        each stage whose modifiers run in the workers are adjusted every
+        `autotune` seconds. See Autotuner."""
+        batches = iter(batches)
+        first = next(batches, None)
+        if first is None:
+            return
+
+        # Sparse or fused copies of the modifier lists, made once so stages
+        # that share a list share the copy too.
+        copies: Dict[int, List[Modifier]] = {}
+
+        def stage_modifiers(stage:Stage) -> List[Modifier]:
+            # Stage level modifiers take precedence over global modifiers,
+            # but you can combine them yourself using YAML references.
+            modifiers = stage.modifiers if stage.modifiers is not None else self.curriculum.modifiers
+            if not self.sparse and not self.fuse:
+                return modifiers
+            if id(modifiers) not in copies:
+                copy = make_sparse(modifiers) if self.sparse else modifiers
+                copies[id(modifiers)] = fuse_modifiers(copy) if self.fuse else copy
+            return copies[id(modifiers)]
+
+        # Decided for all stages up front, as the workers are shared by them
+        if processes > 0 and stage_workers is None:
+            backend = resolve_backend(backend, [modifier for stage in self.curriculum.stages.values() for modifier in stage_modifiers(stage)])
+
+        # Where the modifiers of each stage run, decided when it starts
+        plans: Dict[str, ModifierPlan] = {}
+
+        def plan_stage(stage:Stage, raw:RawBatch) -> ModifierPlan:
+            # With read_by_offset, the lines are only read in the workers
+            sample = cast(List[str], raw[2]) if processes > 0 and not self.read_by_offset else None
+            plan = plan_modifiers(stage_modifiers(stage), sample, chunk_size)
+            plan.log(stage.name)
+            return plan
+
+        # The workers are started when a stage first needs them, live for the
+        # rest of the run, and only get sent the modifiers of a new stage if
+        # they are different.
+        pool: Optional[Union[ModifierPool, ErzatsModifierPool, ExecutorModifierPool]] = None
+        self._pool = None
+
+        def get_pool(modifiers:List[Modifier]) -> Union[ModifierPool, ErzatsModifierPool, ExecutorModifierPool]:
+            nonlocal pool
+            if pool is None:
+                pool = make_modifier_pool(modifiers, processes, max_pending=self._pool_limit(chunk_size, processes),
+                                          start_method=start_method, transport=transport, max_inflight=inflight,
+                                          chunk_timeout=chunk_timeout, cpus=worker_cpus, backend=backend,
+                                          stage_workers=stage_workers).__enter__()
+                self._pool = pool
+            return pool
+
+        current_stage = first[0]
+        plans[current_stage.name] = plan_stage(current_stage, first)
+
+        tuner = Autotuner(chunk_size, processes, self._batch_size, interval=autotune) if autotune is not None and processes > 0 else None
+
+        # Batches handed to the pool and not yet modified
+        waiting: Deque[RawBatch] = deque()
+
+        def submit() -> Iterable[Tuple[RawBatch, BatchSeed]]:
+            nonlocal current_stage
+            for raw in chain([first], batches):
+                stage, index, _, _, _ = raw
+                if stage is not current_stage:
+                    plan = plans[stage.name] = plan_stage(stage, raw)
+                    if not plan.inline and pool is not None and plan.modifiers is not pool.modifiers:
+                        pool.set_modifiers(plan.modifiers)
+                    current_stage = stage
+
+                waiting.append(raw)
+
+                if self.rng == 'philox':
+                    yield raw, CounterKey(self.curriculum.seed, self.curriculum.stages_order.index(stage.name), index)
+                elif self.world_size > 1:
+                    # Same numbers as seeding the global random state per batch
+                    yield raw, f'{self.curriculum.seed}:{index}'
+                else:
+                    yield raw, None
+
+        def modify() -> Iterable[Tuple[RawBatch, Union[List[str],bytes]]]:
+            if self.read_by_offset:
+                # The workers read, modify and shuffle the batch, and send back
+                # the finished batch.
+                jobs = (ReadJob(tuple(cast(List[LineRange], raw[2])), seed, chunk_size, self.shuffle) for raw, seed in submit())
+                for data in get_pool(plans[first[0].name].modifiers).imap_jobs(jobs):
+                    raw = waiting.popleft()
+                    self._release(cast(List[LineRange], raw[2]))
+                    yield raw, data
+                return
+
+            shuffles: Deque[Callable[[List[str]], None]] = deque()
+
+            def chunked(items:Iterable[Tuple[RawBatch, BatchSeed]]) -> Iterable[Tuple[List[str], ChunkSeeder]]:
+                for raw, seed in items:
+                    seeder, shuffle = batch_seeding(seed)
+                    shuffles.append(shuffle)
+                    yield cast(List[str], raw[2]), seeder
+
+            # Each stage runs its modifiers in this process or in the workers
+            for name, items in groupby(submit(), key=lambda item: item[0][0].name):
+                plan = plans[name]
+                stage_pool = ErzatsModifierPool(plan.modifiers) if plan.inline else get_pool(plan.modifiers)
+
+                # Chunk size of each next batch, if it is tuned
+                chunks: ChunkSize = chunk_size
+                stage_tuner = tuner if not plan.inline else None
+                if stage_tuner is not None:
+                    stage_tuner.start_stage(name, cast(TunablePool, stage_pool))
+                    chunks = lambda: cast(Autotuner, stage_tuner).chunk_size
+
+                # Apply any modifiers to random lines in the batch, or sentence
+                # (Multiple modifiers can be applied to the same line)
+                if self.rng == 'philox' or self.world_size > 1:
+                    modified = stage_pool.imap(chunked(items), chunks)
+                else:
+                    modified = (stage_pool.map(batch, chunk_size) for batch, _ in chunked(items))
+
+                for batch in modified:
+                    raw, shuffle = waiting.popleft(), shuffles.popleft()
+                    if self.shuffle:
+                        shuffle(batch)
+                    # Time until the next batch is asked for is time spent
+                    # waiting for the trainer.
+                    handed_out = time.monotonic()
+                    yield raw, batch
+                    if stage_tuner is not None:
+                        stage_tuner.batch_done(cast(TunablePool, stage_pool), time.monotonic() - handed_out)
+
+        try:
+            for (stage, index, _, datasets, epoch_tracker_state), batch in modify():
+                if isinstance(batch, bytes):
+                    output: Union[List[str],bytes] = batch if binary else [line + '\n' for line in batch.decode('utf-8').split('\n')[:-1]]
+                elif binary:
+                    output = ('\n'.join(batch) + '\n').encode('utf-8') if batch else b''
+                else:
+                    output = [line + '\n' for line in batch]
+
+                # Tell anyone whose listening that something interesting happened
+                # TODO: Yield something useful, e.g. progress.
+                yield output, TrainerState(
+                    stage=stage.name,
+                    random_state=random.getstate(),
+                    epoch_tracker_state=epoch_tracker_state,
+                    datasets=datasets,
+                    batch=index + 1)
+        finally:
+            if pool is not None:
+                pool.__exit__(None, None, None)
+                pool.log_stats(loglevel="DEBUG")
+
+    def run(self, *, batch_size:int=100, chunk_size:int=16, processes:int=0, prefetch:int=0, binary:bool=False, start_method:str='fork',
+            transport:str='queue', inflight:int=0, chunk_timeout:float=0, worker_cpus:Optional[List[int]]=None,
+            backend:str='auto', stage_workers:Optional[Dict[str,int]]=None, autotune:Optional[float]=None) -> Iterable[Union[List[str],bytes]]:
+        """Yield batches, moving through the stages of training as datasets are consumed.
+
+        If `prefetch` is larger than 0, reading and modifying happen in their own
+        threads, each keeping up to `prefetch` batches ready. The batches and the
+        state reported by `state()` are the same either way.
+
+        Batches are lists of lines, or if `binary` is set, a single block of
+        UTF-8 encoded, newline terminated lines.
+
+        The `processes` modifier workers are started once, with `start_method`
+        (one of START_METHODS), and reused for all stages. Lines are sent to
+        them through `transport`, one of TRANSPORTS. Unless the global random
+        state is used, up to `inflight` chunks (by default four per worker) are
+        kept in the workers, also across batches. Workers that die are
+        replaced, and if one spends more than `chunk_timeout` seconds on a
+        chunk, a ChunkTimeoutError is raised. If `worker_cpus` is given, the
+        workers are spread over those CPUs, one each if there are enough.
+
+        The workers are processes, or with `backend` (one of BACKENDS) threads
+        or subinterpreters of this process. With `stage_workers`, each modifier
+        gets worker processes of its own instead, that many for the modifiers
+        with those class names and one for the others, and a chunk goes from
+        one to the next. The batches are the same for each. This cannot be
+        combined with `fuse`.
+
+        With `autotune`, the chunk size and number of active workers are
+        adjusted while running, every `autotune` seconds. This needs the philox
+        generator, with which they don't change the batches."""
+        if autotune is not None and (self.rng != 'philox' or self.read_by_offset):
+            raise ValueError('autotuning needs the philox random number generator, and lines read by the trainer')
+        if stage_workers is not None and self.fuse:
+            # A fused run of modifiers would have to share its workers
+            raise ValueError('fused modifiers cannot be given worker processes of their own')
+
+        self._batch_size = batch_size
+        self._batches_read = 0
+        self._batches_out = 0
+
+        limited = self.prefetch_limit(batch_size, prefetch)
+        if limited < prefetch:
+            logger.log(f"Reading ahead {limited} instead of {prefetch} batches to stay within the memory limit")
+            prefetch = limited
+
+        batches = self._read_batches(batch_size)
+
+        if prefetch > 0:
+            batches = threaded(batches, prefetch, name='reader')
+
+        modified = self._modify_batches(batches, chunk_size=chunk_size, processes=processes, binary=binary, start_method=start_method, transport=transport, inflight=inflight, chunk_timeout=chunk_timeout, worker_cpus=worker_cpus, backend=backend, stage_workers=stage_workers, autotune=autotune)
+
+        if prefetch > 0:
+            modified = threaded(modified, prefetch, name='modifier')
+
+        for batch, state in modified:
+            # Readers may already be ahead, so remember the state that goes with
+            # the batch we're handing out.
+            self._snapshot = state
+            self._batches_out += 1
+            yield batch
+
+        # All batches are out, the live state is up-to-date again.
+        self._snapshot = None
+
 
 class StateTracker:
     """Wraps around the trainer.run() call to restore and dump state its."""
@@ -765,21 +1688,38 @@ class StateTracker:
             return trainer.restore(self.loader.load(fh))
 
     def _dump(self, trainer:Trainer):
+        self.save(trainer.state())
+
+    def resume(self, trainer:Trainer) -> None:
+        """Restores the trainer from the state file, if enabled and it exists."""
+        if self.restore and os.path.exists(self.path):
+            self._restore(trainer)
+
+    def save(self, state:TrainerState) -> None:
         new_statefile = f"{self.path}.new"
         with open(new_statefile, 'w', encoding='utf-8') as fh:
-            self.loader.dump(trainer.state(), fh)
+            self.loader.dump(state, fh)
         os.rename(new_statefile, self.path)
         self._last_dump = time.monotonic()
 
+    def due(self) -> bool:
+        """Whether the last dump is more than `timeout` seconds ago."""
+        return time.monotonic() - self._last_dump > self.timeout
+
+    def advance(self, state:TrainerState) -> None:
+        """Call with the state that goes with a batch once it is written to the
+        trainer. Dumps it if the last dump is long enough ago."""
+        if self.dump and self.due():
+            self.save(state)
+
     def run(self, trainer:Trainer, *args, **kwargs):
-        if self.restore and os.path.exists(self.path):
-            self._restore(trainer)
+        self.resume(trainer)
 
         try:
             for batch in trainer.run(*args, **kwargs):
                 # TODO: Replace this with something that listens to Marian, and
                 # writes the state to disk after marian performed validation.
-                if self.dump and time.monotonic() - self._last_dump > self.timeout:
+                if self.dump and self.due():
                     self._dump(trainer)
                 yield batch
         finally:
@@ -788,23 +1728,112 @@ class StateTracker:
                 self._dump(trainer)
 
 
-def print_state(state:TrainerState) -> None:
+def print_state(state:TrainerState, progress:Optional[StageProgress]=None) -> None:
     logger.log(f"At stage {state.stage}")
     for name, reader in state.datasets.items():
         logger.log(f"Dataset {name}: overall epochs {reader.epoch: 3d}.{reader.line:010d}")
 
+    if progress is None:
+        return
+
+    if progress.progress is not None:
+        logger.log(f"Stage {progress.stage}: {progress.progress:.2%} of {progress.until_epoch} epochs of {progress.until_dataset}")
+    else:
+        logger.log(f"Stage {progress.stage}: progress towards until clause unknown")
+
+    if progress.eta is not None:
+        logger.log(f"Stage {progress.stage}: estimated {progress.eta:.0f} seconds remaining")
+
+    for name, lines in progress.expected_lines.items():
+        logger.log(f"Stage {progress.stage}: expecting {lines} lines from dataset {name}")
+
+
+def add_modifier_arguments(parser:argparse.ArgumentParser, seeded_by:str='--rng philox') -> None:
+    """Adds the options for how batches are read and modified, shared by the
+    trainer and opustrainer-materialize. `seeded_by` names the options that
+    seed each line by its position, for the options that need that."""
+    parser.add_argument("--batch-size", '-b', type=int, default=100, help='Batch size')
+    parser.add_argument("--chunk-size", '-B', type=int, default=16, help='Chunk size of batches fed to modifiers')
+    parser.add_argument("--workers", '-j', type=int, default=None, help='Number of workers. Defaults to the number of CPUs available to them, see --worker-cpus')
+    parser.add_argument("--start-method", type=str, choices=START_METHODS, default='fork', help='How to start the modifier workers. forkserver starts them from a process that only loaded the modifiers, which keeps their memory use low')
+    parser.add_argument("--transport", type=str, choices=TRANSPORTS, default='queue', help='How lines are sent to and from the modifier workers. shm copies them through shared memory instead of pickling them')
+    parser.add_argument("--inflight-chunks", type=int, default=0, metavar="N", help=f'Number of chunks to keep in the modifier workers at a time, across batches, with {seeded_by}. Defaults to 4 per worker')
+    parser.add_argument("--chunk-timeout", type=float, default=0, metavar="SECONDS", help='Stop with an error if a modifier worker spends longer than this on one chunk. 0, the default, waits forever')
+    parser.add_argument("--backend", type=str, choices=BACKENDS, default='auto', help='Run the modifier workers as processes, threads, or subinterpreters (Python 3.14 and later). auto uses threads on free-threaded Python, and processes otherwise')
+    parser.add_argument("--modifier-pipeline", type=str, default=None, metavar="NAME=N,...", help='Give each modifier worker processes of its own, N for modifier NAME and 1 for the others, and pass chunks from one modifier to the next. The workers of each are reported with --log-level DEBUG. Not with --read-by-offset')
+    parser.add_argument("--worker-cpus", type=str, default=None, metavar="CPUS", help='CPUs to run the modifier workers on, one worker per CPU if there are enough, e.g. 0-15 or node0')
+    parser.add_argument("--shuffle-cpus", type=str, default=None, metavar="CPUS", help='CPUs to run the shufflers on, e.g. 16-19 or node1')
+    parser.add_argument("--prefetch", type=int, default=2, help='Number of batches to prepare ahead in parallel. 0 does everything in sequence')
+    parser.add_argument("--rng", choices=RNG_MODES, default='legacy', help='Random numbers for the modifiers. philox seeds each line by its position, making the output independent of --workers and --chunk-size')
+    parser.add_argument("--autotune", type=float, nargs='?', const=AUTOTUNE_INTERVAL, default=None, metavar="SECONDS", help=f'Adjust the chunk size and the number of active modifier workers of each stage while running, every SECONDS (default {AUTOTUNE_INTERVAL:g}), logging each change. Needs --rng philox')
+    parser.add_argument("--sparse-modifiers", action="store_true", help='Let modifiers that change lines one by one, like UpperCase, pick the lines to change up front instead of drawing a random number for each line. Faster for low probabilities, but changes different lines unless --rng philox')
+    parser.add_argument("--fuse-modifiers", action="store_true", help='Parse each line once for runs of modifiers that can work on parsed lines, like UpperCase, TitleCase, Prefix, Tags and Retokenize, instead of in each of them. The lines come out with single spaces between words. Not with --modifier-pipeline')
+    parser.add_argument("--read-by-offset", action="store_true", help=f'Let the modifier workers read the lines of each batch from the shuffled files themselves, instead of this process. Needs {seeded_by}')
+
+
+def check_modifier_arguments(parser:argparse.ArgumentParser, args:argparse.Namespace) -> Optional[Dict[str,int]]:
+    """Exits through `parser.error()` if the options of `add_modifier_arguments()`
+    can't be combined. Returns the workers of each stage of --modifier-pipeline,
+    if given."""
+    if args.autotune is not None and (args.rng != 'philox' or args.read_by_offset):
+        parser.error('--autotune needs --rng philox, and cannot be combined with --read-by-offset')
+
+    if args.modifier_pipeline is None:
+        return None
+    try:
+        stage_workers = parse_stage_workers(args.modifier_pipeline)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.read_by_offset:
+        parser.error('--modifier-pipeline cannot be combined with --read-by-offset')
+    if args.backend not in ('auto', 'processes'):
+        parser.error('--modifier-pipeline needs --backend processes')
+    if args.fuse_modifiers:
+        parser.error('--modifier-pipeline cannot be combined with --fuse-modifiers')
+    return stage_workers
+
+
+def modifier_run_arguments(args:argparse.Namespace, worker_cpus:Optional[List[int]], stage_workers:Optional[Dict[str,int]]) -> Dict[str,Any]:
+    """Keyword arguments for `Trainer.run()` from the options of
+    `add_modifier_arguments()`."""
+    return dict(
+        batch_size=args.batch_size,
+        chunk_size=args.chunk_size,
+        processes=args.workers,
+        prefetch=args.prefetch,
+        start_method=args.start_method,
+        transport=args.transport,
+        inflight=args.inflight_chunks,
+        chunk_timeout=args.chunk_timeout,
+        worker_cpus=worker_cpus,
+        backend=args.backend,
+        stage_workers=stage_workers,
+        autotune=args.autotune)
+
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Feeds marian tsv data for training.")
     parser.add_argument("--config", '-c', required=True, type=str, help='YML configuration input.')
     parser.add_argument("--state", '-s', type=str, help='YML state file, defaults to ${CONFIG}.state.')
+    parser.add_argument("--catalog", type=str, help='Dataset statistics cache, defaults to ${CONFIG}.catalog.')
     parser.add_argument("--sync", action="store_true", help="Do not shuffle async")
     parser.add_argument("--temporary-directory", '-T', default=None, type=str, help='Temporary dir, used for shuffling and tracking state')
     parser.add_argument("--do-not-resume", '-d', action="store_true", help='Do not resume from the previous training state')
     parser.add_argument("--no-shuffle", '-n', action="store_false", help='Do not shuffle, for debugging', dest="shuffle")
-    parser.add_argument("--batch-size", '-b', type=int, default=100, help='Batch size')
-    parser.add_argument("--chunk-size", '-B', type=int, default=16, help='Chunk size of batches fed to modifiers')
-    parser.add_argument("--workers", '-j', type=int, default=os.cpu_count() or 1, help='Number of workers')
+    parser.add_argument("--direct-io", action="store_true", help='Write temporary shuffle chunks with O_DIRECT to keep them out of the page cache')
+    add_modifier_arguments(parser, seeded_by='--rng philox or --world-size')
+    parser.add_argument("--trainer-cpus", type=str, default=None, metavar="N|CPUS", help='Reserve CPUs for the trainer program: a number of them, taken from the end, or a list like 0-3,8 or node1. Nothing else runs on them')
+    parser.add_argument("--write-buffer-size", type=int, default=2**20, help='Number of bytes to collect before writing them to the trainer')
+    parser.add_argument("--memory-limit", type=parse_size, default=None, help='Memory the shufflers, queues and caches may use together, e.g. 16G')
+    parser.add_argument("--skip-to-step", type=int, default=None, metavar="N", help='Instead of resuming from the state file, start after the first N batches, computing where they end from the dataset sizes in the catalog')
+    parser.add_argument("--skip-to-lines", type=int, default=None, metavar="N", help='Like --skip-to-step, but start after the batches with the first N lines')
+    parser.add_argument("--rank", type=int, default=0, help='Rank of this process when training data-parallel. It only produces every WORLD_SIZE-th batch, starting at batch RANK')
+    parser.add_argument("--world-size", type=int, default=1, help='Number of data-parallel processes that each produce their own part of the batches')
+    parser.add_argument("--tee", type=str, action='append', default=[], metavar="COMMAND", help='Additional trainer that gets fed the same batches. Can be given multiple times')
+    parser.add_argument("--tee-buffer", type=int, default=16, help='Number of batches buffered for each trainer when using --tee')
+    parser.add_argument("--slow-consumer", type=str, choices=SLOW_CONSUMER_POLICIES, default='block', help='What to do when the buffer of a --tee trainer is full: block all trainers, or spill its batches to disk')
+    parser.add_argument("--serve", type=str, default=None, metavar="SOCKET", help='Instead of running a trainer, serve batches to opustrainer-client processes through this Unix domain socket')
+    parser.add_argument("--max-inflight", type=int, default=4, help='Number of batches a client of --serve may have without acknowledging them')
     parser.add_argument("--log-level", type=str, default="INFO", help="Set log level. Available levels: DEBUG, INFO, WARNING, ERROR, CRITICAL. Default is INFO")
     parser.add_argument("--log-file", '-l', type=str, default=None, help="Target location for logging. Always logs to stderr and optionally to a file.")
     parser.add_argument("trainer", type=str, nargs=argparse.REMAINDER, help="Trainer program that gets fed the input. If empty it is read from config.")
@@ -812,6 +1841,23 @@ def main() -> None:
     args = parser.parse_args()
     logger.setup_logger(args.log_file, args.log_level)
 
+    if args.skip_to_step is not None and args.skip_to_lines is not None:
+        parser.error('--skip-to-step and --skip-to-lines cannot be combined')
+    skip = args.skip_to_step is not None or args.skip_to_lines is not None
+
+    try:
+        layout = plan_layout(trainer=args.trainer_cpus, workers=args.worker_cpus, shuffle=args.shuffle_cpus)
+    except ValueError as e:
+        parser.error(str(e))
+    # Keep quiet about it unless asked
+    pinned = args.trainer_cpus is not None or args.worker_cpus is not None or args.shuffle_cpus is not None
+    layout.log(loglevel="INFO" if pinned else "DEBUG")
+    set_affinity(layout.main)
+    if args.workers is None:
+        args.workers = layout.budget
+
+    stage_workers = check_modifier_arguments(parser, args)
+
     with open(args.config, 'r', encoding='utf-8') as fh:
         config = yaml.safe_load(fh)
 
@@ -826,20 +1872,86 @@ def main() -> None:
     trainer = Trainer(curriculum,
         reader=DatasetReader if args.sync else AsyncDatasetReader,
         tmpdir=args.temporary_directory,
-        shuffle=args.shuffle)
-
-    state_tracker = StateTracker(args.state or f'{args.config}.state', restore=not args.do_not_resume)
+        shuffle=args.shuffle,
+        catalog=DatasetCatalog(args.catalog or f'{args.config}.catalog'),
+        direct_io=args.direct_io,
+        rank=args.rank,
+        world_size=args.world_size,
+        memory=MemoryBudget(args.memory_limit) if args.memory_limit is not None else None,
+        rng=args.rng,
+        read_by_offset=args.read_by_offset,
+        shuffle_cpus=layout.shuffle,
+        sparse=args.sparse_modifiers,
+        fuse=args.fuse_modifiers)
+
+    # Each rank has its own state, as the ranks are at different batches
+    default_state = f'{args.config}.state' if args.world_size == 1 else f'{args.config}.{args.rank}.state'
+    state_tracker = StateTracker(args.state or default_state, restore=not args.do_not_resume and not skip)
+
+    if skip:
+        trainer.skip_to(steps=args.skip_to_step, lines=args.skip_to_lines, batch_size=args.batch_size, chunk_size=args.chunk_size)
 
     # Make trainer listen to `kill -SIGUSR1 $PID` to print dataset progress
-    signal.signal(signal.SIGUSR1, lambda signum, handler: print_state(trainer.state()))
-
-    model_trainer = subprocess.Popen(
-        args.trainer or shlex.split(config['trainer']),
-        stdin=subprocess.PIPE,
-        encoding="utf-8",
-        preexec_fn=ignore_sigint) # ignore_sigint makes marian ignore Ctrl-C. We'll stop it from here.
-
-    assert model_trainer.stdin is not None
+    def on_sigusr1(signum, frame):
+        print_state(trainer.state(), trainer.progress())
+        trainer.log_memory_usage()
+    signal.signal(signal.SIGUSR1, on_sigusr1)
+
+    if args.serve:
+        # Imported here because the server builds on this module
+        from opustrainer.server import BatchServer
+        server = BatchServer(args.serve, max_inflight=args.max_inflight)
+        try:
+            server.serve(trainer, state_tracker, **modifier_run_arguments(args, layout.workers, stage_workers))
+        except KeyboardInterrupt:
+            logger.log("Ctrl-c pressed, stopping server")
+        return
+
+    # The trainer from the command line or config, plus any --tee trainers,
+    # which all get the same batches.
+    commands = [args.trainer or shlex.split(config['trainer'])] + [shlex.split(command) for command in args.tee]
+
+    model_trainers = [
+        subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            bufsize=0, # We do our own buffering in PipeWriter
+            preexec_fn=partial(prepare_trainer, layout.trainer)) # ignore_sigint makes marian ignore Ctrl-C. We'll stop it from here.
+        for command in commands
+    ]
+
+    pipe_writers: List[PipeWriter] = []
+    for model_trainer in model_trainers:
+        assert model_trainer.stdin is not None
+        pipe_size = set_pipe_size(model_trainer.stdin.fileno())
+        if pipe_size is not None:
+            logger.log(f"Pipe buffer to trainer is {pipe_size} bytes", loglevel="DEBUG")
+        pipe_writers.append(PipeWriter(model_trainer.stdin.fileno(), buffer_size=args.write_buffer_size))
+
+    writer: Union[PipeWriter,TeeWriter]
+    if len(pipe_writers) == 1:
+        writer = pipe_writers[0]
+    else:
+        writer = TeeWriter([
+            BufferedConsumer(pipe_writer,
+                maxsize=args.tee_buffer,
+                policy=args.slow_consumer,
+                tmpdir=args.temporary_directory,
+                name=f'trainer {index}')
+            for index, pipe_writer in enumerate(pipe_writers)
+        ])
+
+    def wait_for_trainers() -> int:
+        """Waits for all trainers, and returns the first non-zero exit code."""
+        returncodes = [model_trainer.wait() for model_trainer in model_trainers]
+        return next((returncode for returncode in returncodes if returncode != 0), 0)
+
+    # Make trainer listen to `kill -SIGUSR2 $PID` to print the throughput to the
+    # trainer, and what was sent to the modifier workers
+    def on_sigusr2(signum, frame):
+        writer.log_stats()
+        trainer.log_pool_stats()
+    signal.signal(signal.SIGUSR2, on_sigusr2)
 
     # TODO: This logic looks complicated, should be able to do this simpler. Three scenarios:
     #   1. ctrl-c is pressed and trainer is told this is the end of the training data
@@ -850,33 +1962,67 @@ def main() -> None:
     #      scenario. We don't need to deal with multiple levels of terminating the trainer because
     #      the trainer is already dead at this point.
     try:
+        state_tracker.resume(trainer)
+
+        # Keeps the state that goes with the last batch written to the trainer.
+        # The producer may be ahead of it, and so may the writer's buffer, with
+        # batches that are never written.
+        tracker = WriteTracker(writer, trainer.state())
+
         try:
-            for batch in state_tracker.run(trainer, batch_size=args.batch_size, chunk_size=args.chunk_size, processes=args.workers):
-                model_trainer.stdin.writelines(batch)
+            # Each batch comes with its state, taken when the trainer hands it out
+            batches: Iterable[Tuple[bytes,TrainerState]] = (
+                (cast(bytes, batch), trainer.state())
+                for batch in trainer.run(binary=True, **modifier_run_arguments(args, layout.workers, stage_workers))
+            )
+
+            # Produce the next batches while we're blocked on writing this one
+            if args.prefetch > 0:
+                batches = threaded(batches, trainer.prefetch_limit(args.batch_size, args.prefetch), name='producer')
+
+            for batch, state in batches:
+                written = tracker.write(batch, state)
+                # TODO: Replace this with something that listens to Marian, and
+                # writes the state to disk after marian performed validation.
+                state_tracker.advance(written)
+            tracker.flush()
         except KeyboardInterrupt:
             logger.log("Ctrl-c pressed, stopping training")
+        finally:
+            # Dump on clean exit as well as on exception.
+            if state_tracker.dump:
+                state_tracker.save(tracker.update())
+
+        writer.log_stats(loglevel="DEBUG")
 
         # Levels of waiting for the trainer. This is reached either because we ran out of batches
         # or because ctrl-c was pressed. Pressing ctrl-c more advances to next level of aggressiveness.
         for stage in ['exit', 'terminate', 'kill']:
             try:
                 if stage == 'exit':
-                    model_trainer.stdin.close()
+                    writer.flush()
+                    for model_trainer in model_trainers:
+                        cast(IO[bytes], model_trainer.stdin).close()
                 elif stage == 'terminate':
-                    model_trainer.terminate()
+                    for model_trainer in model_trainers:
+                        model_trainer.terminate()
+                else:
+                    for model_trainer in model_trainers:
+                        model_trainer.kill()
+
+                if len(model_trainers) == 1:
+                    logger.log(f"waiting for trainer to {stage}. Press ctrl-c to be more aggressive")
                 else:
-                    model_trainer.kill()
-                
-                logger.log(f"waiting for trainer to {stage}. Press ctrl-c to be more aggressive")
-                sys.exit(model_trainer.wait()) # blocking
+                    logger.log(f"waiting for {len(model_trainers)} trainers to {stage}. Press ctrl-c to be more aggressive")
+                sys.exit(wait_for_trainers()) # blocking
             except KeyboardInterrupt:
                 continue
     except BrokenPipeError:
-        # BrokenPipeError is thrown by writelines() or close() and indicates that the child trainer
-        # process is no more. We can safely retrieve its return code and exit with that, it should
-        # not block at this point.
+        # BrokenPipeError is thrown by writer.flush() or close() and indicates that the child trainer
+        # process is no more (or with multiple trainers, that all of them are gone). We can safely
+        # retrieve the return code and exit with that, it should not block at this point.
         logger.log("trainer stopped reading input")
-        sys.exit(model_trainer.wait())
+        sys.exit(wait_for_trainers())
 
 
 if __name__ == '__main__':
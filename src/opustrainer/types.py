@@ -1,5 +1,9 @@
+import copy
+import math
 from abc import ABC, abstractmethod
-from typing import NamedTuple, Dict, List, Iterable, Tuple, Optional, Any, Protocol
+from typing import NamedTuple, Dict, List, Iterable, Tuple, Optional, Any, Protocol, Callable, TypeVar
+
+from opustrainer.rng import local_random
 
 
 # List of tokens/words according to some tokenization scheme
@@ -44,10 +48,24 @@ class SentencePair(NamedTuple):
     alignments: Optional[List[Pair]]
 
 
+class Record(NamedTuple):
+    """A line from a data source, split into its fields but not tokenized."""
+    src: str
+    trg: str
+
+    # None if the line has no alignment field
+    alignments: Optional[List[Pair]]
+
+
 class Modifier(ABC):
     """Line modifier"""
     probability: float
 
+    # Whether the modifier draws all its random numbers from `local_random()`,
+    # which it needs to run in the threads of a ThreadModifierPool. Not if it
+    # uses the functions of the random module, itself or through a library.
+    thread_random: bool = False
+
     def __init__(self, probability:float, **kwargs:Dict[str,Any]):
         self.probability = probability
 
@@ -59,6 +77,113 @@ class Modifier(ABC):
         """
         pass
 
+    def noop(self) -> bool:
+        """Whether the modifier leaves every line as it is, e.g. because its
+        probability is 0. It may still draw random numbers while doing so."""
+        return False
+
     @abstractmethod
     def __call__(self, batch: List[str]) -> Iterable[str]:
         pass
+
+
+class PairModifier(Modifier):
+    """Modifier that can also change lines that have been parsed into
+    SentencePairs, so that a run of them only has to parse and format each line
+    once. See `opustrainer.modifiers.fused`. Given the same pairs and random
+    state, it draws the same random numbers and makes the same changes as its
+    `__call__` does to the lines."""
+
+    @abstractmethod
+    def modify_pairs(self, batch:List[SentencePair]) -> Iterable[SentencePair]:
+        pass
+
+
+T = TypeVar('T')
+
+
+def sample_lines(count:int, probability:float) -> List[int]:
+    """Indices of the lines out of `count` that are each picked with
+    `probability`. Instead of a random number per line, it draws the number of
+    lines to skip until the next one that is picked, which follows a geometric
+    distribution, so it takes one random number per line picked, plus one to
+    skip past the end unless the last line is picked. For a single line, that
+    is the one number it would take to decide on that line alone, and it is
+    picked for the same numbers."""
+    if probability >= 1.0:
+        return list(range(count))
+    if probability <= 0.0:
+        return []
+    indices = []
+    rng = local_random()
+    log_skip = math.log1p(-probability)
+    index = -1
+    while index + 1 < count:
+        # Compared as in LineModifier.apply(), so rounding can't tell them
+        # apart. Otherwise 1 - number is in (0, 1], so the log is defined.
+        number = rng.random()
+        index += 1 if probability > number else 1 + max(1, int(math.log(1.0 - number) / log_skip))
+        if index >= count:
+            break
+        indices.append(index)
+    return indices
+
+
+class LineModifier(Modifier):
+    """Modifier that changes each line with `probability`, on its own, and
+    leaves the other lines as they are.
+
+    Normally it draws a random number for each line to decide. With `sparse`
+    set, it picks the lines to change up front with `sample_lines()`, and the
+    other lines are not looked at. Unless each line is seeded on its own, that
+    picks different lines than without `sparse`, but just as many and as
+    randomly. A chunk of one line draws the same single number either way."""
+    sparse: bool = False
+
+    def noop(self) -> bool:
+        return self.probability <= 0
+
+    @abstractmethod
+    def modify(self, line:str) -> str:
+        """Changes a line, which has been picked to be changed"""
+        pass
+
+    def apply(self, line:str) -> str:
+        """Changes a line with `probability`"""
+        return self.modify(line) if self.probability > local_random().random() else line
+
+    def modify_pair(self, pair:SentencePair) -> SentencePair:
+        """Changes a line parsed into a SentencePair, which has been picked to
+        be changed. Implemented by the LineModifiers that are PairModifiers."""
+        raise NotImplementedError
+
+    def apply_pair(self, pair:SentencePair) -> SentencePair:
+        """Changes a parsed line with `probability`"""
+        return self.modify_pair(pair) if self.probability > local_random().random() else pair
+
+    def __call__(self, batch:List[str]) -> Iterable[str]:
+        return self._pick(batch, self.apply, self.modify)
+
+    def modify_pairs(self, batch:List[SentencePair]) -> Iterable[SentencePair]:
+        return self._pick(batch, self.apply_pair, self.modify_pair)
+
+    def _pick(self, batch:List[T], apply:Callable[[T],T], modify:Callable[[T],T]) -> Iterable[T]:
+        # Sparse only for probabilities at which the lines are picked with the
+        # same random numbers as apply() would use
+        if not self.sparse or not 0.0 < self.probability < 1.0:
+            return (apply(line) for line in batch)
+        lines = list(batch)
+        for index in sample_lines(len(lines), self.probability):
+            lines[index] = modify(lines[index])
+        return lines
+
+
+def make_sparse(modifiers:List[Modifier]) -> List[Modifier]:
+    """Copies of `modifiers` in which the LineModifiers are sparse."""
+    sparse = []
+    for modifier in modifiers:
+        if isinstance(modifier, LineModifier):
+            modifier = copy.copy(modifier)
+            modifier.sparse = True
+        sparse.append(modifier)
+    return sparse
@@ -0,0 +1,323 @@
+"""Writes the training data to the trainer program's stdin as large blocks of
+bytes instead of as many small lines."""
+import os
+import time
+from collections import deque
+from tempfile import TemporaryFile
+from threading import Thread, Condition
+from typing import BinaryIO, Deque, Generic, List, Optional, Tuple, TypeVar, Union, cast
+
+from opustrainer import logger
+
+
+# Not exposed by the fcntl module before Python 3.10
+F_SETPIPE_SZ = 1031
+
+# Maximum number of buffers a single writev() call accepts
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+def max_pipe_size() -> Optional[int]:
+    """Largest pipe buffer an unprivileged process may ask for, on Linux."""
+    try:
+        with open('/proc/sys/fs/pipe-max-size', 'r') as fh:
+            return int(fh.read())
+    except (OSError, ValueError):
+        return None
+
+
+def set_pipe_size(fileno:int, size:Optional[int]=None) -> Optional[int]:
+    """Enlarges the kernel buffer of a pipe, so the trainer can keep reading
+    while we're busy preparing the next batch. Returns the new size, or None
+    if the platform does not support resizing pipes."""
+    try:
+        import fcntl
+    except ImportError:
+        return None
+
+    if size is None:
+        size = max_pipe_size()
+        if size is None:
+            return None
+
+    try:
+        return fcntl.fcntl(fileno, getattr(fcntl, 'F_SETPIPE_SZ', F_SETPIPE_SZ), size)
+    except OSError:
+        return None
+
+
+class PipeWriter:
+    """Collects blocks of bytes and writes them with a single writev() call
+    once `buffer_size` bytes are pending. Keeps track of how many bytes were
+    written and how long writing blocked, to measure the throughput."""
+    fileno: int
+    buffer_size: int
+
+    # Total number of bytes written
+    bytes_written: int
+
+    # Total time spent in writev(), in seconds. This is mostly time spent
+    # waiting for the trainer to read from the pipe.
+    write_time: float
+
+    _pending: List[bytes]
+    _pending_size: int
+
+    def __init__(self, fileno:int, *, buffer_size:int=2**20):
+        self.fileno = fileno
+        self.buffer_size = buffer_size
+        self.bytes_written = 0
+        self.write_time = 0.0
+        self._pending = []
+        self._pending_size = 0
+        self._started = time.monotonic()
+
+    def write(self, block:bytes) -> None:
+        if not block:
+            return
+        self._pending.append(block)
+        self._pending_size += len(block)
+        if self._pending_size >= self.buffer_size:
+            self.flush()
+
+    def flush(self) -> None:
+        start = time.monotonic()
+        try:
+            while self._pending:
+                written = os.writev(self.fileno, self._pending[:IOV_MAX])
+                self.bytes_written += written
+                self._pending_size -= written
+
+                # Drop the buffers that were written entirely, and trim the one
+                # that was written partially (e.g. interrupted by a signal).
+                while written > 0:
+                    if written >= len(self._pending[0]):
+                        written -= len(self._pending.pop(0))
+                    else:
+                        self._pending[0] = self._pending[0][written:]
+                        written = 0
+        finally:
+            self.write_time += time.monotonic() - start
+
+    @property
+    def throughput(self) -> float:
+        """Bytes per second written since the writer was created."""
+        elapsed = time.monotonic() - self._started
+        return self.bytes_written / elapsed if elapsed > 0 else 0.0
+
+    def log_stats(self, loglevel:str="INFO", *, name:str="trainer") -> None:
+        elapsed = time.monotonic() - self._started
+        logger.log(f"Wrote {self.bytes_written} bytes to {name}, {self.throughput / 2**20:.2f} MiB/s, "
+                   f"blocked on the {name} for {self.write_time:.1f} of {elapsed:.1f} seconds", loglevel=loglevel)
+
+
+# Policies for a consumer whose buffer is full
+SLOW_CONSUMER_POLICIES = ('block', 'spill')
+
+# Maximum number of bytes read back from a spill file at once
+SPILL_READ_SIZE = 2**20
+
+
+class BufferedConsumer:
+    """Writes blocks to a PipeWriter from its own thread, through a buffer of at
+    most `maxsize` blocks, so one slow trainer does not hold up the others
+    right away. When the buffer is full, `put()` either blocks (policy 'block')
+    or appends the blocks to a temporary file in `tmpdir` (policy 'spill') until
+    the trainer has caught up. Blocks are written in the order they were put
+    either way."""
+    writer: PipeWriter
+    maxsize: int
+    policy: str
+
+    # Error raised while writing, e.g. BrokenPipeError if the trainer stopped
+    error: Optional[BaseException]
+
+    # Total number of bytes that went through the spill file
+    spilled_bytes: int
+
+    def __init__(self, writer:PipeWriter, *, maxsize:int=16, policy:str='block', tmpdir:Optional[str]=None, name:Optional[str]=None):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f'unknown slow consumer policy: {policy}')
+        self.writer = writer
+        self.maxsize = max(maxsize, 1)
+        self.policy = policy
+        self.tmpdir = tmpdir
+        self.error = None
+        self.spilled_bytes = 0
+        self._blocks: Deque[bytes] = deque()
+        self._cond = Condition()
+        self._closed = False
+
+        # Blocks in the spill file come after all blocks in `_blocks`.
+        self._spill: Optional[BinaryIO] = None
+        self._spill_read = 0
+        self._spill_written = 0
+
+        self._thread = Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def put(self, block:bytes) -> None:
+        with self._cond:
+            if self.error is not None:
+                raise self.error
+
+            if self.policy == 'spill' and (self._spill_read < self._spill_written or len(self._blocks) >= self.maxsize):
+                self._write_spill(block)
+            else:
+                while len(self._blocks) >= self.maxsize and self.error is None:
+                    self._cond.wait()
+                if self.error is not None:
+                    raise self.error
+                self._blocks.append(block)
+
+            self._cond.notify_all()
+
+    def _write_spill(self, block:bytes) -> None:
+        if self._spill is None:
+            self._spill = cast(BinaryIO, TemporaryFile(dir=self.tmpdir))
+        self._spill.seek(self._spill_written)
+        self._spill.write(block)
+        self._spill.flush()
+        self._spill_written += len(block)
+        self.spilled_bytes += len(block)
+
+    def _next(self) -> Optional[bytes]:
+        """Next block to write, or None once closed and everything is written."""
+        with self._cond:
+            while True:
+                if self._blocks:
+                    block = self._blocks.popleft()
+                    self._cond.notify_all()
+                    return block
+                if self._spill_read < self._spill_written:
+                    offset, length = self._spill_read, min(self._spill_written - self._spill_read, SPILL_READ_SIZE)
+                    break
+                if self._closed:
+                    return None
+                self._cond.wait()
+
+        # Only this thread reads from the spill file, and put() only appends to
+        # it, so this part does not need the lock.
+        assert self._spill is not None
+        block = os.pread(self._spill.fileno(), length, offset)
+
+        with self._cond:
+            self._spill_read += len(block)
+            if self._spill_read == self._spill_written:
+                # Caught up: start using the in-memory buffer again
+                self._spill.truncate(0)
+                self._spill_read = self._spill_written = 0
+        return block
+
+    def _run(self) -> None:
+        try:
+            while True:
+                block = self._next()
+                if block is None:
+                    break
+                self.writer.write(block)
+            self.writer.flush()
+        except BaseException as exc:
+            with self._cond:
+                self.error = exc
+                self._cond.notify_all()
+
+    def close(self) -> None:
+        """Waits until everything that was put is written. Raises the error
+        that stopped writing, if any."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        if self.error is not None:
+            raise self.error
+
+
+class TeeWriter:
+    """Writes the same blocks to multiple trainers, each through their own
+    BufferedConsumer. Trainers that stop reading are dropped; once none are
+    left, BrokenPipeError is raised."""
+    consumers: List[BufferedConsumer]
+
+    def __init__(self, consumers:List[BufferedConsumer]):
+        self.consumers = consumers
+        self._live = list(range(len(consumers)))
+
+    def _drop(self, index:int, exc:BaseException) -> None:
+        if not isinstance(exc, OSError):
+            raise exc
+        logger.log(f"trainer {index} stopped reading input")
+        self._live.remove(index)
+        if not self._live:
+            raise BrokenPipeError('all trainers stopped reading input')
+
+    @property
+    def bytes_written(self) -> int:
+        """Number of bytes that every trainer still reading has been sent."""
+        return min((self.consumers[index].writer.bytes_written for index in self._live), default=0)
+
+    def write(self, block:bytes) -> None:
+        for index in list(self._live):
+            try:
+                self.consumers[index].put(block)
+            except BaseException as exc:
+                self._drop(index, exc)
+
+    def flush(self) -> None:
+        """Writes out everything, after which nothing can be written anymore."""
+        for index in list(self._live):
+            try:
+                self.consumers[index].close()
+            except BaseException as exc:
+                self._drop(index, exc)
+
+    def log_stats(self, loglevel:str="INFO") -> None:
+        for index, consumer in enumerate(self.consumers):
+            consumer.writer.log_stats(loglevel=loglevel, name=f"trainer {index}")
+            if consumer.spilled_bytes > 0:
+                logger.log(f"Spilled {consumer.spilled_bytes} bytes to disk for trainer {index}", loglevel=loglevel)
+
+
+T = TypeVar('T')
+
+
+class WriteTracker(Generic[T]):
+    """Pairs each block written with a value, e.g. the trainer state that goes
+    with a batch, and reports the value of the last block that was actually
+    written out. PipeWriter holds on to blocks until its buffer is full, and
+    with TeeWriter they're written from other threads, so a block passed to
+    `write()` may not have reached the trainer yet."""
+    writer: Union[PipeWriter,TeeWriter]
+
+    # Value that goes with the last block written out entirely
+    written: T
+
+    def __init__(self, writer:Union[PipeWriter,TeeWriter], initial:T):
+        self.writer = writer
+        self.written = initial
+        self._offset = 0
+        self._pending: Deque[Tuple[int,T]] = deque()
+
+    def write(self, block:bytes, value:T) -> T:
+        """Writes block, and returns the value of the last block written out."""
+        self.writer.write(block)
+        self._offset += len(block)
+        self._pending.append((self._offset, value))
+        return self.update()
+
+    def flush(self) -> T:
+        self.writer.flush()
+        return self.update()
+
+    def update(self) -> T:
+        """Catches up with what the writer wrote out in the meantime."""
+        bytes_written = self.writer.bytes_written
+        while self._pending and self._pending[0][0] <= bytes_written:
+            _, self.written = self._pending.popleft()
+        return self.written
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+import os
+import unittest
+from unittest import mock
+
+from opustrainer import affinity
+from opustrainer.affinity import parse_cpu_list, format_cpu_list, resolve_cpus, worker_cpus, plan_layout
+
+
+class TestAffinity(unittest.TestCase):
+    def test_cpu_list(self):
+        self.assertEqual(parse_cpu_list('0-3,8,10-11'), [0, 1, 2, 3, 8, 10, 11])
+        self.assertEqual(parse_cpu_list('3,1-2,2'), [1, 2, 3])
+        self.assertEqual(format_cpu_list([0, 1, 2, 3, 8, 10, 11]), '0-3,8,10-11')
+        self.assertEqual(format_cpu_list(parse_cpu_list('5,0-1')), '0-1,5')
+        with self.assertRaises(ValueError):
+            parse_cpu_list('0-3,x')
+
+    def test_resolve_cpus(self):
+        self.assertEqual(resolve_cpus('2-5', [0, 1, 2, 3]), [2, 3])
+        with self.assertRaisesRegex(ValueError, 'none of the CPUs'):
+            resolve_cpus('8-9', [0, 1, 2, 3])
+        with mock.patch.object(affinity, 'numa_nodes', return_value={0: [0, 1], 1: [2, 3]}):
+            self.assertEqual(resolve_cpus('node1,0', [0, 1, 2, 3]), [0, 2, 3])
+            with self.assertRaisesRegex(ValueError, 'no NUMA node 2'):
+                resolve_cpus('node2', [0, 1, 2, 3])
+
+    def test_worker_cpus(self):
+        self.assertEqual([worker_cpus(index, 3, [4, 5, 6, 7]) for index in range(3)], [[4], [5], [6]])
+        self.assertEqual(worker_cpus(2, 3, [4, 5]), [4, 5])
+
+    def test_plan_layout(self):
+        with mock.patch.object(affinity, 'available_cpus', return_value=list(range(8))), \
+             mock.patch.object(affinity, 'cgroup_cpu_limit', return_value=None):
+            # Nothing asked for, nothing pinned
+            layout = plan_layout()
+            self.assertEqual((layout.trainer, layout.main, layout.workers, layout.shuffle, layout.budget), ([], [], [], [], 8))
+
+            layout = plan_layout(trainer='2')
+            self.assertEqual(layout.trainer, [6, 7])
+            self.assertEqual(layout.main, list(range(6)))
+            self.assertEqual(layout.workers, list(range(6)))
+            self.assertEqual(layout.budget, 6)
+
+            layout = plan_layout(trainer='0-1', workers='2-5', shuffle='6-7')
+            self.assertEqual((layout.trainer, layout.workers, layout.shuffle, layout.budget), ([0, 1], [2, 3, 4, 5], [6, 7], 4))
+
+            with self.assertRaises(ValueError):
+                plan_layout(trainer='8')
+
+        with mock.patch.object(affinity, 'available_cpus', return_value=list(range(8))), \
+             mock.patch.object(affinity, 'cgroup_cpu_limit', return_value=4.5):
+            self.assertEqual(plan_layout().budget, 4)
+            self.assertEqual(plan_layout(trainer='2').budget, 2)
+
+    @unittest.skipUnless(hasattr(os, 'sched_getaffinity'), 'needs sched_getaffinity')
+    def test_available_cpus(self):
+        self.assertEqual(affinity.available_cpus(), sorted(os.sched_getaffinity(0)))
+
+
+if __name__ == '__main__':
+    unittest.main()
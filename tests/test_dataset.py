@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+import json
+import unittest
+
+from contextlib import closing
+from itertools import islice
+
+from opustrainer.trainer import CurriculumLoader, Trainer
+from opustrainer.dataset import CurriculumDataset, parse_record
+from opustrainer.types import Pair
+
+
+CONFIG = {
+	'datasets': {
+		'clean': 'contrib/test-data/clean',
+		'medium': 'contrib/test-data/medium',
+	},
+	'stages': [
+		'start',
+		'mid'
+	],
+	'start': [
+		'clean 0.8',
+		'medium 0.2',
+		'until clean 1'
+	],
+	'mid': [
+		'clean 0.6',
+		'medium 0.4',
+		'until medium 1',
+	],
+	'modifiers': [
+		{'UpperCase': 0.25}
+	],
+	'seed': 1111
+}
+
+
+class TestCurriculumDataset(unittest.TestCase):
+	def test_batches(self):
+		"""Test that the dataset yields the same lines as the trainer."""
+		with closing(Trainer(CurriculumLoader().load(CONFIG))) as trainer:
+			reference = [[line.rstrip('\n') for line in batch] for batch in trainer.run()]
+
+		self.assertEqual(list(CurriculumDataset(CONFIG)), reference)
+
+	def test_records(self):
+		"""Test that lines with alignments are split into records."""
+		dataset = CurriculumDataset('contrib/test_enzh_config_plain.yml', records=True, batch_size=10)
+		batch = next(iter(dataset))
+		self.assertEqual(len(batch), 10)
+		for record in batch:
+			self.assertTrue(record.src)
+			self.assertTrue(record.trg)
+			self.assertIsInstance(record.alignments, list)
+
+		self.assertEqual(parse_record('a b\tc\t0-0 1-0'), ('a b', 'c', [Pair(0, 0), Pair(1, 0)]))
+		self.assertEqual(parse_record('a b\tc'), ('a b', 'c', None))
+
+	def test_state_dict(self):
+		"""Test that a dataset restored from a state dict, even one that went
+		through JSON, continues after the last batch before it was saved."""
+		reference = list(CurriculumDataset(CONFIG, world_size=2, rank=1))
+
+		dataset = CurriculumDataset(CONFIG, world_size=2, rank=1)
+		batches = list(islice(dataset, 5))
+		state_dict = json.loads(json.dumps(dataset.state_dict()))
+
+		restored = CurriculumDataset(CONFIG, world_size=2, rank=1)
+		restored.load_state_dict(state_dict)
+		batches.extend(restored)
+
+		self.assertEqual(batches, reference)
+
+		# Each batch can also come with its own state
+		batch, state = next(iter(CurriculumDataset(CONFIG, world_size=2, rank=1, return_state=True)))
+		self.assertEqual(batch, reference[0])
+		self.assertEqual(state['shards'], 2)
+		self.assertEqual(state['states'][1]['batch'], 2)
@@ -1,3 +1,4 @@
+import os
 import subprocess
 import sys
 import tempfile
@@ -10,10 +11,12 @@ class TestEndToEnd(unittest.TestCase):
     '''Tests the pipeline end-to-end. Aimed to to test consistent output.'''
 
     def __clean_states(self):
-        """Remove state files"""
+        """Remove state and catalog files"""
         basepath = Path("contrib")
         for state in basepath.glob("*.yml.state"):
             state.unlink(missing_ok=True)
+        for catalog in basepath.glob("*.yml.catalog"):
+            catalog.unlink(missing_ok=True)
 
     def setUp(self) -> None:
         self.__clean_states()
@@ -51,9 +54,13 @@ class TestEndToEnd(unittest.TestCase):
             'contrib/test-data/test_zhen_config.expected.out')
 
     def test_prefix_augment(self):
-        self.assertEndToEnd(
-            ['-c', 'contrib/test_zhen_prefix_config.yml', '-d', '--sync'],
-            'contrib/test-data/test_zhen_config_prefix.expected.out')
+        """Also with --fuse-modifiers, where UpperCase and TitleCase share the
+        parsed lines and Typos and Prefix get them as strings."""
+        for mode in [[], ['--fuse-modifiers']]:
+            with self.subTest(mode=mode):
+                self.assertEndToEnd(
+                    ['-c', 'contrib/test_zhen_prefix_config.yml', '-d', '--sync', *mode],
+                    'contrib/test-data/test_zhen_config_prefix.expected.out')
 
     def test_no_shuffle(self):
         """Confirms that when an empty training procedure is used with
@@ -70,10 +77,32 @@ class TestEndToEnd(unittest.TestCase):
                     ],
                     'contrib/test-data/clean.enzh.10')
 
+    def test_tee(self):
+        """Confirms that additional trainers get the same output."""
+        for policy in ['block', 'spill']:
+            with self.subTest(policy=policy), tempfile.TemporaryDirectory() as tmpdir:
+                outputs = [os.path.join(tmpdir, f'{n}.out') for n in range(2)]
+                self.assertEndToEnd(
+                    [
+                        '-c', 'contrib/test_enzh_config.yml', '-d', '--sync',
+                        '--slow-consumer', policy,
+                        '--tee-buffer', '1',
+                        *(arg for output in outputs for arg in ['--tee', f'sh -c "cat > {output}"'])
+                    ],
+                    'contrib/test-data/test_enzh_config.expected.out')
+                for output in outputs:
+                    with open(output, 'r', encoding='utf-8') as fh, \
+                        open('contrib/test-data/test_enzh_config.expected.out', 'r', encoding='utf-8') as reference:
+                        self.assertEqual(fh.read(), reference.read())
+
     def test_advanced_config(self):
-        self.assertEndToEnd(
-            ['-c', 'contrib/test_enzh_tags_advanced_config.yml', '-d', '-n'],
-            'contrib/test-data/test_enzh_tags_advanced_config.expected.out')
+        """Also with --fuse-modifiers, where Tags and the UpperCase after it
+        share the parsed lines."""
+        for mode in [[], ['--fuse-modifiers']]:
+            with self.subTest(mode=mode):
+                self.assertEndToEnd(
+                    ['-c', 'contrib/test_enzh_tags_advanced_config.yml', '-d', '-n', *mode],
+                    'contrib/test-data/test_enzh_tags_advanced_config.expected.out')
 
     def test_stage_config(self):
         self.assertEndToEnd(
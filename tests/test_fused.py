@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+import random
+import unittest
+
+from opustrainer.modifiers import make_sparse
+from opustrainer.modifiers.fused import FusedModifier, fuse_modifiers, parse_pair, format_pair
+from opustrainer.modifiers.surface import UpperCaseModifier, TitleCaseModifier
+from opustrainer.modifiers.prefix import PrefixModifier
+from opustrainer.modifiers.placeholders import PlaceholderTagModifier
+from opustrainer.modifiers.retokenize import RetokenizeModifier
+from opustrainer.modifiers.typos import TypoModifier
+from opustrainer.types import Pair, SentencePair
+
+
+def run(modifiers, lines):
+    random.seed(1)
+    for modifier in modifiers:
+        lines = list(modifier(lines))
+    return lines
+
+
+def words(lines):
+    return [[field.split() for field in line.split('\t')] for line in lines]
+
+
+class TestFused(unittest.TestCase):
+    def setUp(self):
+        with open('contrib/test-data/clean.zhen.10', 'r', encoding='utf-8') as fh:
+            self.lines = fh.read().splitlines() * 20
+
+    def test_parse_pair(self):
+        self.assertEqual(parse_pair('a b\tc\t0-0 1-0'), SentencePair(['a', 'b'], ['c'], [Pair(0, 0), Pair(1, 0)]))
+        self.assertEqual(parse_pair('a b\tc\t'), SentencePair(['a', 'b'], ['c'], []))
+        self.assertEqual(parse_pair('a b\tc'), SentencePair(['a', 'b'], ['c'], None))
+        for line in ['a b\tc\t0-0 1-0', 'a b\tc\t', 'a b\tc']:
+            self.assertEqual(format_pair(parse_pair(line)), line)
+
+        for line in ['a b', 'a\tb\t0-0\tx', 'a\tb\t0-1', 'a\tb\t0']:
+            with self.assertRaises(ValueError):
+                parse_pair(line)
+
+    def test_fuse_modifiers(self):
+        modifiers = [
+            UpperCaseModifier(0.2),
+            TitleCaseModifier(0.2),
+            TypoModifier(0.2),
+            PrefixModifier(0.2),
+            TypoModifier(0.2),
+            PrefixModifier(0.2),
+            PlaceholderTagModifier(0.2),
+        ]
+        fused = fuse_modifiers(modifiers)
+        self.assertEqual([type(modifier) for modifier in fused],
+            [FusedModifier, TypoModifier, PrefixModifier, TypoModifier, FusedModifier])
+        self.assertEqual(fused[0].modifiers, modifiers[:2])
+        self.assertEqual(fused[-1].modifiers, modifiers[-2:])
+        self.assertEqual(fuse_modifiers([]), [])
+
+    def test_same_output(self):
+        """Test that the fused modifiers draw the same random numbers and change
+        the lines the same way as the modifiers on their own."""
+        configs = {
+            'surface': [UpperCaseModifier(0.3), TitleCaseModifier(0.3), PrefixModifier(0.3)],
+            'sparse': make_sparse([UpperCaseModifier(0.3), TitleCaseModifier(0.3), PrefixModifier(0.3)]),
+            'tags': [PrefixModifier(0.3), UpperCaseModifier(0.3), PlaceholderTagModifier(0.5, custom_detok_src='zh')],
+            'retokenize': [TitleCaseModifier(0.3), RetokenizeModifier(0, src={'detokenize': 'moses:zh'})],
+        }
+        for name, modifiers in configs.items():
+            with self.subTest(config=name):
+                fused = fuse_modifiers(modifiers)
+                self.assertLess(len(fused), len(modifiers))
+                output = run(modifiers, self.lines)
+                self.assertNotEqual(output, self.lines)
+                self.assertEqual(run(fused, self.lines), output)
+
+        # Typos may leave two spaces between words, which the modifiers after it
+        # put back to one.
+        modifiers = [UpperCaseModifier(0.3), TitleCaseModifier(0.3), TypoModifier(0.5), PrefixModifier(0.3), UpperCaseModifier(0.3)]
+        self.assertEqual(words(run(fuse_modifiers(modifiers), self.lines)), words(run(modifiers, self.lines)))
+
+    def test_unparsed(self):
+        """Test that chunks with lines that can't be parsed still go through the
+        modifiers, and lines without alignments are skipped by Tags."""
+        modifiers = [UpperCaseModifier(0.5), TitleCaseModifier(0.5)]
+        lines = [line.split('\t')[0] for line in self.lines]
+        self.assertEqual(run(fuse_modifiers(modifiers), lines), run(modifiers, lines))
+
+        modifiers = [UpperCaseModifier(0.5), PlaceholderTagModifier(0.5)]
+        lines = ['\t'.join(line.split('\t')[:2]) for line in self.lines[:10]]
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(run(fuse_modifiers(modifiers), lines), [])
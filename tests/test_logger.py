@@ -30,3 +30,21 @@ class TestLogger(unittest.TestCase):
             self.assertEqual(line4,"[INFO] Once message2")
             line5 = tmpfile.readline().decode('utf-8').strip().split(' [Trainer] ')[1]
             self.assertEqual(line5,"[INFO] Final message")
+
+
+    def test_log_once_maxsize(self):
+        '''Tests that log_once forgets the least recently seen messages'''
+        log_once = logger.LogOnce(maxsize=2)
+        with tempfile.NamedTemporaryFile(suffix='.log', prefix="logger") as tmpfile:
+            logger.setup_logger(outputfilename=tmpfile.name, disable_stderr=True)
+            log_once("A")
+            log_once("B")
+            log_once("A") # Seen, and now more recent than B
+            log_once("C") # Forgets B
+            log_once("A")
+            log_once("B")
+            logger.logging.shutdown()
+            self.assertEqual(len(log_once), 2)
+            tmpfile.seek(0)
+            lines = [line.decode('utf-8').strip().split(' [Trainer] ')[1] for line in tmpfile]
+            self.assertEqual(lines, ["[INFO] A", "[INFO] B", "[INFO] C", "[INFO] B"])
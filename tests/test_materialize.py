@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+import os
+import gzip
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from contextlib import closing
+from typing import List
+
+from opustrainer.trainer import CurriculumLoader, Trainer
+from opustrainer.materialize import Materializer
+
+
+CONFIG = {
+	'datasets': {
+		'clean': 'contrib/test-data/clean',
+		'medium': 'contrib/test-data/medium',
+	},
+	'stages': [
+		'start',
+		'mid',
+	],
+	'start': [
+		'clean 0.8',
+		'medium 0.2',
+		'until clean 1'
+	],
+	'mid': [
+		'clean 0.6',
+		'medium 0.4',
+		'until medium 1',
+	],
+	'modifiers': [
+		{'UpperCase': 0.25}
+	],
+	'seed': 1111
+}
+
+
+def read_shard(path:str, offset:int=0) -> bytes:
+	with open(path, 'rb') as fh:
+		fh.seek(offset)
+		return gzip.decompress(fh.read())
+
+
+class TestMaterializer(unittest.TestCase):
+	def reference(self, num_shards:int) -> List[bytes]:
+		curriculum = CurriculumLoader().load(CONFIG)
+		with closing(Trainer(curriculum)) as trainer:
+			batches = list(trainer.run(processes=2, binary=True))
+		return [b''.join(batches[n::num_shards]) for n in range(num_shards)]
+
+	def test_shards(self):
+		"""Test that batches are spread round-robin over the shards, and that
+		the manifest points at where each stage starts in each shard."""
+		curriculum = CurriculumLoader().load(CONFIG)
+		with tempfile.TemporaryDirectory() as tmpdir:
+			with closing(Trainer(curriculum)) as trainer:
+				manifest = Materializer(tmpdir, shards=3).run(trainer, processes=2)
+
+			self.assertTrue(manifest.complete)
+			self.assertEqual([stage.stage for stage in manifest.stages], ['start', 'mid'])
+
+			shards = [read_shard(os.path.join(tmpdir, file)) for file in manifest.files]
+			self.assertEqual(shards, self.reference(3))
+			self.assertEqual(manifest.lines, sum(shard.count(b'\n') for shard in shards))
+
+			# The mid stage can be read by seeking to its offsets
+			mid = manifest.stages[1]
+			for file, shard, offset in zip(manifest.files, shards, mid.shards):
+				self.assertEqual(read_shard(os.path.join(tmpdir, file), offset.bytes).count(b'\n'), shard.count(b'\n') - offset.lines)
+
+			# Datasets were read up to the end of the start stage
+			self.assertEqual(mid.datasets['clean'].epoch, 1)
+
+	def test_resume(self):
+		"""Test that a run that was stopped, leaving data after its last
+		checkpoint, continues where it left off."""
+		curriculum = CurriculumLoader().load(CONFIG)
+		with tempfile.TemporaryDirectory() as tmpdir:
+			with closing(Trainer(curriculum)) as trainer:
+				manifest = Materializer(tmpdir, shards=2).run(trainer, max_lines=1000, processes=2)
+
+			self.assertFalse(manifest.complete)
+			self.assertGreaterEqual(manifest.lines, 1000)
+
+			# Simulate a crash after writing more than the checkpoint
+			with open(os.path.join(tmpdir, manifest.files[0]), 'ab') as fh:
+				fh.write(b'garbage')
+
+			with closing(Trainer(curriculum)) as trainer:
+				manifest = Materializer(tmpdir, shards=2).run(trainer, processes=2)
+
+			self.assertTrue(manifest.complete)
+			shards = [read_shard(os.path.join(tmpdir, file)) for file in manifest.files]
+			self.assertEqual(shards, self.reference(2))
+
+			# Only the state of the last checkpoint is kept
+			self.assertEqual(
+				sorted(file for file in os.listdir(tmpdir) if file.startswith('state.')),
+				[manifest.state])
+
+	def test_options(self):
+		"""Test that the modifier options are checked the same way as those of
+		the trainer."""
+		for options in [['--autotune'], ['--modifier-pipeline', 'Tags=2', '--fuse-modifiers'], ['--modifier-pipeline', 'Nope=2']]:
+			errors = []
+			for command in [['opustrainer'], ['opustrainer.materialize', '-o', 'out']]:
+				process = subprocess.run([sys.executable, '-m', *command, '-c', 'x.yml', *options],
+					stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, encoding='utf-8')
+				self.assertEqual(process.returncode, 2)
+				errors.append(process.stderr.splitlines()[-1].split(': error: ')[1])
+			self.assertEqual(errors[0], errors[1])
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+import unittest
+
+from opustrainer.memory import MemoryBudget, parse_size, format_size, LINE_OVERHEAD
+
+
+class TestMemory(unittest.TestCase):
+    def test_parse_size(self):
+        self.assertEqual(parse_size('512'), 512)
+        self.assertEqual(parse_size('64K'), 64 * 2**10)
+        self.assertEqual(parse_size('16g'), 16 * 2**30)
+        self.assertEqual(parse_size('1.5TiB'), int(1.5 * 2**40))
+        self.assertEqual(parse_size('2 MB'), 2 * 2**20)
+        with self.assertRaises(ValueError):
+            parse_size('lots')
+
+    def test_format_size(self):
+        self.assertEqual(format_size(100), '100 B')
+        self.assertEqual(format_size(3 * 2**29), '1.5 GiB')
+
+    def test_budget(self):
+        budget = MemoryBudget(2**20, {'shuffle': 0.5, 'prefetch': 0.5})
+        self.assertEqual(budget.share('shuffle'), 2**19)
+        self.assertEqual(budget.lines('prefetch', 1024 - LINE_OVERHEAD), 512)
+        self.assertEqual(budget.lines('prefetch', 1024 - LINE_OVERHEAD, copies=2), 256)
+        with self.assertRaises(ValueError):
+            MemoryBudget(2**20, {'shuffle': 0.8, 'prefetch': 0.8})
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+import random
+import time
+import unittest
+from typing import Iterable, List
+
+from opustrainer.modifiers import Modifier
+from opustrainer.modifiers.planner import drop_noops, plan_modifiers
+from opustrainer.modifiers.surface import UpperCaseModifier, TitleCaseModifier
+from opustrainer.modifiers.placeholders import PlaceholderTagModifier
+
+
+class SlowModifier(Modifier):
+    def __call__(self, batch:List[str]) -> Iterable[str]:
+        for line in batch:
+            time.sleep(0.001)
+            yield line
+
+
+class BrokenModifier(Modifier):
+    def __call__(self, batch:List[str]) -> Iterable[str]:
+        raise RuntimeError('broken')
+
+
+class TestPlanner(unittest.TestCase):
+    def test_drop_noops(self):
+        upper, title, noop = UpperCaseModifier(0.5), TitleCaseModifier(0.0), UpperCaseModifier(0.0)
+        modifiers = [upper, noop]
+        self.assertEqual(drop_noops(modifiers), [upper])
+        # Modifiers that do nothing still draw random numbers for the ones after them
+        self.assertEqual(drop_noops([noop, upper, title, noop]), [noop, upper])
+        modifiers = [upper, title, upper]
+        self.assertIs(drop_noops(modifiers), modifiers)
+        # Tags without a probability still remove the alignments
+        tags = PlaceholderTagModifier(0.0)
+        self.assertEqual(drop_noops([tags, noop]), [tags])
+
+    def test_plan(self):
+        sample = [f'line {n}\tregel {n}' for n in range(64)]
+
+        plan = plan_modifiers([UpperCaseModifier(0.05)], sample, 16)
+        self.assertTrue(plan.inline)
+        self.assertEqual(len(plan.costs), 1)
+
+        plan = plan_modifiers([UpperCaseModifier(0.05), SlowModifier(1.0)], sample, 16)
+        self.assertFalse(plan.inline)
+        self.assertGreater(plan.costs[1], plan.transfer)
+
+        plan = plan_modifiers([UpperCaseModifier(0.0)], sample, 16)
+        self.assertTrue(plan.inline)
+        self.assertEqual(plan.modifiers, [])
+        self.assertEqual(len(plan.dropped), 1)
+
+        # Without lines to time them on, or if they fail, leave it to the workers
+        self.assertFalse(plan_modifiers([UpperCaseModifier(0.05)], None, 16).inline)
+        self.assertFalse(plan_modifiers([BrokenModifier(1.0)], sample, 16).inline)
+
+    def test_random_state(self):
+        random.seed(1)
+        state = random.getstate()
+        plan_modifiers([UpperCaseModifier(0.5)], ['line'], 16)
+        self.assertEqual(random.getstate(), state)
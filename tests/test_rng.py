@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+import unittest
+
+from opustrainer.rng import philox4x32, CounterKey
+
+
+class TestPhilox(unittest.TestCase):
+    def test_known_answers(self):
+        """Known answer tests of Philox4x32-10 from the Random123 library."""
+        self.assertEqual(
+            philox4x32((0, 0, 0, 0), (0, 0)),
+            (0x6627e8d5, 0xe169c58d, 0xbc57ac4c, 0x9b00dbd8))
+        self.assertEqual(
+            philox4x32((0xffffffff, 0xffffffff, 0xffffffff, 0xffffffff), (0xffffffff, 0xffffffff)),
+            (0x408f276d, 0x41c83b0e, 0xa20bc7c6, 0x6d5451fd))
+        self.assertEqual(
+            philox4x32((0x243f6a88, 0x85a308d3, 0x13198a2e, 0x03707344), (0xa4093822, 0x299f31d0)),
+            (0xd16cfe09, 0x94fdcceb, 0x5001e420, 0x24126ea1))
+
+    def test_line_seeds(self):
+        key = CounterKey(seed=1111, stage=0, batch=42)
+        self.assertEqual(key.line_seed(3), CounterKey(seed=1111, stage=0, batch=42).line_seed(3))
+        seeds = {key.line_seed(line) for line in range(1000)}
+        seeds.add(CounterKey(seed=1111, stage=1, batch=42).line_seed(0))
+        seeds.add(CounterKey(seed=1111, stage=0, batch=43).line_seed(0))
+        seeds.add(CounterKey(seed=1112, stage=0, batch=42).line_seed(0))
+        self.assertEqual(len(seeds), 1003)
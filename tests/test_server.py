@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+import os
+import socket
+import tempfile
+import unittest
+
+from contextlib import closing
+from threading import Thread
+from typing import Dict, List
+
+from opustrainer.trainer import CurriculumLoader, Trainer, StateTracker, StateLoader
+from opustrainer.server import BatchServer, BatchClient
+
+
+CONFIG = {
+	'datasets': {
+		'clean': 'contrib/test-data/clean',
+		'medium': 'contrib/test-data/medium',
+	},
+	'stages': [
+		'start',
+	],
+	'start': [
+		'clean 0.8',
+		'medium 0.2',
+		'until clean 1'
+	],
+	'modifiers': [
+		{'UpperCase': 0.25}
+	],
+	'seed': 1111
+}
+
+
+class TestBatchServer(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.tmpdir.name, 'socket')
+		self.state_path = os.path.join(self.tmpdir.name, 'state')
+		self.curriculum = CurriculumLoader().load(CONFIG)
+
+		with closing(Trainer(self.curriculum)) as trainer:
+			self.reference = list(trainer.run(processes=2, binary=True))
+
+	def tearDown(self):
+		self.tmpdir.cleanup()
+
+	def start_server(self, max_inflight:int) -> Thread:
+		server = BatchServer(self.path, max_inflight=max_inflight)
+
+		def serve():
+			with closing(Trainer(self.curriculum)) as trainer:
+				server.serve(trainer, StateTracker(self.state_path), processes=2)
+
+		thread = Thread(target=serve)
+		thread.start()
+		self.assertTrue(server.wait_until_ready(timeout=10))
+		return thread
+
+	def test_redelivery(self):
+		"""Test that batches a client did not acknowledge before disconnecting
+		are sent to another client, so together they receive every batch."""
+		server = self.start_server(max_inflight=3)
+		received: Dict[int,bytes] = {}
+
+		# First client acknowledges only the first of its batches and leaves
+		with BatchClient(self.path) as client:
+			batches = iter(client)
+			for _ in range(3):
+				batch_id, payload = next(batches)
+				received.setdefault(batch_id, payload)
+			client.ack(0)
+
+		# Second client consumes the rest
+		with BatchClient(self.path) as client:
+			for batch_id, payload in client:
+				received.setdefault(batch_id, payload)
+				client.ack(batch_id)
+
+		server.join(timeout=60)
+		self.assertFalse(server.is_alive())
+
+		self.assertEqual([received[batch_id] for batch_id in sorted(received)], self.reference)
+
+		# State is saved after the last batch
+		with open(self.state_path, 'r', encoding='utf-8') as fh:
+			self.assertEqual(StateLoader().load(fh).batch, len(self.reference))
+
+	def test_backpressure(self):
+		"""Test that a client gets no more than `max_inflight` batches without
+		acknowledging them, and that two clients share the batches."""
+		server = self.start_server(max_inflight=2)
+		received: List[int] = []
+
+		def consume(client:BatchClient):
+			for batch_id, _ in client:
+				received.append(batch_id)
+				client.ack(batch_id)
+
+		with BatchClient(self.path) as slow, BatchClient(self.path) as fast:
+			slow_batches = iter(slow)
+			slow_ids = [next(slow_batches)[0] for _ in range(2)]
+
+			# Nothing more is sent until the slow client acknowledges
+			slow.sock.settimeout(0.5)
+			with self.assertRaises(socket.timeout):
+				next(slow_batches)
+			slow.sock.settimeout(None)
+
+			received.extend(slow_ids)
+			for slow_id in slow_ids:
+				slow.ack(slow_id)
+
+			threads = [Thread(target=consume, args=(client,)) for client in (slow, fast)]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+
+		server.join(timeout=60)
+		self.assertEqual(sorted(received), list(range(len(self.reference))))
@@ -0,0 +1,44 @@
+import io
+import os
+import tempfile
+import unittest
+
+from array import array
+
+from opustrainer.shuffle import shuffle, write_index
+from opustrainer.iohints import DirectWriter
+
+
+class TestShuffle(unittest.TestCase):
+	def test_direct_io(self):
+		"""Test that spilling chunks with O_DIRECT yields the same shuffle as
+		spilling them through the page cache."""
+		lines = [f'line {n}\n'.encode() * (n % 7 + 1) for n in range(5000)]
+		with tempfile.TemporaryDirectory() as tmpdir:
+			for threads in [0, 2]:
+				with self.subTest(threads=threads):
+					buffered = list(shuffle(lines, 1000, seed=1, threads=threads, tmpdir=tmpdir))
+					direct = list(shuffle(lines, 1000, seed=1, threads=threads, tmpdir=tmpdir, direct_io=True))
+					self.assertEqual(buffered, direct)
+					self.assertEqual(sorted(direct), sorted(lines))
+
+	def test_direct_writer_length(self):
+		"""Test that the padding of the last block is truncated away."""
+		data = os.urandom(DirectWriter.BLOCK + 12345)
+		with tempfile.TemporaryDirectory() as tmpdir:
+			filename = os.path.join(tmpdir, 'out')
+			with DirectWriter(os.open(filename, os.O_WRONLY | os.O_CREAT)) as writer:
+				writer.write(data[:100])
+				writer.write(data[100:])
+			with open(filename, 'rb') as fh:
+				self.assertEqual(fh.read(), data)
+
+	def test_index(self):
+		"""Test that the index has the offset of each line in the output."""
+		lines = [f'line {n}\n'.encode() * (n % 7 + 1) for n in range(5000)]
+		index = io.BytesIO()
+		output = b''.join(write_index(shuffle(lines, 1000, seed=1), index))
+		offsets = array('Q', index.getvalue())
+		self.assertEqual(len(offsets), len(lines) + 1)
+		self.assertEqual(offsets[-1], len(output))
+		self.assertEqual(sorted(output[start:end] for start, end in zip(offsets, offsets[1:])), sorted(lines))
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+import random
+import unittest
+import unittest.mock
+
+from opustrainer.modifiers import make_sparse
+from opustrainer.modifiers.surface import UpperCaseModifier, TitleCaseModifier
+from opustrainer.modifiers.prefix import PrefixModifier
+from opustrainer.modifiers.pool import apply_modifiers
+from opustrainer.rng import CounterKey
+from opustrainer.types import sample_lines
+
+
+class TestSurface(unittest.TestCase):
+    def test_sample_lines(self):
+        random.seed(1)
+        self.assertEqual(sample_lines(10, 0.0), [])
+        self.assertEqual(sample_lines(10, 1.0), list(range(10)))
+
+        indices = sample_lines(100000, 0.05)
+        self.assertEqual(indices, sorted(set(indices)))
+        self.assertTrue(all(0 <= index < 100000 for index in indices))
+        self.assertAlmostEqual(len(indices) / 100000, 0.05, delta=0.005)
+
+        # Each line equally likely to be picked
+        counts = [0] * 10
+        for _ in range(10000):
+            for index in sample_lines(10, 0.3):
+                counts[index] += 1
+        for count in counts:
+            self.assertAlmostEqual(count / 10000, 0.3, delta=0.03)
+
+        # A single line takes one number, and is picked for the same ones
+        for number in [0.0, 0.29, 0.3, 0.31, 0.99]:
+            with unittest.mock.patch('random.random', side_effect=[number]):
+                self.assertEqual(sample_lines(1, 0.3), [0] if number < 0.3 else [])
+
+    def test_sparse(self):
+        """Test that sparse modifiers change as many lines, the same lines for
+        the same seed, and leave the original modifiers alone."""
+        lines = [f'line {n}\tlinea {n}\t0-0 1-1' for n in range(10000)]
+        modifiers = [UpperCaseModifier(0.1), TitleCaseModifier(0.05), PrefixModifier(0.02, min_words=1, max_words=2)]
+        sparse = make_sparse(modifiers)
+        self.assertEqual([modifier.sparse for modifier in sparse], [True, True, True])
+        self.assertEqual([modifier.sparse for modifier in modifiers], [False, False, False])
+
+        def run(modifiers):
+            random.seed(1)
+            batch = lines
+            for modifier in modifiers:
+                batch = list(modifier(batch))
+            return batch
+
+        output = run(sparse)
+        self.assertEqual(run(sparse), output)
+        self.assertNotEqual(run(modifiers), output)
+        self.assertEqual(len(output), len(lines))
+        self.assertAlmostEqual(sum(1 for line in output if line.startswith('LINE')) / len(lines), 0.1, delta=0.01)
+        self.assertAlmostEqual(sum(1 for line in output if line.startswith('__start__')) / len(lines), 0.02, delta=0.005)
+
+    def test_sparse_per_line(self):
+        """Test that with a random state per line, sparse modifiers change the
+        same lines, also when a modifier after them would change a line
+        differently had it drawn other numbers."""
+        lines = [f'line {n}\tlinea {n}' for n in range(2000)]
+        modifiers = [TitleCaseModifier(0.5), UpperCaseModifier(0.5)]
+        seed = CounterKey(1, 0, 0), 0
+        output = apply_modifiers(modifiers, lines, seed)
+        self.assertEqual(apply_modifiers(make_sparse(modifiers), lines, seed), output)
+        self.assertGreater(sum(1 for line in output if line.startswith('Line')), 0)
+        self.assertGreater(sum(1 for line in output if line.startswith('LINE')), 0)
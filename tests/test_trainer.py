@@ -2,22 +2,43 @@
 '''Tests the available functionality'''
 import os
 import tempfile
+import time
 import unittest
 
-from typing import IO, Type
+from typing import IO, List, Type
 from collections import Counter
 from contextlib import closing
+from dataclasses import replace
+from unittest import mock
 from textwrap import dedent
 from io import StringIO
-from itertools import chain
+from itertools import chain, zip_longest
 
 import yaml
 
-from opustrainer.trainer import Curriculum, CurriculumLoaderError, Dataset, DatasetReader, AsyncDatasetReader, CurriculumLoader, Trainer, StateTracker, Stage
+try:
+	import pyarrow
+	import pyarrow.parquet
+	import pyarrow.ipc
+except ImportError:
+	pyarrow = None
+
+from opustrainer.trainer import Curriculum, CurriculumLoaderError, Dataset, DatasetReader, AsyncDatasetReader, CurriculumLoader, Trainer, StateTracker, StateLoader, Stage
+from opustrainer.catalog import DatasetCatalog
+from opustrainer.memory import MemoryBudget
 from opustrainer.logger import log_once
+from opustrainer.modifiers.planner import plan_modifiers
 
 TEST_FILE: str
 
+def placed(*inline:bool):
+	"""Patches the planner to put the modifiers of each next stage in the
+	trainer or in the workers, as given."""
+	placements = list(inline)
+	def plan(modifiers, sample, chunk_size):
+		return replace(plan_modifiers(modifiers, None, chunk_size), inline=placements.pop(0))
+	return mock.patch('opustrainer.trainer.plan_modifiers', side_effect=plan)
+
 def setUpModule():
 	global TEST_FILE
 	fd, TEST_FILE = tempfile.mkstemp(text=True)
@@ -125,10 +146,46 @@ class TestDatasetReader(unittest.TestCase):
 		self.assertEqual(lines1, lines2)
 
 
+	def test_catalog(self):
+		"""Test that reading a dataset adds its statistics to the catalog, and
+		that a catalog file written by one reader is picked up by the next."""
+		with tempfile.TemporaryDirectory() as tmpdir:
+			catalog = DatasetCatalog(os.path.join(tmpdir, 'catalog'))
+			with closing(self.reader(Dataset('test', [TEST_FILE]), seed=1234, catalog=catalog)) as reader:
+				self.assertIsNone(reader.stats())
+				for _ in zip(range(10), reader):
+					pass
+				stats = reader.stats()
+
+			self.assertIsNotNone(stats)
+			self.assertEqual(stats.lines, 1000)
+			self.assertEqual(stats.bytes, os.path.getsize(TEST_FILE))
+			self.assertEqual(stats.fields, {1: 1000})
+			self.assertEqual(sum(stats.lengths.values()), 1000)
+
+			reloaded = DatasetCatalog(os.path.join(tmpdir, 'catalog'))
+			self.assertEqual(reloaded.get([TEST_FILE]), stats)
+
+
 class TestAsyncDatasetReader(TestDatasetReader):
 	"""Run all the same tests, but on the async reader that shuffles in advance."""
 	reader = AsyncDatasetReader
 
+	def test_close_while_shuffling(self):
+		"""Test that closing the reader while it is shuffling the next epoch
+		leaves none of the shuffler's temporary chunks behind."""
+		with tempfile.TemporaryDirectory() as tmpdir:
+			# Small enough for the shuffler to write a few dozen chunks
+			reader = AsyncDatasetReader(Dataset('test', [TEST_FILE]), seed=1234, tmpdir=tmpdir, shuffle_memory=10000)
+			with closing(reader):
+				next(reader)
+				pending = reader._pending
+				assert pending is not None and pending.chunks is not None
+				deadline = time.monotonic() + 10
+				while not os.listdir(pending.chunks) and pending.proc.poll() is None and time.monotonic() < deadline:
+					time.sleep(0.001)
+			self.assertEqual(os.listdir(tmpdir), [])
+
 
 class TestTrainer(unittest.TestCase):
 	def test_resume(self):
@@ -225,6 +282,510 @@ class TestTrainer(unittest.TestCase):
 
 		self.assertEqual(batches_linear, batches_parallel)
 
+	def test_stage_modifiers(self):
+		"""Test that the workers, which are kept for the whole run, switch to
+		the modifiers of each stage, however they were started."""
+		config = {
+			'datasets': {
+				'clean': 'contrib/test-data/clean',
+			},
+			'stages': [
+				'start',
+				'mid',
+				'end',
+			],
+			'start': {
+				'mix': [
+					'clean 1.0',
+					'until clean 1'
+				],
+				'modifiers': [
+					{'UpperCase': 1.0}
+				],
+			},
+			'mid': [
+				'clean 1.0',
+				'until clean 1'
+			],
+			'end': {
+				'mix': [
+					'clean 1.0',
+					'until clean 1'
+				],
+				'modifiers': [
+					{'TitleCase': 1.0}
+				],
+			},
+			'seed': 1
+		}
+		curriculum = CurriculumLoader().load(config)
+
+		with closing(Trainer(curriculum)) as trainer:
+			batches_ref = list(trainer.run(processes=0))
+
+		# Every line of the first stage is upper case, the second is untouched
+		self.assertTrue(all(line.isupper() for line in batches_ref[0]))
+		self.assertFalse(all(line.isupper() for line in batches_ref[10]))
+		self.assertEqual(len(batches_ref), 30)
+
+		for start_method in ['fork', 'forkserver']:
+			with self.subTest(start_method=start_method):
+				with closing(Trainer(curriculum)) as trainer, placed(False, False, False):
+					self.assertEqual(list(trainer.run(processes=2, start_method=start_method)), batches_ref)
+
+		with self.subTest(backend='threads'):
+			with closing(Trainer(curriculum)) as trainer, placed(False, False, False):
+				self.assertEqual(list(trainer.run(processes=2, backend='threads')), batches_ref)
+
+		# Refused before any stage starts if a later stage has Typos
+		typos = CurriculumLoader().load({**config, 'end': {**config['end'], 'modifiers': [{'Typos': 0.1}]}})
+		with closing(Trainer(typos)) as trainer, self.assertRaises(ValueError):
+			next(iter(trainer.run(processes=2, backend='threads')))
+
+		with self.subTest(stage_workers={'UpperCaseModifier': 2}):
+			with closing(Trainer(curriculum)) as trainer, placed(False, False, False):
+				self.assertEqual(list(trainer.run(processes=2, stage_workers={'UpperCaseModifier': 2})), batches_ref)
+
+		with closing(Trainer(curriculum, fuse=True)) as trainer, self.assertRaises(ValueError):
+			next(iter(trainer.run(processes=2, stage_workers={'UpperCaseModifier': 2})))
+
+		# Stages whose modifiers run in the trainer, and ones before and after
+		# them in the workers.
+		for inline in [(True, False, True), (False, True, False)]:
+			with self.subTest(inline=inline):
+				with closing(Trainer(curriculum)) as trainer, placed(*inline):
+					self.assertEqual(list(trainer.run(processes=2)), batches_ref)
+
+		with closing(Trainer(curriculum, rng='philox')) as trainer:
+			batches_philox = list(trainer.run(processes=0))
+		with closing(Trainer(curriculum, rng='philox')) as trainer, placed(True, False, True):
+			self.assertEqual(list(trainer.run(processes=2)), batches_philox)
+
+	def test_prefetch(self):
+		"""Test that reading and modifying ahead in separate threads yields the
+		same batches, and that the state dumped while doing so resumes exactly
+		after the last batch that was handed out."""
+		config = {
+			'datasets': {
+				'clean': 'contrib/test-data/clean',
+				'medium': 'contrib/test-data/medium',
+			},
+			'stages': [
+				'start',
+				'mid'
+			],
+			'start': [
+				'clean 0.8',
+				'medium 0.2',
+				'until clean 1'
+			],
+			'mid': [
+				'clean 0.6',
+				'medium 0.4',
+				'until medium 1',
+			],
+			'modifiers': [
+				{'UpperCase': 0.25}
+			],
+			'seed': 1111
+		}
+
+		curriculum = CurriculumLoader().load(config)
+
+		with closing(Trainer(curriculum)) as trainer:
+			batches_ref = list(trainer.run(processes=2))
+
+		with closing(Trainer(curriculum)) as trainer:
+			self.assertEqual(list(trainer.run(processes=2, prefetch=3)), batches_ref)
+
+		with tempfile.TemporaryDirectory() as tmpdir:
+			state_tracker = StateTracker(os.path.join(tmpdir, 'state_file'))
+
+			with closing(Trainer(curriculum)) as trainer1:
+				batches = [batch for _, batch in zip(range(10), state_tracker.run(trainer1, processes=2, prefetch=3))]
+
+			with closing(Trainer(curriculum)) as trainer2:
+				batches.extend(state_tracker.run(trainer2, processes=2, prefetch=3))
+
+		self.assertEqual(batches, batches_ref)
+
+	def test_memory_limit(self):
+		"""Test that a memory limit caps how far ahead batches are read, makes
+		the shuffler work in smaller chunks, and keeps the batches the same
+		as without a limit."""
+		config = {
+			'datasets': {
+				'clean': 'contrib/test-data/clean',
+				'medium': 'contrib/test-data/medium',
+			},
+			'stages': [
+				'start',
+			],
+			'start': [
+				'clean 0.8',
+				'medium 0.2',
+				'until clean 1'
+			],
+			'modifiers': [
+				{'UpperCase': 0.25}
+			],
+			'seed': 1111
+		}
+
+		curriculum = CurriculumLoader().load(config)
+		memory = MemoryBudget(2**18)
+
+		try:
+			with closing(Trainer(curriculum, memory=memory)) as trainer:
+				# 15% of 256 KiB does not fit three queues of 100 lines, but
+				# there is always room for one batch.
+				self.assertEqual(trainer.prefetch_limit(100, 10), 1)
+				self.assertEqual(trainer.prefetch_limit(100, 0), 0)
+				# 70% of 256 KiB split over two datasets
+				self.assertEqual(trainer.readers['clean'].shuffle_memory, int(2**18 * 0.7) // 2)
+				self.assertLess(trainer.readers['clean'].shuffle_batch_size() or 0, 1000)
+				batches_ref = list(trainer.run(processes=2, prefetch=10))
+				# Nothing is queued or in the workers once all batches are out
+				usage = trainer.memory_usage()
+				self.assertEqual(set(usage), {'shuffle', 'prefetch', 'pool', 'log'})
+				self.assertEqual((usage['prefetch'], usage['pool']), (0, 0))
+
+			# The size of log_once is back to what it was without a limit
+			self.assertIsNone(log_once.maxsize)
+
+			with closing(Trainer(curriculum, memory=memory)) as trainer:
+				self.assertEqual(list(trainer.run(processes=2, prefetch=10)), batches_ref)
+
+			# The shuffler merges its chunks by the random key of each line, so
+			# the size of the chunks makes no difference.
+			with closing(Trainer(curriculum)) as trainer:
+				self.assertEqual(list(trainer.run(processes=2)), batches_ref)
+		finally:
+			log_once.maxsize = None
+
+	def test_world_size(self):
+		"""Test that data-parallel ranks each get a disjoint part of the same
+		stream of batches, regardless of the world size, and that each rank can
+		resume where it stopped."""
+		config = {
+			'datasets': {
+				'clean': 'contrib/test-data/clean',
+				'medium': 'contrib/test-data/medium',
+			},
+			'stages': [
+				'start',
+				'mid'
+			],
+			'start': [
+				'clean 0.8',
+				'medium 0.2',
+				'until clean 1'
+			],
+			'mid': [
+				'clean 0.6',
+				'medium 0.4',
+				'until medium 1',
+			],
+			'modifiers': [
+				{'UpperCase': 0.25}
+			],
+			'seed': 1111
+		}
+
+		curriculum = CurriculumLoader().load(config)
+
+		def run(rank:int, world_size:int):
+			with closing(Trainer(curriculum, rank=rank, world_size=world_size)) as trainer:
+				return list(trainer.run(processes=2))
+
+		ranks2 = [run(rank, 2) for rank in range(2)]
+		ranks3 = [run(rank, 3) for rank in range(3)]
+
+		# Interleaving the batches of each rank gives the same stream
+		stream2 = [batch for batches in zip_longest(*ranks2) for batch in batches if batch is not None]
+		stream3 = [batch for batches in zip_longest(*ranks3) for batch in batches if batch is not None]
+		self.assertEqual(stream2, stream3)
+		self.assertEqual(ranks2[1], stream2[1::2])
+
+		with tempfile.TemporaryDirectory() as tmpdir:
+			state_tracker = StateTracker(os.path.join(tmpdir, 'state_file'))
+
+			with closing(Trainer(curriculum, rank=1, world_size=3)) as trainer1:
+				batches = [batch for _, batch in zip(range(5), state_tracker.run(trainer1, processes=2))]
+
+			with closing(Trainer(curriculum, rank=1, world_size=3)) as trainer2:
+				batches.extend(state_tracker.run(trainer2, processes=2))
+
+		self.assertEqual(batches, ranks3[1])
+
+	def test_counter_rng(self):
+		"""Test that with the philox generator the batches are the same for any
+		number of workers, chunk size and world size."""
+		config = {
+			'datasets': {
+				'clean': 'contrib/test-data/clean',
+				'medium': 'contrib/test-data/medium',
+			},
+			'stages': [
+				'start',
+				'mid'
+			],
+			'start': [
+				'clean 0.8',
+				'medium 0.2',
+				'until clean 1'
+			],
+			'mid': [
+				'clean 0.6',
+				'medium 0.4',
+				'until medium 1',
+			],
+			'modifiers': [
+				{'UpperCase': 0.25},
+				{'TitleCase': 0.25},
+			],
+			'seed': 1111
+		}
+
+		curriculum = CurriculumLoader().load(config)
+
+		def run(rank:int=0, world_size:int=1, **kwargs):
+			with closing(Trainer(curriculum, rank=rank, world_size=world_size, rng='philox')) as trainer:
+				return list(trainer.run(**kwargs))
+
+		batches_ref = run(processes=0, chunk_size=16)
+		self.assertEqual(run(processes=2, chunk_size=16), batches_ref)
+		self.assertEqual(run(processes=3, chunk_size=7), batches_ref)
+		self.assertEqual(run(processes=2, chunk_size=100, prefetch=2), batches_ref)
+		self.assertEqual(run(processes=2, chunk_size=5, inflight=1), batches_ref)
+		self.assertEqual(run(processes=3, chunk_size=5, inflight=64, transport='shm'), batches_ref)
+		# Deciding on new chunk sizes and workers after every batch
+		with placed(False, False):
+			self.assertEqual(run(processes=3, chunk_size=5, autotune=0), batches_ref)
+		with placed(False, False):
+			self.assertEqual(run(processes=2, chunk_size=16, autotune=0, backend='threads'), batches_ref)
+
+		ranks = [run(rank, 2, processes=2) for rank in range(2)]
+		self.assertEqual([batch for batches in zip_longest(*ranks) for batch in batches if batch is not None], batches_ref)
+
+		# Modifiers were applied, and not to everything
+		upper = sum(1 for line in chain(*batches_ref) if line.isupper())
+		self.assertGreater(upper, 0)
+		self.assertLess(upper, sum(len(batch) for batch in batches_ref))
+
+		with self.assertRaises(ValueError):
+			Trainer(curriculum, rng='mersenne')
+
+		with closing(Trainer(curriculum)) as trainer, self.assertRaises(ValueError):
+			next(iter(trainer.run(processes=2, autotune=0)))
+
+		# Each line draws its own random number either way, so sparse modifiers
+		# change the same lines.
+		with closing(Trainer(curriculum, rng='philox', sparse=True)) as trainer:
+			self.assertEqual(list(trainer.run(processes=2, chunk_size=7)), batches_ref)
+
+		# Also when the modifier after them would change a line differently had
+		# it drawn another number: upper case after title case undoes it.
+		swapped = CurriculumLoader().load({**config, 'modifiers': [{'TitleCase': 0.5}, {'UpperCase': 0.5}]})
+		with closing(Trainer(swapped, rng='philox')) as trainer:
+			batches_swapped = list(trainer.run(processes=0))
+		with closing(Trainer(swapped, rng='philox', sparse=True)) as trainer:
+			self.assertEqual(list(trainer.run(processes=2, chunk_size=7)), batches_swapped)
+
+		# With a random state per chunk they change other lines, but just as
+		# reproducibly.
+		with closing(Trainer(curriculum)) as trainer:
+			batches_legacy = list(trainer.run(processes=0))
+		with closing(Trainer(curriculum, sparse=True)) as trainer:
+			batches_sparse = list(trainer.run(processes=0))
+		self.assertNotEqual(batches_sparse, batches_legacy)
+		with closing(Trainer(curriculum, sparse=True)) as trainer:
+			self.assertEqual(list(trainer.run(processes=2)), batches_sparse)
+
+	def test_read_by_offset(self):
+		"""Test that batches read by the modifier workers are the same as those
+		read by the trainer, and that the shuffled files are removed."""
+		config = {
+			'datasets': {
+				'clean': 'contrib/test-data/clean',
+				'medium': 'contrib/test-data/medium',
+			},
+			'stages': [
+				'start',
+				'mid'
+			],
+			'start': [
+				'clean 0.8',
+				'medium 0.2',
+				'until clean 1'
+			],
+			'mid': [
+				'clean 0.6',
+				'medium 0.4',
+				'until medium 2',
+			],
+			'modifiers': [
+				{'UpperCase': 0.25},
+				{'TitleCase': 0.25},
+			],
+			'seed': 1111
+		}
+
+		curriculum = CurriculumLoader().load(config)
+
+		def run(rng:str, rank:int=0, world_size:int=1, read_by_offset:bool=False, **kwargs):
+			with tempfile.TemporaryDirectory() as tmpdir:
+				with closing(Trainer(curriculum, reader=AsyncDatasetReader, tmpdir=tmpdir, rng=rng, rank=rank, world_size=world_size, read_by_offset=read_by_offset)) as trainer:
+					batches = list(trainer.run(**kwargs))
+					state = trainer.state()
+				if read_by_offset:
+					self.assertEqual(os.listdir(tmpdir), [])
+			return batches, state
+
+		for rng, world_size in [('philox', 1), ('legacy', 2)]:
+			with self.subTest(rng=rng, world_size=world_size):
+				batches_ref, state_ref = run(rng, world_size=world_size, processes=2)
+				self.assertEqual(run(rng, world_size=world_size, read_by_offset=True, processes=0), (batches_ref, state_ref))
+				self.assertEqual(run(rng, world_size=world_size, read_by_offset=True, processes=3, prefetch=2), (batches_ref, state_ref))
+
+		# Restoring skips lines without reading them
+		with closing(Trainer(curriculum, rng='philox', read_by_offset=True)) as trainer:
+			batches = iter(trainer.run(processes=2))
+			for _ in range(50):
+				next(batches)
+			state = trainer.state()
+			rest = list(batches)
+		with closing(Trainer(curriculum, rng='philox', read_by_offset=True)) as trainer:
+			trainer.restore(state)
+			self.assertEqual(list(trainer.run(processes=2)), rest)
+
+		with self.assertRaises(ValueError):
+			Trainer(curriculum, read_by_offset=True)
+
+	def test_skip_to(self):
+		"""Test that skipping to a batch gives the same batches as reading up to
+		it, including at stage boundaries and when a stage ends exactly at the
+		end of an epoch of its until dataset."""
+		config = {
+			'datasets': {
+				'clean': 'contrib/test-data/clean',
+				'medium': 'contrib/test-data/medium',
+			},
+			'stages': [
+				'start',
+				'mid',
+				'end',
+			],
+			'start': [
+				'clean 0.5',
+				'medium 0.5',
+				'until clean 1' # ends after 20 batches, at the end of an epoch
+			],
+			'mid': [
+				'clean 0.5',
+				'medium 0.5',
+				'until medium 1' # ends when medium finishes its epoch, after 60 batches
+			],
+			'end': [
+				'clean 0.3',
+				'medium 0.7',
+				'until clean 1'
+			],
+			'modifiers': [
+				{'UpperCase': 0.25}
+			],
+			'seed': 1111
+		}
+
+		curriculum = CurriculumLoader().load(config)
+
+		with tempfile.TemporaryDirectory() as tmpdir:
+			catalog = DatasetCatalog(os.path.join(tmpdir, 'catalog'))
+
+			for rng in ['legacy', 'philox']:
+				with closing(Trainer(curriculum, catalog=catalog, rng=rng)) as trainer:
+					batches_ref = list(trainer.run(processes=2))
+
+					spans = list(trainer.stage_spans(100))
+					self.assertEqual([(span.stage.name, span.first_batch, span.batches) for span in spans], [
+						('start', 0, 20),
+						('mid', 20, 60),
+						('end', 80, len(batches_ref) - 80),
+					])
+
+				for steps in [0, 7, 20, 21, 80, len(batches_ref) - 1]:
+					with self.subTest(rng=rng, steps=steps):
+						with closing(Trainer(curriculum, catalog=catalog, rng=rng)) as trainer:
+							trainer.skip_to(steps=steps)
+							self.assertEqual(list(trainer.run(processes=2)), batches_ref[steps:])
+
+				with closing(Trainer(curriculum, catalog=catalog, rng=rng)) as trainer:
+					trainer.skip_to(lines=sum(len(batch) for batch in batches_ref[:30]) + 5)
+					self.assertEqual(trainer.state().batch, 30)
+					self.assertEqual(list(trainer.run(processes=2)), batches_ref[30:])
+
+				with closing(Trainer(curriculum, catalog=catalog, rng=rng, rank=1, world_size=2)) as trainer:
+					batches_rank = list(trainer.run(processes=2))
+
+				with closing(Trainer(curriculum, catalog=catalog, rng=rng, rank=1, world_size=2)) as trainer:
+					trainer.skip_to(steps=11)
+					self.assertEqual(list(trainer.run(processes=2)), batches_rank[11:])
+
+				with closing(Trainer(curriculum, catalog=catalog, rng=rng)) as trainer:
+					with self.assertRaises(ValueError):
+						trainer.skip_to(steps=len(batches_ref) + 1)
+
+	def test_state_without_batch(self):
+		"""State files written before the batch counter was added still load."""
+		curriculum = CurriculumLoader().load({
+			'datasets': {'clean': TEST_FILE},
+			'stages': ['start'],
+			'start': ['clean 1.0', 'until clean 1'],
+			'seed': 1111
+		})
+
+		with closing(Trainer(curriculum)) as trainer:
+			fh = StringIO()
+			StateLoader().dump(trainer.state(), fh)
+
+		ymldata = yaml.load(fh.getvalue(), Loader=yaml.Loader)
+		del ymldata['batch']
+		state = StateLoader().load(StringIO(yaml.dump(ymldata)))
+		self.assertEqual(state.batch, 0)
+
+	def test_progress(self):
+		"""Test that once the dataset statistics are known, the trainer reports
+		how far along the stage it is and how many lines it expects to read."""
+		config = {
+			'datasets': {
+				'clean': TEST_FILE,
+			},
+			'stages': [
+				'start'
+			],
+			'start': [
+				'clean 1.0',
+				'until clean 2'
+			],
+			'seed': 1111
+		}
+
+		curriculum = CurriculumLoader().load(config)
+
+		with closing(Trainer(curriculum, catalog=DatasetCatalog())) as trainer:
+			progress = trainer.progress()
+			self.assertIsNone(progress.progress)
+			self.assertEqual(progress.expected_lines, {})
+
+			batches = iter(trainer.run(batch_size=100))
+			for _ in range(5):
+				next(batches)
+
+			progress = trainer.progress()
+			self.assertEqual(progress.stage, 'start')
+			self.assertAlmostEqual(progress.progress, 500 / 2000)
+			self.assertEqual(progress.expected_lines, {'clean': 2000})
+
 
 class TestCurriculumLoader(unittest.TestCase):
 	def test_simple(self):
@@ -411,6 +972,53 @@ class TestCurriculumLoader(unittest.TestCase):
 				# Assert that we got the specific error as well
 				self.assertRegex(logger_ctx.output[0], r'ValueError\(\'Out-of-bound alignment pairs\'\)')
 
+	@unittest.skipIf(pyarrow is None, 'pyarrow is not installed')
+	def test_columnar_datasets(self):
+		"""Test that Parquet and Arrow datasets are read as if they were TSV
+		files with the selected columns as fields."""
+		table = pyarrow.table({
+			'id': list(range(100)),
+			'src': [f'source {n}' for n in range(100)],
+			'trg': [f'target {n}' if n != 50 else None for n in range(100)],
+			'alignment': ['0-0 1-1'] * 100,
+		})
+
+		with tempfile.TemporaryDirectory() as tmpdir:
+			parquet_file = os.path.join(tmpdir, 'data.parquet')
+			pyarrow.parquet.write_table(table, parquet_file, row_group_size=10)
+
+			arrow_file = os.path.join(tmpdir, 'data.arrow')
+			with pyarrow.ipc.new_file(arrow_file, table.schema) as writer:
+				writer.write_table(table, max_chunksize=10)
+
+			for filename in [parquet_file, arrow_file]:
+				config = {
+					'datasets': {
+						'clean': filename,
+					},
+					'stages': [
+						'start'
+					],
+					'start': [
+						'clean 1.0',
+						'until clean 1'
+					],
+					'seed': 1,
+					'columns': ['src', 'trg', 'alignment']
+				}
+				curriculum = CurriculumLoader().load(config)
+
+				with self.subTest(filename=filename), \
+				 self.assertLogs(level='WARNING'), \
+				 closing(Trainer(curriculum)) as trainer:
+					log_once.cache_clear()
+					output = list(chain.from_iterable(trainer.run(batch_size=1)))
+					# Line 50 has an empty field and is skipped
+					self.assertEqual(sorted(output), sorted(
+						f'source {n}\ttarget {n}\t0-0 1-1\n'
+						for n in range(100) if n != 50
+					))
+
 	def test_num_fields(self):
 		"""Tests the num field limiter"""
 		with tempfile.NamedTemporaryFile('w', encoding='utf-8') as fd:
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+import os
+import pickle
+import random
+import signal
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from opustrainer.modifiers.transport import OrderedRing, Ring, pack_lines, unpack_lines
+from opustrainer.modifiers import Modifier
+from opustrainer.modifiers.pool import ModifierPool, ErzatsModifierPool, ChunkTimeoutError
+from opustrainer.modifiers import backends
+from opustrainer.modifiers.backends import ThreadModifierPool, InterpreterModifierPool, resolve_backend, run_chunk_in_interpreter
+from opustrainer.modifiers.stages import PipelineModifierPool, STATE_WORDS, MAX_REFILLS, save_state, restore_state
+from opustrainer.modifiers.surface import UpperCaseModifier, TitleCaseModifier
+from opustrainer.modifiers.typos import TypoModifier
+from opustrainer.modifiers.fused import fuse_modifiers
+from opustrainer.rng import CounterKey
+
+
+class CrashOnceModifier(Modifier):
+    """Kills its worker the first time it sees `line`, as if it ran out of
+    memory, or hangs on it if `hang` is set."""
+    def __init__(self, line:str, marker:str, hang:bool=False):
+        super().__init__(1.0)
+        self.line = line
+        self.marker = marker
+        self.hang = hang
+
+    def __call__(self, batch):
+        for line in batch:
+            if line == self.line and not os.path.exists(self.marker):
+                open(self.marker, 'w').close()
+                if self.hang:
+                    time.sleep(60)
+                os.kill(os.getpid(), signal.SIGKILL)
+            yield line
+
+
+class TestTransport(unittest.TestCase):
+    def test_pack_lines(self):
+        for lines in [[], [''], ['a', ''], ['héllo', 'wörld\tzh']]:
+            data = pack_lines(lines)
+            assert data is not None
+            self.assertEqual(unpack_lines(memoryview(data), len(lines)), lines)
+
+        # Can't be told apart from two lines
+        self.assertIsNone(pack_lines(['a\nb']))
+
+    def test_ring(self):
+        ring = Ring(10)
+        self.assertEqual(ring.reserve(4, tail=0), (0, 4))
+        self.assertEqual(ring.reserve(4, tail=0), (4, 8))
+        # Doesn't fit at the end, and the start is still in use
+        self.assertIsNone(ring.reserve(4, tail=0))
+        # Once the first block is read, it wraps around to the start
+        self.assertEqual(ring.reserve(4, tail=4), (0, 14))
+
+    def test_ordered_ring(self):
+        ring = OrderedRing(10)
+        first = ring.reserve(5)
+        second = ring.reserve(5)
+        assert first is not None and second is not None
+        self.assertIsNone(ring.reserve(1))
+
+        # Releasing the second block first does not free anything yet
+        ring.release(second[1])
+        self.assertIsNone(ring.reserve(1))
+        ring.release(first[1])
+        self.assertEqual(ring.reserve(10), (0, 20))
+
+    def test_pool(self):
+        """Test that the shared memory transport gives the same lines as the
+        queue, also when chunks don't fit in the rings."""
+        lines = [f'line {n}' for n in range(1000)] + ['with\nnewline']
+        with ModifierPool([UpperCaseModifier(1.0)], 2) as pool:
+            expected = pool.map(lines, 16)
+        self.assertEqual(expected[0], 'LINE 0')
+
+        for ring_size in [2**20, 256]:
+            with self.subTest(ring_size=ring_size):
+                with ModifierPool([UpperCaseModifier(1.0)], 2, transport='shm', ring_size=ring_size) as pool:
+                    self.assertEqual(pool.map(lines, 16), expected)
+                    self.assertEqual(pool.map(lines, 300), expected)
+                    if ring_size > 256:
+                        self.assertEqual(pool.stats.queued_chunks, 4) # the newline chunks, both ways
+                    self.assertGreater(pool.stats.shared_bytes, 0)
+
+    def test_imap(self):
+        """Test that imap gives the same batches as map, in order, with no more
+        chunks in flight than asked for."""
+        batches = [[f'batch {batch} line {n}' for n in range(size)] for batch, size in enumerate([40, 0, 7, 100, 1])]
+        keys = [CounterKey(1111, 0, index) for index in range(len(batches))]
+        jobs = lambda: ((batch, lambda chunk, size, key=key: (key, chunk * size)) for batch, key in zip(batches, keys))
+        modifiers = [UpperCaseModifier(0.5)]
+
+        with ErzatsModifierPool(modifiers) as pool:
+            expected = [pool.map(batch, 8, key=key) for batch, key in zip(batches, keys)]
+
+        for transport in ['queue', 'shm']:
+            with self.subTest(transport=transport):
+                with ModifierPool(modifiers, 2, transport=transport, max_inflight=3) as pool:
+                    self.assertEqual(list(pool.imap(jobs(), 8)), expected)
+                    self.assertEqual(pool.stats.peak_inflight, 3)
+                    self.assertEqual(pool.stats.inflight, 0)
+
+                    # Chunks still in flight when the caller stops don't end up
+                    # in the next call.
+                    modified = pool.imap(jobs(), 8)
+                    self.assertEqual(next(modified), expected[0])
+                    modified.close()
+                    self.assertEqual(pool.stats.inflight, 0)
+                    self.assertEqual(list(pool.imap(jobs(), 8)), expected)
+
+        with ErzatsModifierPool(modifiers) as pool:
+            self.assertEqual(list(pool.imap(jobs(), 8)), expected)
+
+    def test_dead_worker(self):
+        """Test that chunks of a worker that died are sent to its replacement,
+        giving the same lines."""
+        lines = [f'line {n}' for n in range(1000)]
+        with ErzatsModifierPool([UpperCaseModifier(0.5)]) as pool:
+            expected = pool.map(lines, 16, key=CounterKey(1111, 0, 0))
+
+        for transport in ['queue', 'shm']:
+            with self.subTest(transport=transport), tempfile.TemporaryDirectory() as tmpdir:
+                modifiers = [CrashOnceModifier('line 500', os.path.join(tmpdir, 'crashed')), UpperCaseModifier(0.5)]
+                with ModifierPool(modifiers, 2, transport=transport) as pool:
+                    self.assertEqual(pool.map(lines, 16, key=CounterKey(1111, 0, 0)), expected)
+                    self.assertEqual(pool.stats.restarts, 1)
+                    self.assertGreater(pool.stats.redispatched, 0)
+                    # The new workers keep working
+                    self.assertEqual(pool.map(lines, 16, key=CounterKey(1111, 0, 0)), expected)
+
+    def test_chunk_timeout(self):
+        """Test that a worker stuck on a chunk gives an error instead of
+        blocking forever."""
+        lines = [f'line {n}' for n in range(100)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            modifiers = [CrashOnceModifier('line 50', os.path.join(tmpdir, 'hung'), hang=True)]
+            with ModifierPool(modifiers, 2, chunk_timeout=1) as pool:
+                started = time.monotonic()
+                with self.assertRaisesRegex(ChunkTimeoutError, "line 48"):
+                    pool.map(lines, 16)
+            self.assertLess(time.monotonic() - started, 30)
+
+    def test_thread_backend(self):
+        """Test that modifiers running in threads give the same lines as in
+        processes, and don't touch the random state of the caller."""
+        batches = [[f'batch {batch} line {n}' for n in range(size)] for batch, size in enumerate([40, 0, 7, 100, 1])]
+        keys = [CounterKey(1111, 0, index) for index in range(len(batches))]
+        jobs = lambda: ((batch, lambda chunk, size, key=key: (key, chunk * size)) for batch, key in zip(batches, keys))
+        modifiers = [UpperCaseModifier(0.5)]
+
+        with ErzatsModifierPool(modifiers) as pool:
+            expected = [pool.map(batch, 8, key=key) for batch, key in zip(batches, keys)]
+
+        # Seeds drawn from the global random state
+        random.seed(1)
+        with ModifierPool(modifiers, 2) as pool:
+            expected_legacy = [pool.map(batch, 8) for batch in batches]
+        state = random.getstate()
+
+        random.seed(1)
+        with ThreadModifierPool(modifiers, 3, max_inflight=3) as pool:
+            self.assertEqual([pool.map(batch, 8) for batch in batches], expected_legacy)
+            self.assertEqual(random.getstate(), state)
+            self.assertEqual(list(pool.imap(jobs(), 8)), expected)
+            self.assertEqual(pool.stats.peak_inflight, 3)
+            self.assertEqual(pool.stats.inflight, 0)
+
+            modified = pool.imap(jobs(), 8)
+            self.assertEqual(next(modified), expected[0])
+            modified.close()
+            self.assertEqual(pool.stats.inflight, 0)
+            self.assertEqual(list(pool.imap(jobs(), 8)), expected)
+
+        # Typos draws from the random module through the typo library
+        typos = [UpperCaseModifier(0.5), TypoModifier(0.1)]
+        with self.assertRaises(ValueError):
+            ThreadModifierPool(typos, 3)
+        with ThreadModifierPool(modifiers, 3) as pool, self.assertRaises(ValueError):
+            pool.set_modifiers(typos)
+        self.assertEqual(resolve_backend('auto', typos), 'processes')
+        with self.assertRaises(ValueError):
+            resolve_backend('threads', typos)
+        self.assertEqual(resolve_backend('threads', fuse_modifiers(modifiers + [TitleCaseModifier(0.5)])), 'threads')
+
+        with self.assertRaises(ValueError):
+            resolve_backend('fibers')
+
+    def test_pipeline(self):
+        """Test that modifiers in a pipeline of their own workers give the same
+        lines as all of them in one worker, seeded per chunk or per line."""
+        batches = [[f'batch {batch} line {n}' for n in range(size)] for batch, size in enumerate([40, 0, 7, 100, 1])]
+        keys = [CounterKey(1111, 0, index) for index in range(len(batches))]
+        jobs = lambda: ((batch, lambda chunk, size, key=key: (key, chunk * size)) for batch, key in zip(batches, keys))
+        modifiers = [UpperCaseModifier(0.5), TitleCaseModifier(0.5)]
+        other = [TitleCaseModifier(0.3)]
+
+        with ErzatsModifierPool(modifiers) as pool:
+            expected = list(pool.imap(jobs(), 8))
+            random.seed(1)
+            expected_legacy = [pool.map(batch, 8) for batch in batches]
+            pool.set_modifiers(other)
+            expected_other = [pool.map(batch, 8) for batch in batches]
+
+        random.seed(1)
+        with PipelineModifierPool(modifiers, {'UpperCaseModifier': 2}) as pool:
+            self.assertEqual([pool.map(batch, 8) for batch in batches], expected_legacy)
+            # A new pipeline for new modifiers
+            pool.set_modifiers(other)
+            self.assertEqual([pool.map(batch, 8) for batch in batches], expected_other)
+            pool.set_modifiers(modifiers)
+            self.assertEqual(list(pool.imap(jobs(), 8)), expected)
+            self.assertEqual(pool.stats.inflight, 0)
+            self.assertEqual(pool.workers, 3)
+
+            assert pool._pipeline is not None
+            (upper_busy, upper_chunks), (title_busy, title_chunks) = pool._pipeline.utilisation()
+            self.assertEqual(upper_chunks, 20)
+            self.assertEqual(title_chunks, 20)
+            self.assertTrue(0 <= upper_busy <= 1)
+
+    def test_pipeline_state(self):
+        """Test that the random state between stages is the seed and the words
+        drawn since, unless it can't be, and gives the same state back."""
+        for drawn in [0, 1, STATE_WORDS - 1, STATE_WORDS, STATE_WORDS + 1, MAX_REFILLS * STATE_WORDS, MAX_REFILLS * STATE_WORDS + 1]:
+            with self.subTest(drawn=drawn):
+                random.seed(1234)
+                for _ in range(drawn):
+                    random.getrandbits(32)
+                expected = random.getstate()
+                state = save_state((1234, 0))
+                self.assertEqual(state, (1234, drawn) if drawn <= MAX_REFILLS * STATE_WORDS else expected)
+                random.seed(1)
+                restore_state(state)
+                self.assertEqual(random.getstate(), expected)
+
+        # Continuing from a state that was saved
+        random.seed(0.5)
+        random.random()
+        state = save_state((0.5, 0))
+        self.assertEqual(state, (0.5, 2))
+        restore_state(state)
+        random.random()
+        self.assertEqual(save_state(state), (0.5, 4))
+
+        # gauss() keeps its second number in the state
+        random.seed(1234)
+        random.gauss(0, 1)
+        expected = random.getstate()
+        self.assertEqual(save_state((1234, 0)), expected)
+
+    def test_pipeline_dead_worker(self):
+        """Test that a dead pipeline worker fails the chunks instead of hanging."""
+        lines = [f'line {n}' for n in range(100)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            modifiers = [UpperCaseModifier(0.5), CrashOnceModifier('line 50', os.path.join(tmpdir, 'crashed'))]
+            with PipelineModifierPool(modifiers, {}) as pool:
+                with self.assertRaises(RuntimeError):
+                    pool.map(lines, 10)
+
+    def test_pipeline_killed_worker(self):
+        """Test that killing a stage worker while `imap()` keeps submitting
+        chunks fails them, also those submitted after the pipeline broke,
+        instead of hanging."""
+        batches = (([f'batch {batch} line {n}' for n in range(100)], lambda chunk, size: chunk) for batch in range(10000))
+        with PipelineModifierPool([UpperCaseModifier(0.5), TitleCaseModifier(0.5)], {}) as pool:
+            modified = pool.imap(batches, 10)
+            next(modified)
+            pipeline = pool._pipeline
+            assert pipeline is not None
+            os.kill(pipeline.processes[1][0].pid, signal.SIGKILL)
+            with self.assertRaises(RuntimeError):
+                for _ in modified:
+                    pass
+            self.assertTrue(pool._broken)
+            self.assertIsInstance(pipeline.submit(['line'], 1).exception(timeout=0), RuntimeError)
+
+    def test_interpreter_modifiers(self):
+        """Test that the chunks for the interpreters only carry the path of the
+        pickled modifiers, which an interpreter reads once per version."""
+        lines = [f'line {n}' for n in range(100)]
+        key = CounterKey(1111, 0, 0)
+        with ErzatsModifierPool([UpperCaseModifier(0.5)]) as erzats:
+            expected = erzats.map(lines, 16, key=key)
+
+        backends._interpreter_modifiers = (-1, [])
+        pool = InterpreterModifierPool([UpperCaseModifier(0.5)], 2)
+        try:
+            path = pool._modifiers_file()
+            self.assertEqual(pool._modifiers_file(), path)
+            with mock.patch('pickle.load', wraps=pickle.load) as load:
+                output = [run_chunk_in_interpreter(pool.version, path, lines[start:start + 16], (key, start)) for start in range(0, 100, 16)]
+                self.assertEqual(load.call_count, 1)
+                pool.set_modifiers([TitleCaseModifier(0.5)])
+                self.assertNotEqual(pool._modifiers_file(), path)
+                run_chunk_in_interpreter(pool.version, pool._modifiers_file(), lines, (key, 0))
+                self.assertEqual(load.call_count, 2)
+            self.assertEqual([line for chunk in output for line in chunk], expected)
+        finally:
+            pool._remove_files()
+        self.assertFalse(os.path.exists(path))
+
+    @unittest.skipUnless(sys.version_info >= (3, 14), 'needs subinterpreters')
+    def test_interpreter_backend(self):
+        lines = [f'line {n}' for n in range(100)]
+        with ErzatsModifierPool([UpperCaseModifier(0.5)]) as pool:
+            expected = pool.map(lines, 16, key=CounterKey(1111, 0, 0))
+        with InterpreterModifierPool([UpperCaseModifier(0.5)], 2) as pool:
+            self.assertEqual(pool.map(lines, 16, key=CounterKey(1111, 0, 0)), expected)
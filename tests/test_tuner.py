@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+import unittest
+
+from opustrainer.modifiers.tuner import Autotuner, TunerWindow
+from opustrainer.modifiers.pool import ModifierPool
+from opustrainer.modifiers.surface import UpperCaseModifier
+
+
+def window(consumer:float=0.0, stall:float=0.0, utilisation=None) -> TunerWindow:
+    return TunerWindow(1.0, consumer, stall, 1.0 - consumer - stall, utilisation)
+
+
+class TestTuner(unittest.TestCase):
+    def test_decide(self):
+        tuner = Autotuner(16, 4, 100)
+
+        # Waiting for busy workers: all are active already, and there are
+        # enough chunks to go round.
+        self.assertIsNone(tuner.decide(window(stall=0.9, utilisation=0.95)))
+
+        # The trainer program can't keep up: free a CPU for it
+        self.assertIsNotNone(tuner.decide(window(consumer=0.8)))
+        self.assertEqual(tuner.settings.workers, 3)
+
+        # Waiting for busy workers again: take it back
+        self.assertIsNotNone(tuner.decide(window(stall=0.9, utilisation=0.95)))
+        self.assertEqual(tuner.settings.workers, 4)
+
+        # Waiting for idle workers: chunks too small to be worth it
+        self.assertIsNotNone(tuner.decide(window(stall=0.9, utilisation=0.1)))
+        self.assertEqual(tuner.settings.chunk_size, 32)
+
+        # Busy sending chunks, but not larger than what still gives every
+        # worker a chunk of each batch
+        self.assertIsNone(tuner.decide(window(stall=0.2)))
+        self.assertEqual(tuner.settings.chunk_size, 32)
+        tuner.settings.workers = 2
+        self.assertIsNotNone(tuner.decide(window(stall=0.2)))
+        self.assertEqual(tuner.settings.chunk_size, 64)
+
+        # Within the bounds
+        tuner = Autotuner(16, 1, 100, min_workers=1)
+        self.assertIsNone(tuner.decide(window(consumer=0.9, stall=0.1)))
+        self.assertEqual(tuner.settings.workers, 1)
+
+    def test_stages(self):
+        """Test that each stage keeps its own settings, and that the pool is
+        limited to as many chunks in flight as there are active workers."""
+        with ModifierPool([UpperCaseModifier(0.5)], 2) as pool:
+            tuner = Autotuner(16, 2, 100, interval=0)
+            tuner.start_stage('start', pool)
+            self.assertEqual(pool.max_inflight, 0)
+
+            tuner.settings.workers = 1
+            tuner.settings.chunk_size = 32
+            tuner._apply(pool)
+            self.assertEqual(pool.max_inflight, 1)
+
+            pool.stats.peak_inflight = 0
+            lines = [f'line {n}' for n in range(100)]
+            modified = list(pool.imap([(lines, lambda chunk, size: 1.0)] * 3, lambda: tuner.chunk_size))
+            self.assertEqual([len(batch) for batch in modified], [100, 100, 100])
+            self.assertEqual(pool.stats.peak_inflight, 1)
+
+            tuner.start_stage('mid', pool)
+            self.assertEqual((tuner.chunk_size, tuner.settings.workers), (16, 2))
+            self.assertEqual(pool.max_inflight, 0)
+
+            tuner.start_stage('start', pool)
+            self.assertEqual((tuner.chunk_size, tuner.settings.workers), (32, 1))
+            self.assertEqual(pool.max_inflight, 1)
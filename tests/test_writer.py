@@ -0,0 +1,142 @@
+import os
+import unittest
+from threading import Thread
+
+from opustrainer.writer import PipeWriter, BufferedConsumer, TeeWriter, WriteTracker, set_pipe_size
+
+
+class TestPipeWriter(unittest.TestCase):
+    def test_write(self):
+        """Test that all blocks arrive in order, whether they're written
+        immediately or collected until flush()."""
+        blocks = [f'line {n}\n'.encode() * n for n in range(200)]
+        read_fd, write_fd = os.pipe()
+
+        received = []
+        reader = Thread(target=lambda: received.extend(iter(lambda: os.read(read_fd, 2**16), b'')))
+        reader.start()
+
+        set_pipe_size(write_fd, 2**16)
+        writer = PipeWriter(write_fd, buffer_size=4096)
+        for block in blocks:
+            writer.write(block)
+        writer.flush()
+        os.close(write_fd)
+        reader.join()
+        os.close(read_fd)
+
+        self.assertEqual(b''.join(received), b''.join(blocks))
+        self.assertEqual(writer.bytes_written, sum(len(block) for block in blocks))
+        self.assertGreater(writer.throughput, 0)
+
+
+class TestBufferedConsumer(unittest.TestCase):
+    def test_spill(self):
+        """Test that with the spill policy, put() does not wait for a trainer
+        that isn't reading, and the blocks still arrive in order."""
+        blocks = [f'batch {n}\n'.encode() * 100 for n in range(100)]
+        read_fd, write_fd = os.pipe()
+
+        consumer = BufferedConsumer(PipeWriter(write_fd, buffer_size=1), maxsize=2, policy='spill')
+
+        # More than fits in the pipe buffer, while nobody is reading yet
+        for block in blocks:
+            consumer.put(block)
+        self.assertGreater(consumer.spilled_bytes, 0)
+
+        received = []
+        reader = Thread(target=lambda: received.extend(iter(lambda: os.read(read_fd, 2**16), b'')))
+        reader.start()
+
+        # Once caught up, the in-memory buffer is used again
+        consumer.put(b'last\n')
+
+        consumer.close()
+        os.close(write_fd)
+        reader.join()
+        os.close(read_fd)
+
+        self.assertEqual(b''.join(received), b''.join(blocks) + b'last\n')
+
+    def test_tee(self):
+        """Test that all trainers get the same blocks, and that a trainer that
+        stops reading is dropped without stopping the others."""
+        blocks = [f'batch {n}\n'.encode() for n in range(1000)]
+        pipes = [os.pipe() for _ in range(3)]
+
+        received = [[] for _ in pipes]
+        readers = [
+            Thread(target=lambda read_fd=read_fd, out=out: out.extend(iter(lambda: os.read(read_fd, 2**16), b'')))
+            for (read_fd, _), out in zip(pipes[:2], received)
+        ]
+        for reader in readers:
+            reader.start()
+
+        # The third trainer is gone before it reads anything
+        os.close(pipes[2][0])
+
+        writer = TeeWriter([
+            BufferedConsumer(PipeWriter(write_fd, buffer_size=4096), maxsize=4, policy=policy)
+            for (_, write_fd), policy in zip(pipes, ['block', 'spill', 'block'])
+        ])
+
+        with self.assertLogs(level='INFO') as logs:
+            for block in blocks:
+                writer.write(block)
+            writer.flush()
+        self.assertIn('trainer 2 stopped reading input', logs.output[0])
+
+        for (read_fd, write_fd), reader in zip(pipes[:2], readers):
+            os.close(write_fd)
+            reader.join()
+            os.close(read_fd)
+        os.close(pipes[2][1])
+
+        self.assertEqual(b''.join(received[0]), b''.join(blocks))
+        self.assertEqual(b''.join(received[1]), b''.join(blocks))
+
+
+class TestWriteTracker(unittest.TestCase):
+    def test_buffered(self):
+        """Test that a batch only counts as written once PipeWriter has written
+        it out, not while it is waiting in the buffer."""
+        read_fd, write_fd = os.pipe()
+        set_pipe_size(write_fd, 2**16)
+
+        tracker = WriteTracker(PipeWriter(write_fd, buffer_size=100), 0)
+        self.assertEqual(tracker.write(b'a' * 40, 1), 0)
+        self.assertEqual(tracker.write(b'b' * 40, 2), 0)
+        self.assertEqual(tracker.write(b'c' * 40, 3), 3) # Buffer full, all written
+        self.assertEqual(tracker.write(b'd' * 40, 4), 3)
+        self.assertEqual(tracker.flush(), 4)
+
+        os.close(write_fd)
+        self.assertEqual(os.read(read_fd, 2**16), b'a' * 40 + b'b' * 40 + b'c' * 40 + b'd' * 40)
+        os.close(read_fd)
+
+    def test_tee(self):
+        """Test that with multiple trainers, a batch counts as written once
+        every trainer that is still reading got it."""
+        read_fd, write_fd = os.pipe()
+        set_pipe_size(write_fd, 2**16)
+
+        # The second trainer is gone before it reads anything
+        gone_read_fd, gone_write_fd = os.pipe()
+        os.close(gone_read_fd)
+
+        tracker = WriteTracker(TeeWriter([
+            BufferedConsumer(PipeWriter(write_fd, buffer_size=2**20)),
+            BufferedConsumer(PipeWriter(gone_write_fd, buffer_size=1)),
+        ]), 0)
+
+        with self.assertLogs(level='INFO'):
+            for n in range(1, 11):
+                tracker.write(f'batch {n}\n'.encode(), n)
+                # Nothing reaches the first trainer until its buffer is flushed
+                self.assertEqual(tracker.update(), 0)
+            self.assertEqual(tracker.flush(), 10)
+
+        os.close(write_fd)
+        self.assertEqual(os.read(read_fd, 2**16), b''.join(f'batch {n}\n'.encode() for n in range(1, 11)))
+        os.close(read_fd)
+        os.close(gone_write_fd)